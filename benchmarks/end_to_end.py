@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# measures the throughput and server CPU of a whole TNRA run on one machine
+#
+# For every number of workers, starts a tnra.Server in its own process,
+# enqueues --routes distinct routes with tnra.Client.enqueue_many, and routes
+# them with tnra.start_routers using tnra.synthetic.SyntheticDistances in place
+# of OpenTripPlanner, so no routing engine, database or graph is needed.
+# Reports the enqueue rate, the rate at which workers popped and finished
+# routes, the rate at which the server wrote results, and the CPU time that the
+# server used, which is the cost that does not go down as workers are added.
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from tnra import router, server, synthetic
+
+def serve(port, result_port, cpu_times):
+    tnra_server = server.Server(port, result_port = result_port)
+    tnra_server.start()
+    tnra_server.join()
+    cpu_times.put(time.process_time())
+
+def routes(n, seed = 0):
+    """ Return n distinct routes around Boston, so that none of them are
+    deduplicated by the server """
+
+    generator = random.Random(seed)
+    return [
+        (-71.2 + generator.random() * 0.3, 42.2 + generator.random() * 0.2,
+         -71.2 + generator.random() * 0.3, 42.2 + generator.random() * 0.2)
+        for i in range(n)
+    ]
+
+def run(n_workers, args, directory):
+    cpu_times = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target = serve, args = (args.port, args.result_port, cpu_times)
+    )
+    server_process.start()
+
+    client = server.Client(port = args.port)
+    client.ping()
+    client.open_file(os.path.join(directory, "routes_%d.json" % n_workers))
+
+    start_time = time.time()
+    client.enqueue_many(routes(args.routes), mode = args.mode)
+    enqueue_seconds = time.time() - start_time
+
+    start_time = time.time()
+    router.start_routers({
+        "router": synthetic.SyntheticDistances,
+        "kwargs": {
+            "latency": args.latency_ms / 1000,
+            "latency_sd": args.latency_sd_ms / 1000,
+            "failure_rate": args.failure_rate,
+            "response_size": args.response_size
+        },
+        "route_logging": False,
+        "server_port": args.port,
+        "server_result_port": args.result_port,
+        "concurrency": args.concurrency
+    }, threads = n_workers)
+    route_seconds = time.time() - start_time
+
+    # results are only all written once the file is closed
+    client.close_file()
+    write_seconds = time.time() - start_time
+    write_stats = client.write_stats()
+    client.exit()
+    server_process.join()
+    server_cpu = cpu_times.get()
+
+    return {
+        "enqueue": args.routes / enqueue_seconds,
+        "pop": args.routes / route_seconds,
+        "write": write_stats["lines_written"] / write_seconds,
+        "server_cpu": server_cpu,
+        "server_cpu_share": server_cpu / (enqueue_seconds + route_seconds)
+    }
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(
+        description = "Measure the throughput of TNRA with a synthetic "
+                      "routing backend"
+    )
+    parser.add_argument("-n", "--routes", type = int, default = 20000,
+                        help = "Number of routes to enqueue and route")
+    parser.add_argument("-w", "--workers", type = int, nargs = "+",
+                        default = [1, 2, 4, 8],
+                        help = "Numbers of router processes")
+    parser.add_argument("-c", "--concurrency", type = int, default = 1,
+                        help = "Routes calculated at once by every process")
+    parser.add_argument("-m", "--mode", default = "walk",
+                        help = "Mode of the routes")
+    parser.add_argument("-l", "--latency-ms", type = float, default = 0,
+                        help = "Milliseconds that a route takes")
+    parser.add_argument("--latency-sd-ms", type = float, default = 0,
+                        help = "Standard deviation of the route latency, in "
+                               "milliseconds")
+    parser.add_argument("-f", "--failure-rate", type = float, default = 0,
+                        help = "Share of routes that are not found")
+    parser.add_argument("-s", "--response-size", type = int, default = 20000,
+                        help = "Size of each fake OTP response, in bytes")
+    parser.add_argument("-p", "--port", type = int, default = 5599)
+    parser.add_argument("-r", "--result-port", type = int, default = 5600)
+    args = parser.parse_args()
+
+    # printing every route would be most of the work of a router
+    router.VERBOSE = False
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("%8s %12s %12s %12s %12s %10s" % (
+            "workers", "enqueue/s", "pop/s", "writes/s", "server CPU s",
+            "server CPU"
+        ))
+        for n_workers in args.workers:
+            result = run(n_workers, args, directory)
+            print("%8d %12.0f %12.0f %12.0f %12.2f %9.0f%%" % (
+                n_workers, result["enqueue"], result["pop"], result["write"],
+                result["server_cpu"], 100 * result["server_cpu_share"]
+            ))
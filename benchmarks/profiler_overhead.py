@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# measures the cost of profiling a job, as a share of the time a route takes
+#
+# Times jobs shaped like the stages of tnra.Router.route, without a routing
+# engine, with profiling turned off and at several sample rates. --route-ms is
+# the time that a route takes the routing engine.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from tnra import profiler
+
+STAGES = ("departure_time", "cache_get", "routing_engine", "write_result",
+          "route_log")
+
+def job(stage):
+    with stage("queue_pop"):
+        pass
+    with stage("job"):
+        for name in STAGES:
+            with stage(name):
+                pass
+
+def null_stage(name):
+    return profiler.NULL_STAGE
+
+def run(stage, n):
+    start_time = time.perf_counter()
+    for i in range(n):
+        job(stage)
+    return time.perf_counter() - start_time
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(
+        description = "Measure the overhead of stage profiling"
+    )
+    parser.add_argument("-n", "--jobs", type = int, default = 200000,
+                        help = "Number of jobs to run")
+    parser.add_argument("--route-ms", type = float, default = 50.0,
+                        help = "Milliseconds that a route takes to calculate")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        baseline = run(null_stage, args.jobs)
+        print("%-22s %6.2f us per job" % (
+            "profiling off", baseline / args.jobs * 1e6
+        ))
+        for sample_rate in (0.0, 0.01, 0.1, 1.0):
+            profile = profiler.Profiler(
+                os.path.join(directory, "profile.json"), sample_rate
+            )
+            per_job = (run(profile.stage, args.jobs) - baseline) / args.jobs
+            profile.close()
+            print("%-22s %6.2f us per job, %.4f%% of a %g ms route" % (
+                "sample rate %g" % sample_rate, per_job * 1e6,
+                100 * per_job * 1000 / args.route_ms, args.route_ms
+            ))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# measures the cost of encoding and decoding the hot TNRA server messages
+#
+# Compares the binary wire protocol against the pickled dicts that were
+# previously sent for every message.
+
+import argparse
+import json
+import pickle
+import timeit
+
+from tnra import server
+
+ROUTE = (
+    (-71.089824, 42.337874, -71.116708, 42.372779),
+    {
+        "mode": "walk",
+        "attributes": {
+            "blockgroup_geoid": "250250001001",
+            "shelter_objectid": 12
+        }
+    }
+)
+
+def pickle_cmd(cmd, body):
+    return [pickle.dumps({"cmd": cmd, "body": body})]
+
+def unpickle_cmd(frames):
+    return pickle.loads(frames[0])
+
+def pickle_rsp(cmd, body):
+    return [pickle.dumps({"rsp": server.RESPONSES["ok"], "body": body})]
+
+def unpickle_rsp(cmd, frames):
+    return pickle.loads(frames[0])
+
+def protocol_cmd(cmd, body):
+    return server.encode_cmd({"cmd": cmd, "body": body})
+
+def protocol_rsp(cmd, body):
+    return server.encode_rsp(cmd, {"rsp": server.RESPONSES["ok"], "body": body})
+
+def cases(batch_size, response_size):
+    record = {"response": {"plan": "x" * response_size}, "attributes": ROUTE[1]}
+    # distinct objects, so that pickle cannot memoize repeated routes
+    batch = [
+        (
+            tuple(coord + i * 1e-6 for coord in ROUTE[0]),
+            {
+                "mode": ROUTE[1]["mode"],
+                "attributes": dict(ROUTE[1]["attributes"], index = i)
+            }
+        )
+        for i in range(batch_size)
+    ]
+    return [
+        ("enqueue", "cmd", server.COMMANDS["enqueue"], ROUTE, 1),
+        ("enqueue_many", "cmd", server.COMMANDS["enqueue_many"], batch,
+         batch_size),
+        ("queue_pop", "rsp", server.COMMANDS["queue_pop"], ROUTE, 1),
+        ("queue_pop_many", "rsp", server.COMMANDS["queue_pop_many"], batch,
+         batch_size),
+        ("write_to_disk", "cmd", server.COMMANDS["write_to_disk"], record, 1)
+    ]
+
+def measure(function, number):
+    return min(timeit.repeat(function, number = number, repeat = 5)) / number
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(description = "Measure the cost of "
+                                                   "encoding server messages")
+    parser.add_argument("-b", "--batch-size", type = int, default = 1000,
+                        help = "Number of routes in batched messages")
+    parser.add_argument("-s", "--response-size", type = int, default = 20000,
+                        help = "Size of each fake OTP response, in bytes")
+    parser.add_argument("-n", "--number", type = int, default = 200,
+                        help = "Number of messages to time per repetition")
+    args = parser.parse_args()
+
+    print("%-16s %-9s %14s %14s %10s" % (
+        "message", "codec", "encode us/rt", "decode us/rt", "bytes/rt"
+    ))
+    for (name, kind, cmd, body, n_routes) in cases(args.batch_size,
+                                                   args.response_size):
+        # the worker JSON-encodes results before handing them to the client
+        if (cmd == server.COMMANDS["write_to_disk"]):
+            body = json.dumps(body)
+
+        if (kind == "cmd"):
+            codecs = [
+                ("pickle", pickle_cmd, unpickle_cmd),
+                ("protocol", protocol_cmd, server.decode_cmd)
+            ]
+        else:
+            codecs = [
+                ("pickle", pickle_rsp,
+                 lambda frames: unpickle_rsp(cmd, frames)),
+                ("protocol", protocol_rsp,
+                 lambda frames: server.decode_rsp(cmd, frames))
+            ]
+
+        for (codec, encode, decode) in codecs:
+            frames = encode(cmd, body)
+            encode_time = measure(lambda: encode(cmd, body), args.number)
+            decode_time = measure(lambda: decode(frames), args.number)
+            print("%-16s %-9s %14.2f %14.2f %10.0f" % (
+                name, codec,
+                encode_time * 1e6 / n_routes,
+                decode_time * 1e6 / n_routes,
+                sum(len(frame) for frame in frames) / n_routes
+            ))
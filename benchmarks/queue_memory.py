@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# measures the memory used per queued route by the TNRA server queue
+#
+# Compares tnra.queues.ColumnarQueue against the list of individually
+# zlib-compressed pickles that the server previously used, with routes shaped
+# like the ones enqueued by the hurricane shelter simulation.
+
+import argparse
+import pickle
+import random
+import time
+import tracemalloc
+import zlib
+
+from tnra import queues
+
+def routes(n):
+    for i in range(n):
+        yield (
+            (
+                -71.0 - random.random() * 0.2, 42.2 + random.random() * 0.2,
+                -71.0 - random.random() * 0.2, 42.2 + random.random() * 0.2
+            ),
+            {
+                "mode": random.choice(["walk", "drive", "transit"]),
+                "attributes": {
+                    "blockgroup_geoid": "25025%07d" % random.randint(0, 999999),
+                    "shelter_objectid": random.randint(1, 60)
+                }
+            }
+        )
+
+def pickle_queue(items):
+    queue = []
+    queue.extend(zlib.compress(pickle.dumps(item)) for item in items)
+    return queue
+
+def columnar_queue(items):
+    queue = queues.ColumnarQueue()
+    queue.extend(items)
+    return queue
+
+def measure(build, n):
+    items = list(routes(n))
+
+    # timed separately, as tracing allocations slows everything down
+    start_time = time.time()
+    queue = build(items)
+    elapsed = time.time() - start_time
+    del queue
+
+    tracemalloc.start()
+    queue = build(items)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current / n, n / elapsed)
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(description = "Measure queue memory use")
+    parser.add_argument("-n", "--routes", type = int, default = 1000000,
+                        help = "Number of routes to enqueue")
+    args = parser.parse_args()
+
+    print("%-10s %14s %14s" % ("queue", "bytes/route", "routes/s"))
+    for (name, build) in [("pickle", pickle_queue),
+                          ("columnar", columnar_queue)]:
+        (bytes_per_route, rate) = measure(build, args.routes)
+        print("%-10s %14.1f %14.0f" % (name, bytes_per_route, rate))
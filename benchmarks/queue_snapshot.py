@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# measures how long the TNRA server queue takes to snapshot and recover
+#
+# Builds a queue of routes shaped like the ones enqueued by the hurricane
+# shelter simulation, snapshots it with tnra.journal.Journal, logs a tail of
+# further enqueues and pops to the journal, and recovers the queue from the
+# snapshot and journal. The rate at which the tail is replayed is used to
+# estimate how long recovery would take by replaying the whole job history
+# instead.
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from tnra import journal, queues
+
+def routes(n, first_job_id = 0):
+    for i in range(n):
+        yield (
+            (
+                -71.0 - random.random() * 0.2, 42.2 + random.random() * 0.2,
+                -71.0 - random.random() * 0.2, 42.2 + random.random() * 0.2
+            ),
+            {
+                "job_id": first_job_id + i,
+                "mode": random.choice(["walk", "drive", "transit"]),
+                "attributes": {
+                    "blockgroup_geoid": "25025%07d" % random.randint(0, 999999),
+                    "shelter_objectid": random.randint(1, 60)
+                }
+            }
+        )
+
+def timed(function, *args):
+    start_time = time.time()
+    result = function(*args)
+    return (result, time.time() - start_time)
+
+def recover(directory):
+    journal_ = journal.Journal(directory)
+    (queue, state, ops) = journal_.recover()
+    for (op, argument) in ops:
+        if (op == "enqueue"):
+            queue.extend(argument)
+        elif (op == "pop"):
+            queue.pop_many(*argument)
+    journal_.close()
+    return queue
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(
+        description = "Measure queue snapshot and recovery times"
+    )
+    parser.add_argument("-n", "--routes", type = int, default = 50000000,
+                        help = "Number of routes in the snapshot")
+    parser.add_argument("-t", "--tail", type = int, default = 100000,
+                        help = "Number of routes enqueued after the snapshot")
+    parser.add_argument("-d", "--directory",
+                        help = "Directory to write the journal to; by default, "
+                               "a temporary directory")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp()
+    try:
+        queue = queues.QueueSet()
+        (_, elapsed) = timed(queue.extend, routes(args.routes))
+        print("built %d routes in %.1f s (%d MB of columns)" % (
+            len(queue), elapsed, queue.nbytes() / 1e6
+        ))
+
+        journal_ = journal.Journal(directory)
+        journal_.recover()
+        (_, elapsed) = timed(journal_.snapshot, queue, {})
+        size = os.path.getsize(os.path.join(directory, journal.SNAPSHOT_NAME))
+        print("snapshot: %.2f s, %d MB, %.0f MB/s" % (
+            elapsed, size / 1e6, size / 1e6 / elapsed
+        ))
+
+        def log_tail():
+            for item in routes(args.tail, len(queue)):
+                journal_.enqueue(item)
+            journal_.commit()
+            journal_.pop(args.tail // 2)
+            journal_.commit()
+        (_, elapsed) = timed(log_tail)
+        print("journaled %d enqueues and a pop in %.2f s" % (
+            args.tail, elapsed
+        ))
+        journal_.close()
+        del queue
+
+        (queue, elapsed) = timed(recover, directory)
+        print("recovered %d routes in %.2f s" % (len(queue), elapsed))
+
+        # replay only the journal to measure the cost of replaying a route
+        os.remove(os.path.join(directory, journal.SNAPSHOT_NAME))
+        os.rename(
+            os.path.join(directory, "%s1" % journal.JOURNAL_PREFIX),
+            os.path.join(directory, "%s0" % journal.JOURNAL_PREFIX)
+        )
+        (tail, elapsed) = timed(recover, directory)
+        print("replaying the full history of %d routes would take ~%.0f s" % (
+            args.routes + args.tail, elapsed / args.tail
+            * (args.routes + args.tail)
+        ))
+    finally:
+        if (args.directory is None):
+            shutil.rmtree(directory)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# measures the cost of logging a route, as a share of the time a route takes
+#
+# Compares opening the route log, appending one line and closing it again for
+# every route, which is what tnra.Router used to do, with buffering records in
+# a tnra.routelog.RouteLog. Records are shaped like the ones logged by
+# tnra.Router; --route-ms is the time that a route takes the routing engine.
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from tnra import routelog
+
+def record(i):
+    return {
+        "time": time.time(),
+        "success": 1,
+        "origin_x": -71.089824, "origin_y": 42.337874,
+        "dest_x": -71.116708, "dest_y": 42.372779,
+        "mode": "transit",
+        "departure_time": datetime.datetime(2017, 10, 4, 11).timestamp(),
+        "attributes": {
+            "blockgroup_geoid": "250250101031",
+            "shelter_objectid": i % 60
+        }
+    }
+
+def log_per_route(path, n):
+    for i in range(n):
+        with open(path, "a") as f:
+            f.write(json.dumps(record(i)))
+            f.write("\n")
+
+def log_buffered(path, n):
+    log = routelog.RouteLog(path)
+    for i in range(n):
+        log.write(record(i))
+    log.close()
+
+def log_nothing(path, n):
+    for i in range(n):
+        record(i)
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(
+        description = "Measure the overhead of route logging"
+    )
+    parser.add_argument("-n", "--routes", type = int, default = 200000,
+                        help = "Number of routes to log")
+    parser.add_argument("--route-ms", type = float, default = 50.0,
+                        help = "Milliseconds that a route takes to calculate")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        start_time = time.time()
+        log_nothing(None, args.routes)
+        baseline = time.time() - start_time
+
+        for (name, function) in (("open/append per route", log_per_route),
+                                 ("buffered", log_buffered)):
+            path = os.path.join(directory, "%s.json" % function.__name__)
+            start_time = time.time()
+            function(path, args.routes)
+            elapsed = time.time() - start_time
+            per_route = (elapsed - baseline) / args.routes
+            print("%-22s %6.1f us per route, %.3f%% of a %g ms route" % (
+                name, per_route * 1e6, 100 * per_route * 1000 / args.route_ms,
+                args.route_ms
+            ))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# compares the throughput of the TNRA server engines
+#
+# Popping processes repeatedly call queue_pop while writing processes
+# repeatedly send fake OTP responses of --response-size bytes with
+# write_to_disk, which are the two halves of what tnra.Router does for every
+# route. --write-latency adds an artificial delay to every flush of the
+# server's result writer to simulate a slow disk; as the writer flushes on its
+# own thread, it should only slow down the writes of a full buffer.
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from tnra import server, writer
+
+class SlowDiskWriter(writer.ResultWriter):
+
+    """ ResultWriter whose flushes take at least write_latency seconds """
+
+    def __init__(self, write_latency):
+        writer.ResultWriter.__init__(self)
+        self.write_latency = write_latency
+
+    def _flush(self):
+        if ((self._file is not None) and (self._buffer_bytes > 0)):
+            time.sleep(self.write_latency)
+        writer.ResultWriter._flush(self)
+
+class SlowDiskServer(server.Server):
+
+    """ Server whose result writer is a SlowDiskWriter """
+
+    def __init__(self, port, engine, write_latency):
+        server.Server.__init__(self, port, engine)
+        self.writer = SlowDiskWriter(write_latency)
+
+def routes(n):
+    """ Return n distinct routes, which are not deduplicated """
+
+    return [
+        (-71.0 - (i % 1000) * 1e-4, 42.0, -71.1, 42.1 + (i // 1000) * 1e-4)
+        for i in range(n)
+    ]
+
+def popper(port, stop, results):
+    client = server.Client(port = port)
+    n = 0
+    while (not stop.is_set()):
+        client.queue_pop()
+        n += 1
+    results.put(("pop", n))
+
+def write(port, response_size, stop, results):
+    client = server.Client(port = port)
+    response = "x" * response_size
+    n = 0
+    while (not stop.is_set()):
+        client.write_to_disk({"response": response, "attributes": None})
+        n += 1
+    results.put(("write", n))
+
+def run(engine, port, n_workers, n_routes, response_size, write_latency,
+        duration, directory):
+    tnra_server = SlowDiskServer(port, engine, write_latency)
+    tnra_server.daemon = True
+    tnra_server.start()
+
+    client = server.Client(port = port)
+    client.enqueue_many(routes(n_routes), mode = "walk")
+    client.open_file(os.path.join(directory, "routes_%s.json" % engine))
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target = popper, args = (port, stop, results))
+        for i in range(n_workers)
+    ] + [
+        multiprocessing.Process(
+            target = write, args = (port, response_size, stop, results)
+        )
+        for i in range(n_workers)
+    ]
+
+    for process in processes:
+        process.start()
+    time.sleep(duration)
+    stop.set()
+
+    totals = {"pop": 0, "write": 0}
+    for process in processes:
+        (kind, n) = results.get()
+        totals[kind] += n
+    for process in processes:
+        process.join()
+
+    client.close_file()
+    client.exit()
+    tnra_server.join()
+
+    return (totals["pop"] / duration, totals["write"] / duration)
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(description = "Compare the throughput "
+                                                   "of the TNRA server engines")
+    parser.add_argument("-w", "--workers", type = int, nargs = "+",
+                        default = [1, 4, 16],
+                        help = "Numbers of popping and writing processes")
+    parser.add_argument("-r", "--routes", type = int, default = 200000,
+                        help = "Number of routes to enqueue for each run")
+    parser.add_argument("-d", "--duration", type = float, default = 5,
+                        help = "Duration of each run, in seconds")
+    parser.add_argument("-s", "--response-size", type = int, default = 20000,
+                        help = "Size of each fake OTP response, in bytes")
+    parser.add_argument("-l", "--write-latency", type = float, default = 0,
+                        help = "Artificial delay added to each flush of the "
+                               "result writer, in seconds")
+    parser.add_argument("-p", "--port", type = int, default = 5599)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("%8s %8s %12s %12s" % ("engine", "workers", "pops/s", "writes/s"))
+        for n_workers in args.workers:
+            for engine in server.ENGINES:
+                (pop_rate, write_rate) = run(
+                    engine, args.port, n_workers, args.routes,
+                    args.response_size,
+                    args.write_latency, args.duration, directory
+                )
+                print("%8s %8d %12.0f %12.0f" % (
+                    engine, n_workers, pop_rate, write_rate
+                ))
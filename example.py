@@ -39,17 +39,8 @@ tnra.start_routers({
 # Stop the routing engine
 manager.stop_otp()
 
-# TNRA output files are not pure JSONs; instead, they have one JSON per row
-import json
-with open("routes.json", "r") as f:
-    while True:
-        line = f.readline()
-        if (len(line) == 0):
-            break
-        else:
-            print(
-                json.dumps(
-                    json.loads(line),
-                    indent = 4
-                )
-            )
+# TNRA output files are not pure JSONs; instead, they have one JSON per row,
+# which tnra.Reader reads lazily
+reader = tnra.Reader("routes.json")
+for record in reader.records(fields = ["attributes", "duration", "distance"]):
+    print(record)
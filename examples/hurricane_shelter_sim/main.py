@@ -2,17 +2,26 @@
 
 import json
 import hashlib
+import math
 import os
 import pymongo
 import random
-import sys
 
 import otpmanager
 import route_distances
 import tnra
+from tnra import matrix
+from tnra import scenarios as tnra_scenarios
 
 SHELTER_INFO_PATH = "shelters.json"
 DEFAULT_N_SCENARIOS = 200
+DEFAULT_THRESHOLDS = [600, 1200, 1800] # seconds
+
+def _finite(value):
+    """ Return a float, or None if it is NaN, for JSON output """
+
+    value = float(value)
+    return None if math.isnan(value) else value
 
 def load_blockgroups(city, statefp = None):
     """ Load block group GeoJSON objects from Mongo
@@ -138,19 +147,82 @@ class Simulation(object):
         print("Initializing TNRA client")
         self.tnra_client = tnra.Client()
 
+    def route(self, mode = "walk"):
+        """ Route every block group to every shelter
+
+        Routes do not depend on which shelters are open, so they are routed
+        once per mode and shared by every scenario; a mode that was already
+        routed is not routed again. Routes are written under a temporary name
+        that is only moved into place once every route has been written, so
+        that the routes of a run that did not finish are routed again rather
+        than evaluated as if they were complete.
+
+        Args:
+            mode: The mode of transportation to use
+
+        Returns:
+            The path of the routes
+        """
+
+        routes_path = os.path.realpath("routes_%s.json" % mode)
+        if (os.path.exists(routes_path)):
+            return routes_path
+
+        print("Enqueueing %d routes" % (
+            len(self.blockgroups) * len(self.shelters)
+        ))
+        self.tnra_client.enqueue_matrix(
+            [blockgroup["geometry"]["geometries"][0]["coordinates"]
+             for blockgroup in self.blockgroups],
+            [shelter["geometry"]["coordinates"] for shelter in self.shelters],
+            [{"blockgroup_geoid": blockgroup["properties"]["GEOID"]}
+             for blockgroup in self.blockgroups],
+            [{"shelter_objectid": shelter["properties"]["OBJECTID"]}
+             for shelter in self.shelters],
+            mode = mode
+        )
+        partial_path = routes_path + ".partial"
+        self.tnra_client.open_file(partial_path)
+
+        print("Initializing OpenTripPlanner")
+        self.manager.start()
+
+        print("Routing")
+        tnra.start_routers({
+            "router": route_distances.OTPDistances,
+            "kwargs": {
+                "entrypoint": "localhost:%d" % self.manager.port
+            },
+            "route_logging": False
+        })
+
+        self.manager.stop_otp()
+        if (not self.tnra_client.close_file()):
+            raise IOError("Could not finish writing %s" % partial_path)
+        os.replace(partial_path, routes_path)
+        return routes_path
+
     def run(self, items_per_sample, mode = "walk",
-            n_scenarios = DEFAULT_N_SCENARIOS):
+            n_scenarios = DEFAULT_N_SCENARIOS, population = None,
+            thresholds = DEFAULT_THRESHOLDS):
         """ Run a simulation
 
         One run includes running n scenarios where n is up to n_scenarios
         scenarios returned by the create_scenarios function. See the
-        documentation of create_scenarios for more information.
+        documentation of create_scenarios for more information. Every block
+        group is routed to every shelter once (see route), and every scenario
+        is then evaluated at once over the resulting travel time matrix with
+        tnra.scenarios.evaluate.
 
         Args:
             items_per_sample: The number of shelters to include in each
                 scenario
             mode: The mode of transportation to use
             n_scenarios: The maximum number of scenarios to run
+            population: A dict of block group GEOID -> population to weigh
+                block groups by, or None to weigh them equally
+            thresholds: Travel times in seconds to compute the share of the
+                population that can reach an open shelter within
         """
 
         print("Creating scenarios")
@@ -166,56 +238,65 @@ class Simulation(object):
             len(scenarios), len(self.blockgroups), len(self.shelters)
         ))
 
-        print("Enqueueing %d routes" % (
-            len(scenarios) * len(self.blockgroups) * len(self.shelters)
-        ))
-        i = 0
-        for scenario in scenarios:
-            for blockgroup in self.blockgroups:
-                blockgroup_coords = blockgroup["geometry"]["geometries"][0]["coordinates"]
-                for shelter in self.shelters:
-                    shelter_coords = shelter["geometry"]["coordinates"]
-
-                    self.tnra_client.enqueue(
-                        *tuple(blockgroup_coords + shelter_coords),
-                        mode = mode,
-                        attributes = {
-                            "blockgroup_geoid": blockgroup["properties"]["GEOID"],
-                            "shelter_objectid": shelter["properties"]["OBJECTID"]
-                        }
-                    )
-
-                    i += 1
-                    sys.stdout.write("\r%d" % i)
-                    sys.stdout.flush()
-
-        print("")
-        with open("out.json", "w") as f:
-            json.dump(scenarios, f, indent = 4)
-
-        print("Setting up output")
+        routes_path = self.route(mode)
+
+        # the travel times are exported once per mode and memory-mapped by
+        # every later run
+        matrix_directory = "matrix_%s" % mode
+        if (os.path.exists(os.path.join(matrix_directory,
+                                        matrix.ORIGINS_FILE))):
+            print("Opening travel times")
+            times = matrix.open_matrix(matrix_directory)
+        else:
+            print("Exporting travel times")
+            times = matrix.export_matrix(
+                routes_path, matrix_directory, "blockgroup_geoid",
+                "shelter_objectid",
+                [blockgroup["properties"]["GEOID"]
+                 for blockgroup in self.blockgroups],
+                [shelter["properties"]["OBJECTID"]
+                 for shelter in self.shelters]
+            )
+        masks = tnra_scenarios.scenario_masks(
+            [[shelter["properties"]["OBJECTID"] for shelter in scenario]
+             for scenario in scenarios],
+            times.destination_ids
+        )
+        weights = None
+        if (population is not None):
+            weights = [population.get(geoid, 0) for geoid in times.origin_ids]
+
+        print("Evaluating scenarios")
+        results = tnra_scenarios.evaluate(
+            times.duration, masks, weights, thresholds
+        )
+
         output_directory = ("%d_shelters" % items_per_sample)
         if (not os.path.isdir(output_directory)):
             os.makedirs(output_directory)
         with open("%s/scenarios_%s.json" % (output_directory, mode), "w") as f:
-            json.dump(scenarios, f, indent = 4)
-        self.tnra_client.open_file("%s/%s/routes_%s.json" % (
-            os.path.realpath("."), output_directory, mode
-        ))
-
-        print("Initializing OpenTripPlanner")
-        self.manager.start()
-
-        print("Running simulation")
-        tnra.start_routers({
-            "router": route_distances.OTPDistances,
-            "kwargs": {
-                "entrypoint": "localhost:%d" % self.manager.port
-            },
-            "route_logging": False
-        })
-
-        self.manager.stop_otp()
+            json.dump([
+                {
+                    "shelters": [
+                        shelter["properties"]["OBJECTID"]
+                        for shelter in scenario
+                    ],
+                    "mean_time": _finite(results["mean_time"][i]),
+                    "unreachable": results["unreachable"][i],
+                    "coverage": {
+                        str(threshold): results["coverage"][i, k]
+                        for (k, threshold) in enumerate(thresholds)
+                    },
+                    "nearest_shelter": {
+                        geoid: (
+                            times.destination_ids[results["nearest"][i, j]]
+                            if (results["nearest"][i, j] >= 0) else None
+                        )
+                        for (j, geoid) in enumerate(times.origin_ids)
+                    }
+                }
+                for (i, scenario) in enumerate(scenarios)
+            ], f, indent = 4)
 
 def main(shelter_info_path = SHELTER_INFO_PATH, city = "Boston"):
     sim = Simulation(shelter_info_path, city)
@@ -10,9 +10,17 @@ setuptools.setup(
                   "the UIRLab at Northeastern University",
     packages = ["tnra"],
     install_requires = ["route_distances", "otpmanager", "pyzmq"],
+    extras_require = {
+        "numpy": ["numpy"]
+    },
     entry_points = {
         "console_scripts": [
-            "tnra_server = tnra.server:start_server"
+            "tnra_server = tnra.server:start_server",
+            "tnra_top = tnra.top:start_top",
+            "tnra_worker = tnra.worker_node:start_worker",
+            "tnra_merge_logs = tnra.routelog:start_merge",
+            "tnra_profile = tnra.profiler:start_profile",
+            "tnra_export_matrix = tnra.matrix:start_export"
         ]
     }
 )
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# helpers shared by the tests
+
+import socket
+
+from tnra import server
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def start_server(**kwargs):
+    """ Start a server on free ports, returning it with a Client; the result
+    port of the server is kept as its result_port attribute """
+
+    port = free_port()
+    result_port = free_port()
+    s = server.Server(port = port, result_port = result_port, **kwargs)
+    s.result_port = result_port
+    s.start()
+    return (s, server.Client(port = port))
+
+def stop_server(s, client):
+    client.exit()
+    s.join()
+    client.close()
+
+def close_router(worker):
+    """ Close the connections of a tnra.router.Router to its server """
+
+    worker.client.close()
+    worker.sink.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+from tnra import balancer
+
+class EndpointPoolTest(unittest.TestCase):
+
+    def pool(self, **kwargs):
+        kwargs.setdefault("probe", None)
+        return balancer.EndpointPool(
+            ["engine0", "engine1", "engine2"], verbose = False, **kwargs
+        )
+
+    def healthy(self, pool):
+        return [status["healthy"] for status in pool.status()]
+
+    def test_least_outstanding(self):
+        pool = self.pool()
+        self.assertEqual([pool.acquire() for i in range(3)], [0, 1, 2])
+        pool.release(1, 0.1)
+        self.assertEqual(pool.acquire(), 1)
+        # ties go to the engine with the lowest latency
+        pool.release(0, 0.2)
+        pool.release(2, 0.1)
+        self.assertEqual(pool.acquire(), 2)
+
+    def test_errors_eject(self):
+        pool = self.pool(max_errors = 2)
+        for i in range(2):
+            self.assertEqual(pool.acquire(), 0)
+            pool.release(0, error = True)
+        self.assertEqual(self.healthy(pool), [False, True, True])
+        self.assertNotIn(0, [pool.acquire() for i in range(4)])
+
+    def test_slow_engine_is_ejected(self):
+        pool = self.pool(min_samples = 2, slow_factor = 2)
+        for i in range(2):
+            for (engine, seconds) in [(0, 0.1), (1, 0.1), (2, 1.0)]:
+                pool.acquire()
+                pool.release(engine, seconds)
+        self.assertEqual(self.healthy(pool), [True, True, False])
+
+    def test_probe_readmits(self):
+        ready = {"engine0": True, "engine1": False, "engine2": True}
+        pool = self.pool(max_errors = 1, eject_seconds = 30,
+                         probe = lambda endpoint: ready[endpoint])
+        pool.release(pool.acquire(), error = True)
+        now = time.time()
+        pool.check(now)
+        self.assertEqual(self.healthy(pool), [False, False, True])
+
+        # ejected engines are only probed once eject_seconds have passed
+        self.assertEqual(pool.check(now + 10), 0)
+        ready["engine1"] = True
+        self.assertEqual(pool.check(now + 31), 2)
+        self.assertEqual(self.healthy(pool), [True, True, True])
+
+    def test_readmitted_without_probe(self):
+        pool = self.pool(max_errors = 1, eject_seconds = 0.2)
+        for i in range(3):
+            pool.release(pool.acquire(), error = True)
+        self.assertEqual(self.healthy(pool), [False, False, False])
+        start_time = time.time()
+        pool.acquire()
+        self.assertGreaterEqual(time.time() - start_time, 0.1)
+        self.assertEqual(self.healthy(pool), [True, True, True])
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tnra import blockfile
+
+def records(start, stop):
+    return [b"{\"i\": %d}" % i for i in range(start, stop)]
+
+class BlockFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "routes.blocks")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_seek_by_index(self):
+        block_writer = blockfile.BlockWriter(self.path, block_records = 10)
+        block_writer.write_lines(records(0, 95))
+        block_writer.close()
+        self.assertTrue(blockfile.is_block_file(self.path))
+
+        reader = blockfile.BlockReader(self.path)
+        self.assertEqual(len(reader), 95)
+        self.assertEqual(len(reader.index), 10)
+        self.assertEqual(reader.index[-1][2], 5)
+        for n in (0, 9, 10, 57, 94):
+            self.assertEqual(reader.record(n), b"{\"i\": %d}" % n)
+        with self.assertRaises(IndexError):
+            reader.record(95)
+        self.assertEqual(reader.read_block(3), records(30, 40))
+        self.assertEqual(list(reader), records(0, 95))
+        self.assertEqual(
+            [line for block in reader.blocks(processes = 2)
+             for line in block],
+            records(0, 95)
+        )
+
+    def test_blocks_are_split_by_size(self):
+        block_writer = blockfile.BlockWriter(self.path, block_bytes = 100)
+        block_writer.write_lines(records(0, 50))
+        block_writer.close()
+        reader = blockfile.BlockReader(self.path)
+        self.assertGreater(len(reader.index), 1)
+        self.assertEqual(list(reader), records(0, 50))
+
+    def test_append(self):
+        block_writer = blockfile.BlockWriter(self.path, block_records = 10)
+        block_writer.write_lines(records(0, 15))
+        block_writer.close()
+        block_writer = blockfile.BlockWriter(self.path, mode = "a",
+                                             block_records = 10)
+        block_writer.write_lines(records(15, 30))
+        block_writer.close()
+
+        reader = blockfile.BlockReader(self.path)
+        self.assertEqual([entry[2] for entry in reader.index], [10, 5, 10, 5])
+        self.assertEqual(list(reader), records(0, 30))
+
+    def test_file_without_index(self):
+        block_writer = blockfile.BlockWriter(self.path, block_records = 10)
+        block_writer.write_lines(records(0, 25))
+        block_writer.flush()
+        size = os.path.getsize(self.path)
+        block_writer.close()
+        # a crash in the middle of writing the third block, before the index
+        # was written
+        os.truncate(self.path, size + blockfile.BLOCK_HEADER.size + 3)
+
+        reader = blockfile.BlockReader(self.path)
+        self.assertEqual(len(reader), 20)
+        self.assertEqual(reader.record(15), b"{\"i\": 15}")
+
+        # appending rewrites the index after the complete blocks
+        block_writer = blockfile.BlockWriter(self.path, mode = "a",
+                                             block_records = 10)
+        block_writer.write_lines(records(20, 25))
+        block_writer.close()
+        self.assertEqual(list(blockfile.BlockReader(self.path)),
+                         records(0, 25))
+
+    def test_not_a_block_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"{\"i\": 0}\n")
+        self.assertFalse(blockfile.is_block_file(self.path))
+        with self.assertRaises(ValueError):
+            blockfile.BlockReader(self.path)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from tnra import cache
+
+ROUTE = (
+    -71.08, 42.33, -71.11, 42.37, "walk", datetime.datetime(2018, 1, 3, 11)
+)
+
+class RouteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "route_cache.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_are_cached(self):
+        route_cache = cache.RouteCache(self.path, "boston")
+        self.assertEqual(route_cache.get(*ROUTE), (False, None))
+        route_cache.put(*ROUTE, {"duration": 60})
+        route_cache.close()
+
+        route_cache = cache.RouteCache(self.path, "boston")
+        self.assertEqual(route_cache.get(*ROUTE), (True, {"duration": 60}))
+        self.assertEqual(
+            cache.RouteCache(self.path, "cambridge").get(*ROUTE), (False, None)
+        )
+
+    def test_no_route_is_not_cached(self):
+        route_cache = cache.RouteCache(self.path)
+        route_cache.put(*ROUTE, None)
+        self.assertEqual(route_cache.get(*ROUTE), (False, None))
+
+    def test_no_route_expires(self):
+        route_cache = cache.RouteCache(self.path, no_route_ttl = 0.5)
+        route_cache.put(*ROUTE, None)
+        self.assertEqual(route_cache.get(*ROUTE), (True, None))
+        time.sleep(0.6)
+        self.assertEqual(route_cache.get(*ROUTE), (False, None))
+
+        # a route found later replaces the route that was not found
+        route_cache.put(*ROUTE, None)
+        route_cache.put(*ROUTE, {"duration": 60})
+        self.assertEqual(route_cache.get(*ROUTE), (True, {"duration": 60}))
+
+    def test_access_times_are_batched(self):
+        routes = [ROUTE[:4] + (mode, ) + ROUTE[5:]
+                  for mode in ("walk", "bike", "car")]
+        route_cache = cache.RouteCache(self.path, max_entries = 2)
+        for route in routes[:2]:
+            route_cache.put(*route, {"duration": 60})
+            time.sleep(0.01)
+
+        def accessed():
+            connection = sqlite3.connect(self.path)
+            try:
+                return connection.execute(
+                    "SELECT accessed FROM routes ORDER BY accessed"
+                ).fetchall()
+            finally:
+                connection.close()
+
+        before = accessed()
+        self.assertTrue(route_cache.get(*routes[0])[0])
+        # the hit is not written until the next put
+        self.assertEqual(accessed(), before)
+
+        # which keeps the route that was hit over the one that was not
+        route_cache.put(*routes[2], {"duration": 60})
+        route_cache.evict()
+        self.assertTrue(route_cache.get(*routes[0])[0])
+        self.assertFalse(route_cache.get(*routes[1])[0])
+        route_cache.close()
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tnra import journal, server
+
+from tests.helpers import free_port
+
+class RecoveryTest(unittest.TestCase):
+
+    """ Servers that are killed, without a final snapshot, and recovered from
+    their journal directory """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def start(self, **kwargs):
+        return server.Server(
+            port = free_port(), result_port = free_port(),
+            journal_dir = self.directory, **kwargs
+        )
+
+    def kill(self, s):
+        """ Stop a server the way a crash would, dropping anything that was
+        not committed to its journal """
+
+        s.journal._file.close()
+        s._socket.close()
+        s._results_socket.close()
+        s._context.term()
+
+    def command(self, s, cmd, body = None):
+        response = s.dispatch({"cmd": server.COMMANDS[cmd], "body": body})
+        self.assertEqual(response["rsp"], server.RESPONSES["ok"])
+        return response.get("body")
+
+    def enqueue(self, s, n, start = 0):
+        for i in range(start, start + n):
+            self.command(s, "enqueue", ((i, 0, i + 1, 1), {"mode": "walk"}))
+
+    def journal_path(self, s):
+        return os.path.join(
+            self.directory, "%s%d" % (journal.JOURNAL_PREFIX,
+                                      s.journal.generation)
+        )
+
+    def test_snapshot_and_journal_tail(self):
+        s = self.start(lease_timeout = 60)
+        self.enqueue(s, 3)
+        with s._lock:
+            s._snapshot()
+        self.enqueue(s, 2, start = 3)
+        popped = self.command(s, "queue_pop_many", {"n": 2})
+        self.kill(s)
+
+        s = self.start(lease_timeout = 60)
+        try:
+            self.assertEqual(s.journal.generation, 1)
+            self.assertEqual(self.command(s, "queue_size"), 3)
+            self.assertEqual(self.command(s, "lease_stats")["leases"], 2)
+            self.assertEqual(
+                set(s._leases),
+                set(kwargs["job_id"] for (args, kwargs) in popped)
+            )
+            # job IDs are not reused after a restart
+            self.enqueue(s, 1, start = 5)
+            job_ids = [
+                kwargs["job_id"]
+                for (args, kwargs) in self.command(s, "queue_pop_many",
+                                                   {"n": 10})
+            ]
+            self.assertEqual(len(job_ids), 4)
+            self.assertEqual(len(set(job_ids) | set(s._leases)), 6)
+        finally:
+            self.kill(s)
+
+    def test_torn_final_record(self):
+        s = self.start()
+        self.enqueue(s, 2)
+        path = self.journal_path(s)
+        self.kill(s)
+        # a crash in the middle of writing the second record
+        os.truncate(path, os.path.getsize(path) - 3)
+
+        s = self.start()
+        self.assertEqual(self.command(s, "queue_size"), 1)
+        # the torn record is dropped, so that later records can be read
+        self.enqueue(s, 1, start = 2)
+        self.kill(s)
+
+        s = self.start()
+        try:
+            # the default queue is LIFO
+            routes = self.command(s, "queue_pop_many", {"n": 10})
+            self.assertEqual(
+                [args for (args, kwargs) in routes],
+                [(2, 0, 3, 1), (0, 0, 1, 1)]
+            )
+        finally:
+            self.kill(s)
+
+    def test_journal_left_by_snapshot_is_removed(self):
+        s = self.start()
+        self.enqueue(s, 2)
+        old_journal = self.journal_path(s)
+        with open(old_journal, "rb") as f:
+            records = f.read()
+        with s._lock:
+            s._snapshot()
+        self.kill(s)
+        # a crash between the rename of the snapshot and the removal of the
+        # journal before it
+        with open(old_journal, "wb") as f:
+            f.write(records)
+
+        s = self.start()
+        try:
+            self.assertFalse(os.path.exists(old_journal))
+            self.assertEqual(
+                sorted(os.listdir(self.directory)),
+                [os.path.basename(self.journal_path(s)),
+                 journal.SNAPSHOT_NAME]
+            )
+            # the journal was not replayed on top of the snapshot
+            self.assertEqual(self.command(s, "queue_size"), 2)
+        finally:
+            self.kill(s)
+
+    def expire(self, s, job_id):
+        """ Expire the lease of a job, as if its worker had died """
+
+        (deadline, item) = s._leases.pop(job_id)
+        s._leases[job_id] = (0, item)
+        s._leases.move_to_end(job_id, last = False)
+        self.assertIsNone(s.dispatch({"cmd": server.COMMANDS["queue_pop"]})
+                          .get("body"))
+
+    def test_leases_and_dead_letters_survive_restart(self):
+        for snapshot in (False, True):
+            with self.subTest(snapshot = snapshot):
+                s = self.start(lease_timeout = 60, max_deliveries = 1)
+                self.enqueue(s, 2)
+                popped = self.command(s, "queue_pop_many", {"n": 2})
+                (dead_id, leased_id) = [
+                    kwargs["job_id"] for (args, kwargs) in popped
+                ]
+                self.expire(s, dead_id)
+                if (snapshot):
+                    with s._lock:
+                        s._snapshot()
+                self.kill(s)
+
+                s = self.start(lease_timeout = 60, max_deliveries = 1)
+                try:
+                    stats = self.command(s, "lease_stats")
+                    self.assertEqual(stats["leases"], 1)
+                    self.assertEqual(stats["dead_letters"], 1)
+                    self.assertEqual(list(s._leases), [leased_id])
+                    self.assertEqual(
+                        [kwargs["job_id"] for (args, kwargs)
+                         in self.command(s, "dead_letters", {"n": 10})],
+                        [dead_id]
+                    )
+                    self.assertEqual(
+                        self.command(s, "requeue_dead_letters"), 1
+                    )
+                    self.assertEqual(self.command(s, "queue_size"), 1)
+                finally:
+                    self.kill(s)
+                shutil.rmtree(self.directory)
+                os.mkdir(self.directory)
+
+    def test_restart_without_leases(self):
+        s = self.start(lease_timeout = 60, max_deliveries = 1)
+        self.enqueue(s, 2)
+        popped = self.command(s, "queue_pop_many", {"n": 2})
+        self.expire(s, popped[0][1]["job_id"])
+        self.kill(s)
+
+        s = self.start(lease_timeout = None)
+        try:
+            stats = self.command(s, "lease_stats")
+            self.assertEqual((stats["leases"], stats["dead_letters"]), (0, 0))
+            self.enqueue(s, 1, start = 2)
+            self.assertEqual(
+                len(self.command(s, "queue_pop_many", {"n": 10})), 1
+            )
+        finally:
+            self.kill(s)
+
+    def test_matrix_survives_restart(self):
+        body = {"origins": [(i, 0) for i in range(10)],
+                "destinations": [(0, j) for j in range(10)],
+                "kwargs": {"mode": "walk"}}
+        for snapshot in (False, True):
+            with self.subTest(snapshot = snapshot):
+                s = self.start()
+                self.command(s, "enqueue_matrix", body)
+                popped = self.command(s, "queue_pop_many", {"n": 15})
+                if (snapshot):
+                    with s._lock:
+                        s._snapshot()
+                popped += self.command(s, "queue_pop_many", {"n": 10})
+                self.kill(s)
+
+                s = self.start()
+                try:
+                    self.assertEqual(self.command(s, "queue_size"), 75)
+                    # the matrix is expanded where it left off
+                    popped += self.command(s, "queue_pop_many", {"n": 100})
+                    self.assertEqual(
+                        sorted(args for (args, kwargs) in popped),
+                        sorted((i, 0, 0, j) for i in range(10)
+                               for j in range(10))
+                    )
+                finally:
+                    self.kill(s)
+                shutil.rmtree(self.directory)
+                os.mkdir(self.directory)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+    from tnra import matrix
+except ImportError:
+    numpy = None
+
+def record(origin, destination, duration, distance = None, **attributes):
+    attributes.update({"o": origin, "d": destination})
+    return {"attributes": attributes, "duration": duration,
+            "distance": distance, "response": {}}
+
+@unittest.skipUnless(numpy, "needs NumPy")
+class ODMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "routes.json")
+        records = [
+            record("a", "x", 60, 100),
+            record("a", "y", 120, 200),
+            record("b", "y", 90, 150, city = "cambridge"),
+            # no route, then a route, then no route again
+            record("b", "x", None),
+            record("b", "x", 30, 50),
+            record("b", "x", None),
+            # a job routed with several modes is left out
+            record("c", "x", [[10], [20]], [[1], [2]]),
+            {"attributes": "not a dict", "duration": 1, "distance": 1}
+        ]
+        with open(self.path, "w") as f:
+            for route in records:
+                f.write(json.dumps(route) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertMatrix(self, od_matrix, duration, distance):
+        numpy.testing.assert_array_equal(od_matrix.duration, duration)
+        numpy.testing.assert_array_equal(od_matrix.distance, distance)
+        numpy.testing.assert_array_equal(
+            od_matrix.missing, numpy.isnan(numpy.array(duration))
+        )
+
+    def test_load_matrix(self):
+        od_matrix = matrix.load_matrix(self.path, "o", "d")
+        self.assertEqual(od_matrix.origin_ids, ["a", "b", "c"])
+        self.assertEqual(od_matrix.destination_ids, ["x", "y"])
+        self.assertEqual(od_matrix.shape, (3, 2))
+        nan = numpy.nan
+        self.assertMatrix(od_matrix, [[60, 120], [30, 90], [nan, nan]],
+                          [[100, 200], [50, 150], [nan, nan]])
+
+        od_matrix = matrix.load_matrix(
+            self.path, "o", "d", origin_ids = ["b"],
+            destination_ids = ["y", "x"], where = {"city": "cambridge"}
+        )
+        self.assertMatrix(od_matrix, [[90, nan]], [[150, nan]])
+
+    def test_export_and_open(self):
+        directory = os.path.join(self.directory, "matrix")
+        exported = matrix.export_matrix(self.path, directory, "o", "d",
+                                        dtype = "float32")
+        self.assertEqual(exported.duration.dtype, numpy.float32)
+
+        opened = matrix.open_matrix(directory)
+        loaded = matrix.load_matrix(self.path, "o", "d")
+        self.assertIsInstance(opened.duration, numpy.memmap)
+        self.assertEqual(
+            (opened.origin_ids, opened.destination_ids),
+            (loaded.origin_ids, loaded.destination_ids)
+        )
+        self.assertMatrix(opened, loaded.duration, loaded.distance)
+        numpy.testing.assert_array_equal(opened.found, ~loaded.missing)
+        self.assertEqual(opened.origin_index(), {"a": 0, "b": 1, "c": 2})
+        self.assertEqual(opened.destination_index(), {"x": 0, "y": 1})
+
+        # a matrix whose export did not finish does not open
+        os.remove(os.path.join(directory, matrix.DESTINATIONS_FILE))
+        with self.assertRaises(FileNotFoundError):
+            matrix.open_matrix(directory)
+
+if (__name__ == "__main__"):
+    unittest.main()
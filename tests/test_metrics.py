@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+from tnra import metrics, server, top
+
+from tests.helpers import start_server, stop_server
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets_are_precise(self):
+        for seconds in (0, 0.0001, 0.0031, 0.0033, 0.05, 1.7, 42.0, 3600.0):
+            value = metrics.bucket_value(metrics.bucket_index(seconds))
+            self.assertLessEqual(
+                abs(value - seconds),
+                max(0.035 * seconds, metrics.HISTOGRAM_UNIT)
+            )
+
+    def test_percentiles(self):
+        histogram = metrics.Histogram()
+        self.assertEqual(histogram.summary(), {
+            "mean": None, "p50": None, "p90": None, "p99": None, "max": None
+        })
+        for i in range(1, 101):
+            histogram.record(i / 100)
+        summary = histogram.summary()
+        self.assertAlmostEqual(summary["mean"], 0.505)
+        self.assertAlmostEqual(summary["p50"], 0.5, delta = 0.02)
+        self.assertAlmostEqual(summary["p90"], 0.9, delta = 0.03)
+        self.assertAlmostEqual(summary["p99"], 0.99, delta = 0.03)
+        self.assertEqual(summary["max"], 1.0)
+
+        # histograms are sent as dicts, and merged
+        other = metrics.Histogram.from_dict(histogram.to_dict())
+        self.assertEqual(other.count, 100)
+        other.record(2.0)
+        histogram.merge(other)
+        self.assertEqual((histogram.count, histogram.max), (201, 2.0))
+
+class MetricsTest(unittest.TestCase):
+
+    def test_take_and_aggregate(self):
+        worker_metrics = metrics.Metrics()
+        self.assertIsNone(worker_metrics.take())
+        worker_metrics.record("walk", 0.1)
+        worker_metrics.record("walk", 0.3, success = False)
+        worker_metrics.record("walk", None, cached = True)
+        worker_metrics.record("bike", 0.2)
+        report = worker_metrics.take()
+        self.assertEqual(
+            {mode: data["routes"] for (mode, data) in report.items()},
+            {"walk": 3, "bike": 1}
+        )
+        # counts are reset once taken
+        self.assertIsNone(worker_metrics.take())
+
+        aggregator = metrics.StatsAggregator(rate_window = 10)
+        start = aggregator._start_time
+        aggregator.report("a", report, now = start + 5)
+        aggregator.report("b", {"bike": report["bike"]}, now = start + 10)
+        summary = aggregator.summary(now = start + 10)
+        self.assertEqual(summary["workers"], 2)
+        walk = summary["modes"]["walk"]
+        self.assertEqual(
+            (walk["routes"], walk["failures"], walk["cache_hits"]), (3, 1, 1)
+        )
+        self.assertAlmostEqual(walk["failure_rate"], 1 / 3)
+        self.assertAlmostEqual(walk["latency"]["mean"], 0.2, delta = 0.01)
+        self.assertEqual(summary["total"]["routes"], 5)
+        self.assertAlmostEqual(summary["total"]["routes_per_second"], 0.5)
+
+        # reports older than the rate window stop counting towards rates
+        summary = aggregator.summary(now = start + 16)
+        self.assertEqual(summary["workers"], 1)
+        self.assertEqual(summary["modes"]["walk"]["routes_per_second"], 0)
+        self.assertEqual(summary["total"]["routes"], 5)
+
+    def test_server_stats(self):
+        (s, client) = start_server()
+        sink = server.ResultSink(port = s.result_port)
+        try:
+            worker_metrics = metrics.Metrics()
+            worker_metrics.record("walk", 0.1)
+            sink.report_stats(worker_metrics.take(), worker = "a")
+            deadline = time.time() + 10
+            stats = client.stats()
+            while (stats["workers"] == 0):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+                stats = client.stats()
+            self.assertEqual(stats["modes"]["walk"]["routes"], 1)
+            self.assertEqual(
+                (stats["queue_size"], stats["leases"], stats["lines_written"]),
+                (0, 0, 0)
+            )
+        finally:
+            sink.close()
+            stop_server(s, client)
+
+class TopTest(unittest.TestCase):
+
+    def test_trend(self):
+        trend = top.QueueTrend(window = 10)
+        trend.add(0, 100)
+        self.assertIsNone(trend.rate())
+        trend.add(5, 80)
+        self.assertEqual((trend.rate(), trend.eta()), (4, 20))
+        # sizes older than the window are dropped, but for the last one
+        trend.add(20, 80)
+        trend.add(25, 60)
+        self.assertEqual(trend.rate(), 1)
+        trend.add(40, 90)
+        self.assertEqual(trend.rate(), -2)
+        self.assertIsNone(trend.eta())
+
+    def test_render(self):
+        aggregator = metrics.StatsAggregator()
+        worker_metrics = metrics.Metrics()
+        worker_metrics.record("walk", 0.1)
+        worker_metrics.record("bike", 0.2, success = False)
+        aggregator.report("a", worker_metrics.take())
+        stats = aggregator.summary()
+        stats.update({"queue_size": 10, "leases": 2, "dead_letters": 0,
+                      "lines_written": 1, "time": time.time()})
+        trend = top.QueueTrend()
+        trend.add(0, 20)
+        trend.add(10, 12)
+
+        lines = top.render(stats, trend, "localhost", 7000).split("\n")
+        self.assertIn("queue: 10   leases: 2", lines[1])
+        self.assertIn("ETA: 0:00:15", lines[2])
+        self.assertEqual(
+            [line.split()[0] for line in lines[5:]], ["bike", "walk", "total"]
+        )
+
+if (__name__ == "__main__"):
+    unittest.main()
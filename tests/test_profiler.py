@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tnra import profiler
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = profiler.Profiler(
+            os.path.join(self.directory, "profile.json"), sample_rate = 1,
+            dump_interval = 0, worker = "test"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def route(self, n):
+        for i in range(n):
+            with self.profiler.stage("job"):
+                with self.profiler.stage("routing_engine"):
+                    pass
+
+    def count(self, stage):
+        return sum(count for (i, count) in stage["latency"]["counts"])
+
+    def test_nested_stages(self):
+        self.route(3)
+        self.profiler.close()
+        with open(self.profiler.path, "r") as f:
+            stages = json.load(f)["stages"]
+        self.assertEqual(sorted(stages), ["job", "job;routing_engine"])
+        self.assertEqual(self.count(stages["job"]), 3)
+
+    def test_threads_dump_concurrently(self):
+        errors = []
+
+        def route():
+            try:
+                self.route(200)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target = route) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.profiler.close()
+        with open(self.profiler.path, "r") as f:
+            stages = json.load(f)["stages"]
+        self.assertEqual(self.count(stages["job"]), 1600)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import random
+import unittest
+
+from tnra import queues
+
+def route(i):
+    """ Return a route whose keyword arguments vary with i """
+
+    kwargs = {"job_id": i, "mode": ("walk", "bike")[i % 2], "hour": i % 24}
+    if (i % 3 == 0):
+        kwargs["attributes"] = {"origin": "g%d" % i, "destination": i * 7}
+    elif (i % 3 == 1):
+        kwargs["attributes"] = "block %d" % i
+    return ((i * 0.5, 42.0, i * 0.25 - 71.0, 42.5), kwargs)
+
+class ColumnarQueueTest(unittest.TestCase):
+
+    def test_pop_from_both_ends(self):
+        queue = queues.ColumnarQueue()
+        # past the sample size, so that later routes are compressed
+        n = queues.DICTIONARY_SAMPLE_SIZE + 500
+        queue.extend(route(i) for i in range(n))
+        self.assertEqual(len(queue), n)
+        self.assertTrue(any(queue._flags))
+        self.assertEqual(list(queue), [route(i) for i in range(n)])
+
+        self.assertEqual(queue.pop(), route(n - 1))
+        self.assertEqual(queue.pop_many(2), [route(n - 2), route(n - 3)])
+        self.assertEqual(queue.popleft_many(2), [route(0), route(1)])
+        self.assertEqual(list(queue), [route(i) for i in range(2, n - 3)])
+        self.assertEqual((queue.first_job_id(), queue.last_job_id()),
+                         (2, n - 4))
+
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        with self.assertRaises(IndexError):
+            queue.pop()
+        with self.assertRaises(ValueError):
+            queue.append(((0, 0, 1), {}))
+
+    def test_dump_and_load(self):
+        n = queues.DICTIONARY_SAMPLE_SIZE + 500
+        queue = queues.ColumnarQueue()
+        queue.extend(route(i) for i in range(n))
+        queue.popleft_many(10)
+        queue.append(((0, 0, 1, 1), {}))
+        f = io.BytesIO()
+        queue.dump(f)
+
+        f.seek(0)
+        loaded = queues.ColumnarQueue.load(f)
+        expected = [route(i) for i in range(10, n)] + [((0, 0, 1, 1), {})]
+        self.assertEqual(list(loaded), expected)
+        # the loaded queue compresses new routes with the same dictionary
+        loaded.append(route(n))
+        self.assertEqual(loaded._flags[-1], 1)
+        self.assertEqual(loaded.pop(), route(n))
+        self.assertEqual(loaded.popleft_many(1), [route(10)])
+
+        with self.assertRaises(ValueError):
+            queues.ColumnarQueue.load(io.BytesIO(b"TNRAQST1"))
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            queues.ColumnarQueue.load(io.BytesIO(f.read()[:-1]))
+
+def job(job_id, mode = "walk", **kwargs):
+    return ((job_id, 0, job_id + 1, 1),
+            dict(kwargs, job_id = job_id, mode = mode))
+
+def job_ids(items):
+    return [kwargs["job_id"] for (args, kwargs) in items]
+
+class QueueSetTest(unittest.TestCase):
+
+    def test_orderings(self):
+        # the order holds across the routes of different modes
+        jobs = [job(0, "walk"), job(1, "bike"), job(2, "walk"),
+                job(3, "bike", priority = 2), job(4, "walk", priority = 2),
+                job(5, "walk", priority = 1)]
+        expected = {
+            "lifo": [5, 4, 3, 2, 1, 0],
+            "fifo": [0, 1, 2, 3, 4, 5],
+            "priority": [3, 4, 5, 0, 1, 2]
+        }
+        for ordering in queues.ORDERINGS:
+            with self.subTest(ordering = ordering):
+                queue = queues.JobQueue("jobs", ordering)
+                for item in jobs:
+                    queue.append(item)
+                self.assertEqual(
+                    job_ids(queue.pop_many(2)), expected[ordering][:2]
+                )
+                self.assertEqual(
+                    job_ids(queue.pop_many(10)), expected[ordering][2:]
+                )
+                self.assertEqual(len(queue), 0)
+
+    def test_queue_priorities_and_modes(self):
+        queue_set = queues.QueueSet()
+        queue_set.create("urgent", "fifo", priority = 1)
+        queue_set.extend([job(0), job(1, queue = "urgent"), job(2),
+                          job(3, "bike", queue = "urgent"), job(4, "bike")])
+        self.assertEqual(queue_set.names(), ["default", "urgent"])
+
+        self.assertEqual(job_ids(queue_set.pop_many(1, modes = ["bike"])), [3])
+        self.assertEqual(
+            job_ids(queue_set.pop_many(10, names = ["default"],
+                                       modes = ["walk"])),
+            [2, 0]
+        )
+        self.assertEqual(job_ids(queue_set.pop_many(10)), [1, 4])
+
+        # routes for a queue that does not exist create it
+        queue_set.append(job(5, queue = "new"))
+        self.assertEqual(queue_set["new"].ordering, queues.DEFAULT_ORDERING)
+        with self.assertRaises(ValueError):
+            queue_set.create("new", "fifo")
+        queue_set.drop("new")
+        self.assertNotIn("new", queue_set)
+        self.assertEqual(len(queue_set), 0)
+
+    def test_dump_and_load(self):
+        queue_set = queues.QueueSet()
+        queue_set.create("fifo", "fifo", priority = 2)
+        queue_set.create("priority", "priority", priority = 1)
+        queue_set.extend([
+            job(0), job(1, "bike"),
+            job(2, queue = "fifo"), job(3, "bike", queue = "fifo"),
+            job(4, queue = "priority", priority = 1),
+            job(5, "bike", queue = "priority", priority = 3),
+            job(6, queue = "priority", priority = 3)
+        ])
+        f = io.BytesIO()
+        queue_set.dump(f)
+        f.seek(0)
+        loaded = queues.QueueSet.load(f)
+
+        self.assertEqual(loaded.names(), ["default", "fifo", "priority"])
+        self.assertEqual(
+            [(loaded[name].ordering, loaded[name].priority)
+             for name in loaded.names()],
+            [("lifo", 0), ("fifo", 2), ("priority", 1)]
+        )
+        self.assertEqual(job_ids(loaded.pop_many(10)), [2, 3, 5, 6, 4, 1, 0])
+
+        with self.assertRaises(ValueError):
+            queues.QueueSet.load(io.BytesIO(b"TNRAQUE1"))
+
+class MatrixJobTest(unittest.TestCase):
+
+    def test_take(self):
+        matrix = queues.MatrixJob(
+            [(0, 0), (1, 1)], [(2, 2), (3, 3), (4, 4)], {"mode": "walk"},
+            destination_attributes = [{"name": "a"}, None, {"name": "c"}]
+        )
+        self.assertEqual((matrix.size(), len(matrix)), (6, 6))
+        self.assertEqual(matrix.take(2), [
+            ((0, 0, 2, 2), {"mode": "walk",
+                            "attributes": {"origin": 0, "name": "a"}}),
+            ((0, 0, 3, 3), {"mode": "walk",
+                            "attributes": {"origin": 0, "destination": 1}})
+        ])
+        self.assertEqual(len(matrix), 4)
+
+        # a job is rebuilt where it left off
+        loaded = queues.MatrixJob.from_dict(
+            json.loads(json.dumps(matrix.to_dict()))
+        )
+        self.assertEqual(loaded.take(10), matrix.take(10))
+        self.assertEqual(loaded.take(10), [])
+        self.assertEqual(len(loaded), 0)
+
+        with self.assertRaises(ValueError):
+            queues.MatrixJob([(0, 0)], [(1, 1, 2)])
+        with self.assertRaises(ValueError):
+            queues.MatrixJob([(0, 0)], [(1, 1)], origin_attributes = [])
+
+class KeyIndexTest(unittest.TestCase):
+
+    def test_matches_dict(self):
+        index = queues.KeyIndex()
+        expected = {}
+        keys = [random.getrandbits(64) or 1 for i in range(2000)]
+        for (job_id, key) in enumerate(keys):
+            index[key] = job_id
+            expected[key] = job_id
+        # removed entries do not hide the keys that were probed past them
+        for key in keys[::3]:
+            self.assertEqual(index.pop(key), expected.pop(key))
+        self.assertIsNone(index.pop(keys[0]))
+        # a removed key can be added again
+        index[keys[3]] = 5
+        expected[keys[3]] = 5
+
+        self.assertEqual(len(index), len(expected))
+        for key in keys:
+            self.assertEqual(index.get(key), expected.get(key))
+            self.assertEqual(key in index, key in expected)
+
+        index.clear()
+        self.assertEqual(len(index), 0)
+        self.assertNotIn(keys[1], index)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tnra import blockfile, reader
+
+def line(i):
+    return json.dumps({
+        "attributes": {"origin": i, "destination": "d%d" % (i % 3)},
+        "duration": i * 60,
+        "distance": i * 100,
+        "response": {"plan": [i] * 10}
+    }).encode("utf-8")
+
+def is_even(attributes):
+    return attributes["origin"] % 2 == 0
+
+class ReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "routes.json")
+        with open(self.path, "wb") as f:
+            for i in range(100):
+                f.write(line(i) + b"\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        routes = reader.Reader(self.path, chunk_bytes = 500)
+        self.assertGreater(len(routes.chunks()), 1)
+        self.assertEqual(len(routes), 100)
+        self.assertEqual(routes[42], json.loads(line(42).decode("utf-8")))
+        self.assertEqual(routes[99]["duration"], 99 * 60)
+        self.assertEqual(
+            [record["attributes"]["origin"] for record in routes],
+            list(range(100))
+        )
+
+    def test_projection(self):
+        # a response that is not valid JSON is never parsed
+        with open(self.path, "wb") as f:
+            f.write(line(0)[:-20] + b"not json}\n")
+        routes = reader.Reader(self.path)
+        self.assertEqual(
+            list(routes.records(fields = ["duration", "distance"])),
+            [{"duration": 0, "distance": 0}]
+        )
+        # fields that are missing are looked for until the end of the record
+        with self.assertRaises(ValueError):
+            list(routes.records(fields = ["duration", "mode"]))
+        with self.assertRaises(ValueError):
+            list(routes.records())
+
+    def test_prefilter(self):
+        for processes in (1, 2):
+            with self.subTest(processes = processes):
+                routes = reader.Reader(self.path, processes = processes,
+                                       chunk_bytes = 500)
+                self.assertEqual(
+                    [record["duration"] for record in routes.records(
+                        fields = ["duration"], where = {"destination": "d1"}
+                    )],
+                    [i * 60 for i in range(1, 100, 3)]
+                )
+                self.assertEqual(
+                    len(list(routes.records(where = is_even))), 50
+                )
+                # the value occurs in the line, but not in the attributes
+                self.assertEqual(
+                    list(routes.records(where = {"origin": 6000})), []
+                )
+
+    def test_block_file(self):
+        path = os.path.join(self.directory, "routes.blocks")
+        block_writer = blockfile.BlockWriter(path, block_records = 30)
+        block_writer.write_lines(line(i) for i in range(100))
+        block_writer.close()
+
+        routes = reader.Reader(path)
+        self.assertTrue(routes.is_block_file)
+        self.assertEqual(len(routes.chunks()), 4)
+        self.assertEqual(len(routes), 100)
+        self.assertEqual(routes[42]["distance"], 4200)
+        self.assertEqual(
+            [record["distance"] for record in routes.records(
+                fields = ["distance"], where = {"destination": "d2"}
+            )],
+            [i * 100 for i in range(2, 100, 3)]
+        )
+        with self.assertRaises(TypeError):
+            routes.offsets()
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from tnra import routelog
+
+class RouteLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "routing_logs.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, "r") as f:
+            return [json.loads(line) for line in f]
+
+    def test_worker_log_paths(self):
+        paths = [routelog.worker_log_path(self.path, worker)
+                 for worker in ("node1-2", "node1-1")]
+        self.assertEqual(
+            paths[0], os.path.join(self.directory, "routing_logs.node1-2.json")
+        )
+        self.assertIn(str(os.getpid()), routelog.worker_log_path(self.path))
+        for path in paths:
+            open(path, "w").close()
+        open(os.path.join(self.directory, "other.node1-3.json"), "w").close()
+        self.assertEqual(routelog.worker_log_paths(self.path), sorted(paths))
+
+    def test_records_are_buffered(self):
+        route_log = routelog.RouteLog(self.path, flush_bytes = 100,
+                                      flush_interval = 60)
+        route_log.write({"time": 0})
+        self.assertFalse(os.path.exists(self.path))
+        # flushed once flush_bytes are buffered
+        for i in range(1, 10):
+            route_log.write({"time": i})
+        self.assertGreater(len(self.read(self.path)), 0)
+        self.assertLess(len(self.read(self.path)), 10)
+        route_log.close()
+        self.assertEqual(self.read(self.path),
+                         [{"time": i} for i in range(10)])
+
+        # or once flush_interval has passed since the last flush
+        route_log = routelog.RouteLog(self.path, flush_interval = 0)
+        route_log.write({"time": 10})
+        self.assertEqual(len(self.read(self.path)), 11)
+
+    def test_merge(self):
+        times = [[0, 3, 4], [1, 2, 6], [5]]
+        paths = []
+        for (worker, worker_times) in enumerate(times):
+            path = routelog.worker_log_path(self.path, str(worker))
+            route_log = routelog.RouteLog(path)
+            for t in worker_times:
+                route_log.write({"time": t, "worker": worker})
+            route_log.close()
+            paths.append(path)
+
+        output = os.path.join(self.directory, "merged.json")
+        self.assertEqual(routelog.merge(paths, output), 7)
+        self.assertEqual([record["time"] for record in self.read(output)],
+                         list(range(7)))
+
+        argv = ["tnra_merge_logs", output, "--path", self.path, "--delete"]
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch("builtins.print"):
+            routelog.start_merge()
+        self.assertEqual(len(self.read(output)), 7)
+        self.assertEqual(os.listdir(self.directory), ["merged.json"])
+
+if (__name__ == "__main__"):
+    unittest.main()
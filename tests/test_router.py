@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from tnra import controller, router, synthetic
+
+from tests.helpers import close_router, start_server, stop_server
+
+class WaitForLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def route(self, **kwargs):
+        """ Route 5 jobs, 2 of which were taken by a worker that died, and
+        return the number of results that were written """
+
+        (s, client) = start_server(lease_timeout = 1)
+        try:
+            path = os.path.join(self.directory, "routes.json")
+            client.open_file(path)
+            for i in range(5):
+                client.enqueue(i, 0, i + 1, 1, mode = "walk")
+            self.assertEqual(len(client.queue_pop_many(2)), 2)
+
+            worker = router.Router(
+                synthetic.SyntheticDistances,
+                {"latency": 0, "response_size": 0}, route_logging = False,
+                server_port = client.port, server_result_port = s.result_port,
+                **kwargs
+            )
+            try:
+                worker.main()
+            finally:
+                close_router(worker)
+            client.close_file()
+        finally:
+            stop_server(s, client)
+        with open(path, "r") as f:
+            return len(f.readlines())
+
+    def test_expired_leases_are_routed(self):
+        for kwargs in [{}, {"prefetch": False}, {"concurrency": 4}]:
+            self.assertEqual(self.route(**kwargs), 5)
+
+    def test_without_waiting(self):
+        self.assertEqual(self.route(wait_for_leases = False), 3)
+
+class PrefetcherTest(unittest.TestCase):
+
+    def test_queue_pop_many(self):
+        (s, client) = start_server()
+        try:
+            self.assertIsNone(client.queue_pop_many(10))
+            for i in range(5):
+                client.enqueue(i, 0, i + 1, 1, mode = "walk")
+            self.assertEqual(len(client.queue_pop_many(3)), 3)
+            self.assertEqual(len(client.queue_pop_many(3)), 2)
+            self.assertIsNone(client.queue_pop_many(3))
+        finally:
+            stop_server(s, client)
+
+    def test_buffer_is_drained(self):
+        (s, client) = start_server()
+        try:
+            for i in range(25):
+                client.enqueue(i, 0, i + 1, 1, mode = "walk")
+            prefetcher = router.Prefetcher(
+                port = client.port, min_size = 4, max_size = 8,
+                wait_for_leases = False
+            )
+            prefetcher.start()
+            routes = []
+            while True:
+                item = prefetcher.get()
+                if (item is None):
+                    break
+                routes.append(item[0])
+                # the buffer is not refilled past its target size
+                self.assertLessEqual(len(prefetcher._buffer), 4)
+            prefetcher.join(10)
+            self.assertFalse(prefetcher.is_alive())
+            self.assertEqual(
+                sorted(routes), [(i, 0, i + 1, 1) for i in range(25)]
+            )
+            self.assertEqual(client.queue_size(), 0)
+        finally:
+            stop_server(s, client)
+
+    def test_size_follows_latency(self):
+        prefetcher = router.Prefetcher(
+            min_size = 10, max_size = 1000, target_seconds = 2,
+            concurrency = 4
+        )
+        self.assertEqual(prefetcher.size, 10)
+        prefetcher.record_latency(0.1)
+        self.assertEqual(prefetcher.size, 80)
+        # the moving average is smoothed, and the target size is bounded
+        for i in range(100):
+            prefetcher.record_latency(0.001)
+        self.assertEqual(prefetcher.size, 1000)
+        for i in range(100):
+            prefetcher.record_latency(60)
+        self.assertEqual(prefetcher.size, 10)
+
+class CountingDistances(synthetic.SyntheticDistances):
+
+    """ Synthetic router that counts its instances and the most routes that
+    were in flight at once across them """
+
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.instances = 0
+        cls.in_flight = 0
+        cls.max_in_flight = 0
+
+    def __init__(self, **kwargs):
+        synthetic.SyntheticDistances.__init__(self, **kwargs)
+        with self.lock:
+            CountingDistances.instances += 1
+
+    def distance(self, *args, **kwargs):
+        with self.lock:
+            CountingDistances.in_flight += 1
+            CountingDistances.max_in_flight = max(
+                CountingDistances.max_in_flight, CountingDistances.in_flight
+            )
+        try:
+            return synthetic.SyntheticDistances.distance(
+                self, *args, **kwargs
+            )
+        finally:
+            with self.lock:
+                CountingDistances.in_flight -= 1
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        CountingDistances.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def route(self, jobs, latency = 0, distances = CountingDistances,
+              **kwargs):
+        """ Route (args, kwargs) jobs with a Router, and return the records
+        that were written """
+
+        (s, client) = start_server()
+        try:
+            path = os.path.join(self.directory, "routes.json")
+            client.open_file(path)
+            for (args, job_kwargs) in jobs:
+                client.enqueue(*args, **job_kwargs)
+            worker = router.Router(
+                distances, {"latency": latency, "response_size": 0},
+                route_logging = False, server_port = client.port,
+                server_result_port = s.result_port, **kwargs
+            )
+            try:
+                worker.main()
+            finally:
+                close_router(worker)
+            client.close_file()
+        finally:
+            stop_server(s, client)
+        with open(path, "r") as f:
+            return [json.loads(line) for line in f]
+
+    def test_concurrent_routing(self):
+        jobs = [((i, 0, i + 1, 1), {"mode": "walk", "attributes": {"i": i}})
+                for i in range(40)]
+        for prefetch in (True, False):
+            with self.subTest(prefetch = prefetch):
+                CountingDistances.reset()
+                records = self.route(jobs, latency = 0.05, concurrency = 4,
+                                     prefetch = prefetch)
+                self.assertEqual(
+                    sorted(record["attributes"]["i"] for record in records),
+                    list(range(40))
+                )
+                self.assertEqual(CountingDistances.max_in_flight, 4)
+                # one router per thread, and one to check the arguments
+                self.assertEqual(CountingDistances.instances, 5)
+
+    def test_route_error_is_raised(self):
+        class FailingDistances(CountingDistances):
+            def distance(self, *args, **kwargs):
+                raise RuntimeError("engine is down")
+
+        (s, client) = start_server()
+        try:
+            for i in range(10):
+                client.enqueue(i, 0, i + 1, 1, mode = "walk")
+            worker = router.Router(
+                FailingDistances, {}, route_logging = False,
+                server_port = client.port, server_result_port = s.result_port,
+                concurrency = 4, wait_for_leases = False
+            )
+            try:
+                with self.assertRaises(RuntimeError):
+                    worker.main()
+            finally:
+                close_router(worker)
+            # the prefetcher stops refilling its buffer
+            for thread in threading.enumerate():
+                if (isinstance(thread, router.Prefetcher)):
+                    thread.join(10)
+                    self.assertFalse(thread.is_alive())
+        finally:
+            stop_server(s, client)
+
+    def test_modes_and_hours_fan_out(self):
+        class NoBikeDistances(CountingDistances):
+            def distance(self, origin_x, origin_y, dest_x, dest_y,
+                         mode = "walk", departure_time = None):
+                if (mode == "bike"):
+                    return None
+                return CountingDistances.distance(
+                    self, origin_x, origin_y, dest_x, dest_y, mode,
+                    departure_time
+                )
+
+        route = (-71.08, 42.33, -71.11, 42.37)
+        records = self.route([
+            (route, {"modes": ["walk", "bike"], "hours": [8, 17],
+                     "weekday": 6, "attributes": {"i": 0}}),
+            (route, {"modes": ["bike"], "attributes": {"i": 1}})
+        ], distances = NoBikeDistances)
+
+        # the job without any route is finished without a record
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["attributes"], {"i": 0})
+        self.assertEqual(
+            (record["modes"], record["weekday"], record["hours"]),
+            (["walk", "bike"], 6, [8, 17])
+        )
+        self.assertEqual(record["duration"][1], [None, None])
+        self.assertEqual(record["distance"][0][0], record["distance"][0][1])
+        self.assertGreater(record["duration"][0][0], 0)
+        self.assertNotIn("response", record)
+
+    def test_departure_datetime(self):
+        # a Thursday, before daylight saving time starts on March 11
+        today = datetime.date(2018, 3, 8)
+        self.assertEqual(router.departure_datetime(3, 11, today),
+                         datetime.datetime(2018, 3, 14, 11))
+        self.assertEqual(router.departure_datetime(4, 0, today),
+                         datetime.datetime(2018, 3, 8, 0))
+        self.assertEqual(router.departure_datetime(7, 23, today),
+                         datetime.datetime(2018, 3, 11, 23))
+
+def exit_after(seconds, code):
+    time.sleep(seconds)
+    sys.exit(code)
+
+class FinishWhenDrainedTest(unittest.TestCase):
+
+    def run_routers(self, active, routers):
+        """ Run processes that exit after the given (seconds, exit code)
+        until _finish_when_drained returns, returning them and the gate """
+
+        gate = controller.Gate(active)
+        processes = [
+            multiprocessing.Process(target = exit_after, args = router_args)
+            for router_args in routers
+        ]
+        for process in processes:
+            process.start()
+        try:
+            router._finish_when_drained(gate, processes)
+            return ([process.exitcode for process in processes],
+                    gate._done.value)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+    def test_crash_does_not_finish(self):
+        # router 0 crashes, and router 2 is paused until router 1 drains the
+        # queue
+        (exit_codes, done) = self.run_routers(
+            2, [(0, 1), (0.5, 0), (30, 0)]
+        )
+        self.assertEqual(exit_codes, [1, 0, None])
+        self.assertTrue(done)
+
+    def test_paused_routers_are_not_left_waiting(self):
+        (exit_codes, done) = self.run_routers(1, [(0, 1), (30, 0)])
+        self.assertEqual(exit_codes, [1, None])
+        self.assertTrue(done)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tnra import server
+
+from tests.helpers import start_server, stop_server
+
+class LoadQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_redelivered_jobs_are_reloaded(self):
+        # a job whose lease expired is requeued with a delivery count, which
+        # must not survive save_queue and load_queue
+        (s, client) = start_server(lease_timeout = 1)
+        try:
+            client.enqueue(0, 0, 1, 1, mode = "walk")
+            client.enqueue(2, 2, 3, 3, mode = "walk")
+            self.assertEqual(len(client.queue_pop_many(1)), 1)
+            deadline = time.time() + 10
+            while (client.lease_stats()["expired"] == 0):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.2)
+            path = os.path.join(self.directory, "queue.snapshot")
+            self.assertTrue(client.save_queue(path))
+        finally:
+            stop_server(s, client)
+
+        (s, client) = start_server()
+        try:
+            self.assertEqual(client.load_queue(path), 2)
+            self.assertEqual(client.queue_size(), 2)
+            routes = client.queue_pop_many(10)
+            self.assertEqual(len(routes), 2)
+            for (args, kwargs) in routes:
+                self.assertNotIn("deliveries", kwargs)
+        finally:
+            stop_server(s, client)
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_duplicates_are_routed_once(self):
+        path = os.path.join(self.directory, "results.jsonl")
+        (s, client) = start_server()
+        try:
+            client.open_file(path)
+            for i in range(3):
+                # coordinates are rounded to dedup_precision decimal places
+                client.enqueue(0, 0, 1, 1 + i * 1e-9, mode = "walk",
+                               attributes = {"i": i})
+            client.enqueue(0, 0, 1, 1, mode = "bike", attributes = {"i": 3})
+            self.assertEqual(client.queue_size(), 2)
+            self.assertEqual(client.dedup_stats()["hits"], 2)
+
+            for (args, kwargs) in client.queue_pop_many(10):
+                client.write_result({"duration": 60}, kwargs["attributes"],
+                                    kwargs["job_id"])
+            self.assertEqual(client.dedup_stats()["pending"], 0)
+
+            # a route whose key has finished is written from the results
+            client.enqueue(0, 0, 1, 1, mode = "walk", attributes = {"i": 4})
+            self.assertEqual(client.queue_size(), 0)
+            self.assertEqual(client.dedup_stats()["cache_hits"], 1)
+            client.close_file()
+        finally:
+            stop_server(s, client)
+
+        with open(path, "r") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(
+            sorted(record["attributes"]["i"] for record in records),
+            [0, 1, 2, 3, 4]
+        )
+
+class EnqueueTest(unittest.TestCase):
+
+    def test_positional_arguments_are_moved_to_kwargs(self):
+        (s, client) = start_server()
+        try:
+            client.enqueue(0, 0, 1, 1, "walk", 3, 9, {"i": 0})
+            client.enqueue_many([(2, 2, 3, 3, "bike")])
+            routes = sorted(client.queue_pop_many(10))
+            self.assertEqual(
+                [(args, kwargs["mode"]) for (args, kwargs) in routes],
+                [((0, 0, 1, 1), "walk"), ((2, 2, 3, 3), "bike")]
+            )
+            self.assertEqual(
+                (routes[0][1]["weekday"], routes[0][1]["hour"],
+                 routes[0][1]["attributes"]),
+                (3, 9, {"i": 0})
+            )
+
+            with self.assertRaises(TypeError):
+                client.enqueue(0, 0, 1, 1, "walk", mode = "bike")
+            with self.assertRaises(TypeError):
+                client.enqueue(0, 0, 1, 1, "walk", 3, 9, None, 1)
+            self.assertEqual(client.queue_size(), 0)
+        finally:
+            stop_server(s, client)
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_many_clients(self):
+        def pop_all(port, popped):
+            client = server.Client(port = port)
+            try:
+                while True:
+                    routes = client.queue_pop_many(7)
+                    if (routes is None):
+                        break
+                    popped.extend(args for (args, kwargs) in routes)
+            finally:
+                client.close()
+
+        for engine in server.ENGINES:
+            with self.subTest(engine = engine):
+                (s, client) = start_server(engine = engine)
+                try:
+                    client.enqueue_many(
+                        [(i, 0, i + 1, 1) for i in range(500)],
+                        mode = "walk"
+                    )
+                    popped = []
+                    threads = [
+                        threading.Thread(target = pop_all,
+                                         args = (client.port, popped))
+                        for i in range(4)
+                    ]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    self.assertEqual(
+                        sorted(popped), [(i, 0, i + 1, 1) for i in range(500)]
+                    )
+                finally:
+                    stop_server(s, client)
+
+    def test_slow_io_does_not_stall_queue(self):
+        (s, client) = start_server()
+        save_queue = s._handlers[server.COMMANDS["save_queue"]]
+        saving = threading.Event()
+        release = threading.Event()
+
+        def slow_save_queue(body):
+            saving.set()
+            release.wait()
+            return save_queue(body)
+
+        s._handlers[server.COMMANDS["save_queue"]] = slow_save_queue
+        path = os.path.join(self.directory, "queue.snapshot")
+        saver = server.Client(port = client.port)
+        thread = threading.Thread(target = saver.save_queue, args = (path, ))
+        try:
+            client.enqueue(0, 0, 1, 1, mode = "walk")
+            thread.start()
+            self.assertTrue(saving.wait(10))
+            # queue commands are answered while the I/O thread is busy
+            client.enqueue(2, 2, 3, 3, mode = "walk")
+            self.assertEqual(client.queue_size(), 2)
+            release.set()
+            thread.join()
+        finally:
+            release.set()
+            saver.close()
+            stop_server(s, client)
+        self.assertTrue(os.path.exists(path))
+
+    def test_failed_handler_answers_notok(self):
+        for engine in server.ENGINES:
+            with self.subTest(engine = engine):
+                (s, client) = start_server(engine = engine)
+                try:
+                    # a body without "n", and a directory that does not exist
+                    client.send_cmd({"cmd": server.COMMANDS["queue_pop_many"],
+                                     "body": {}})
+                    self.assertIsNone(server.parse_body(client.recv_rsp()))
+                    self.assertIsNone(client.open_file(
+                        os.path.join(self.directory, "missing", "out.jsonl")
+                    ))
+                    # both the server and its I/O thread keep serving
+                    client.open_file(
+                        os.path.join(self.directory, "results.jsonl")
+                    )
+                    self.assertTrue(client.close_file())
+                    self.assertTrue(client.ping())
+                finally:
+                    stop_server(s, client)
+
+class NamedQueueTest(unittest.TestCase):
+
+    def test_named_queues(self):
+        (s, client) = start_server()
+        try:
+            self.assertTrue(client.create_queue("urgent", "fifo", 1))
+            for i in range(3):
+                client.enqueue(i, 0, i + 1, 1, mode = "walk",
+                               queue = ("default", "urgent")[i % 2])
+            client.enqueue(3, 0, 4, 1, mode = "bike", queue = "urgent")
+            self.assertIsNone(client.create_queue("urgent", "lifo"))
+            self.assertEqual(
+                [(info["name"], info["ordering"], info["size"])
+                 for info in client.queue_info()],
+                [("default", "lifo", 2), ("urgent", "fifo", 2)]
+            )
+
+            self.assertEqual(client.queue_pop(modes = ["bike"])[0][0], 3)
+            self.assertEqual(
+                [args[0] for (args, kwargs) in client.queue_pop_many(10)],
+                [1, 2, 0]
+            )
+            client.enqueue(4, 0, 5, 1, mode = "walk", queue = "urgent")
+            self.assertTrue(client.drop_queue("urgent"))
+            self.assertEqual(client.queue_size(), 0)
+            self.assertEqual(
+                [info["name"] for info in client.queue_info()], ["default"]
+            )
+        finally:
+            stop_server(s, client)
+
+class MatrixTest(unittest.TestCase):
+
+    def test_matrix_is_expanded_lazily(self):
+        (s, client) = start_server()
+        try:
+            origins = [(i, 0) for i in range(30)]
+            destinations = [(0, j) for j in range(30)]
+            self.assertEqual(
+                client.enqueue_matrix(origins, destinations, mode = "walk"),
+                {"matrix_id": 0, "routes": 900}
+            )
+            client.enqueue(0, 0, 1, 1, mode = "walk")
+            self.assertEqual(client.queue_size(), 901)
+            self.assertEqual(len(s.queue), 1)
+            self.assertEqual(client.queue_info()[0]["matrix_routes"], 900)
+
+            # routes that were enqueued on their own are popped first
+            self.assertEqual(client.queue_pop()[0], (0, 0, 1, 1))
+            self.assertIsNone(client.queue_pop_many(10, modes = ["bike"]))
+            routes = client.queue_pop_many(10)
+            self.assertEqual(
+                [kwargs["attributes"] for (args, kwargs) in routes[:2]],
+                [{"origin": 0, "destination": 9},
+                 {"origin": 0, "destination": 8}]
+            )
+            # only the routes that were popped were expanded
+            self.assertEqual(len(s.queue), 0)
+            self.assertEqual(client.queue_size(), 890)
+
+            self.assertEqual(len(client.queue_pop_many(1000)), 890)
+            self.assertEqual(s.matrices, {})
+            self.assertIsNone(client.enqueue_matrix([], destinations))
+            self.assertIsNone(client.enqueue_matrix(
+                origins, destinations, origin_attributes = [{}]
+            ))
+        finally:
+            stop_server(s, client)
+
+class EnqueueManyTest(unittest.TestCase):
+
+    def test_rejected_batch_raises(self):
+        (s, client) = start_server()
+        enqueue_many = s._handlers[server.COMMANDS["enqueue_many"]]
+        batches = []
+
+        def reject_second_batch(body):
+            batches.append(body)
+            if (len(batches) == 2):
+                return {"rsp": server.RESPONSES["notok"]}
+            return enqueue_many(body)
+
+        s._handlers[server.COMMANDS["enqueue_many"]] = reject_second_batch
+        try:
+            routes = [(i, 0, i + 1, 1) for i in range(5)]
+            with self.assertRaises(server.EnqueueError) as context:
+                client.enqueue_many(routes, batch_size = 2)
+            self.assertEqual(context.exception.enqueued, 2)
+            self.assertEqual(client.queue_size(), 2)
+        finally:
+            stop_server(s, client)
+
+if (__name__ == "__main__"):
+    unittest.main()
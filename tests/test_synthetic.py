@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+
+from tnra import synthetic
+
+ROUTE = (-71.08, 42.33, -71.11, 42.37)
+
+class SyntheticDistancesTest(unittest.TestCase):
+
+    def test_haversine(self):
+        self.assertEqual(synthetic.haversine(*ROUTE[:2], *ROUTE[:2]), 0)
+        # a degree of latitude is about 111 km
+        self.assertAlmostEqual(synthetic.haversine(0, 0, 0, 1), 111195,
+                               delta = 1)
+
+    def test_results_depend_on_the_route(self):
+        distances = synthetic.SyntheticDistances(latency = 0,
+                                                 response_size = 1000)
+        walk = distances.distance(*ROUTE, mode = "walk")
+        bike = distances.distance(*ROUTE, mode = "bike")
+        self.assertEqual(walk["distance"], bike["distance"])
+        self.assertAlmostEqual(walk["duration"] / bike["duration"],
+                               synthetic.SPEEDS["bike"]
+                               / synthetic.SPEEDS["walk"])
+        self.assertEqual(
+            synthetic.SyntheticDistances(latency = 0).distance(*ROUTE)
+            ["duration"],
+            walk["duration"]
+        )
+        self.assertEqual(len(walk["response"]["padding"]), 1000)
+
+    def test_latency_and_failures(self):
+        distances = synthetic.SyntheticDistances(latency = 0.05)
+        start_time = time.time()
+        distances.distance(*ROUTE)
+        self.assertGreaterEqual(time.time() - start_time, 0.05)
+
+        distances = synthetic.SyntheticDistances(
+            latency = 0.001, latency_sd = 0.002, failure_rate = 0.5, seed = 1
+        )
+        results = [distances.distance(*ROUTE) for i in range(100)]
+        failures = sum(1 for result in results if (result is None))
+        self.assertGreater(failures, 25)
+        self.assertLess(failures, 75)
+        # failures are reproducible with a seed
+        distances = synthetic.SyntheticDistances(
+            latency = 0.001, latency_sd = 0.002, failure_rate = 0.5, seed = 1
+        )
+        self.assertEqual(
+            [distances.distance(*ROUTE) is None for i in range(100)],
+            [result is None for result in results]
+        )
+
+if (__name__ == "__main__"):
+    unittest.main()
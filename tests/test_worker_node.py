@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import sys
+import unittest
+from unittest import mock
+
+from tnra import worker_node
+
+from tests.helpers import start_server, stop_server
+
+class StartWorkerTest(unittest.TestCase):
+
+    def start_worker(self, client, start_routers):
+        argv = ["tnra_worker", "-p", str(client.port), "-e", "localhost:1",
+                "-P", "1", "--name", "node1"]
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(worker_node, "wait_for_otp"), \
+                mock.patch.object(worker_node, "route_distances"), \
+                mock.patch.object(worker_node.router, "start_routers",
+                                  start_routers):
+            worker_node.start_worker()
+        return client.nodes()["node1"]["status"]
+
+    def test_registers_status(self):
+        (s, client) = start_server()
+        try:
+            self.assertEqual(
+                self.start_worker(client, mock.Mock()), "finished"
+            )
+            with self.assertRaises(RuntimeError):
+                self.start_worker(
+                    client, mock.Mock(side_effect = RuntimeError)
+                )
+            self.assertEqual(client.nodes()["node1"]["status"], "failed")
+        finally:
+            stop_server(s, client)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tnra import writer
+
+class ResultWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        result_writer = writer.ResultWriter(flush_bytes = 10)
+        result_writer.start()
+        path = os.path.join(self.directory, "routes.json")
+        result_writer.open(path)
+        for i in range(100):
+            result_writer.write(b"{\"i\": %d}" % i)
+        result_writer.stop()
+        with open(path, "rb") as f:
+            self.assertEqual(len(f.readlines()), 100)
+
+    def test_open_error(self):
+        result_writer = writer.ResultWriter()
+        result_writer.start()
+        with self.assertRaises(OSError):
+            result_writer.open(os.path.join(self.directory, "a", "b.json"))
+        self.assertTrue(result_writer.is_alive())
+        result_writer.stop()
+
+    @unittest.skipUnless(os.path.exists("/dev/full"), "needs /dev/full")
+    def test_write_error(self):
+        # every write to /dev/full fails as if the disk were full
+        result_writer = writer.ResultWriter(flush_bytes = 1)
+        result_writer.start()
+        result_writer.open("/dev/full", "a")
+        result_writer.write(b"{}")
+        result_writer.join(10)
+        self.assertFalse(result_writer.is_alive())
+        self.assertIsInstance(result_writer.error, OSError)
+        self.assertIsNotNone(result_writer.stats()["error"])
+
+        # calls fail instead of waiting forever
+        with self.assertRaises(OSError):
+            result_writer.close()
+        with self.assertRaises(OSError):
+            result_writer.open(os.path.join(self.directory, "routes.json"))
+        result_writer.stop()
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -2,3 +2,4 @@
 
 from .server import Server, Client
 from .router import Router, start_routers
+from .reader import Reader
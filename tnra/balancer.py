@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# least-outstanding-requests balancing between routing engines on a node
+#
+# One OpenTripPlanner JVM can be the ceiling of a large machine, so a node can
+# run several and give start_routers all of their entrypoints. Every router
+# process then keeps a router per routing engine, and sends each route to the
+# healthy engine with the fewest requests in flight from every process on the
+# node, which is kept in shared memory by an EndpointPool.
+#
+# Engines are ejected from the pool when several requests to them raise in a
+# row, when their moving average latency grows to several times the median of
+# the other engines, or when a health check run by start_routers fails; the
+# route that failed is retried on another engine. Ejected engines are health
+# checked again and readmitted once eject_seconds have passed, so that an
+# engine that was restarted rejoins the run; without health checks, they are
+# readmitted once eject_seconds have passed.
+
+import json
+import multiprocessing
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_MAX_ERRORS = 3        # errors in a row that eject an engine
+DEFAULT_SLOW_FACTOR = 3.0     # multiple of the median latency that ejects one
+DEFAULT_MIN_SAMPLES = 20      # requests an engine needs before it is slow
+DEFAULT_EJECT_SECONDS = 30.0  # seconds before an ejected engine is readmitted
+DEFAULT_CHECK_INTERVAL = 5.0  # seconds between health checks
+LATENCY_SMOOTHING = 0.1       # weight of the newest latency in the average
+NO_ENGINE_POLL_INTERVAL = 0.5 # seconds between retries when all are ejected
+
+OTP_READY_PATH = "/otp/routers" # lists the graphs that are loaded
+
+def otp_ready(entrypoint, timeout = 2.0):
+    """ Return whether an OpenTripPlanner instance has loaded a graph and is
+    answering requests
+
+    Args:
+        entrypoint: The host:port of the instance
+        timeout: The number of seconds to wait for an answer
+    """
+
+    try:
+        with urllib.request.urlopen(
+                    "http://%s%s" % (entrypoint, OTP_READY_PATH),
+                    timeout = timeout
+                ) as response:
+            routers = json.loads(response.read().decode("utf-8"))
+    except (urllib.error.URLError, socket.timeout, ConnectionError,
+            ValueError):
+        return False
+    return len(routers.get("routerInfo", [])) > 0
+
+class EndpointPool(object):
+
+    """ Routing engine entrypoints shared by the router processes of a node,
+    with the number of requests in flight to each and their health
+
+    Must be created before the router processes are started, and passed to
+    them when they are.
+
+    Attributes:
+        endpoints: The host:port of every routing engine
+    """
+
+    def __init__(self, endpoints, max_errors = DEFAULT_MAX_ERRORS,
+                 slow_factor = DEFAULT_SLOW_FACTOR,
+                 min_samples = DEFAULT_MIN_SAMPLES,
+                 eject_seconds = DEFAULT_EJECT_SECONDS,
+                 check_interval = DEFAULT_CHECK_INTERVAL, probe = otp_ready,
+                 verbose = True):
+        """ Initializes EndpointPool object
+
+        Args:
+            endpoints: The host:port of every routing engine
+            max_errors: The number of requests in a row that raise which eject
+                an engine
+            slow_factor: The multiple of the median moving average latency of
+                the other engines above which an engine is ejected, or None to
+                never eject slow engines
+            min_samples: The number of requests that an engine needs to have
+                answered since it was admitted before it can be ejected as slow
+            eject_seconds: The number of seconds before an ejected engine is
+                health checked for readmission, or readmitted if there is no
+                probe
+            check_interval: The number of seconds between health checks
+            probe: A function of an endpoint that returns whether it is
+                healthy, or None to not run health checks
+            verbose: Whether or not to print ejections and readmissions
+        """
+
+        assert len(endpoints) > 0, "No endpoints"
+
+        self.endpoints = list(endpoints)
+        self.max_errors = max_errors
+        self.slow_factor = slow_factor
+        self.min_samples = min_samples
+        self.eject_seconds = eject_seconds
+        self.check_interval = check_interval
+        self.probe = probe
+        self.verbose = verbose
+
+        n = len(self.endpoints)
+        self._lock = multiprocessing.Lock()
+        self._outstanding = multiprocessing.Array("i", n, lock = False)
+        self._healthy = multiprocessing.Array("b", [True] * n, lock = False)
+        self._errors = multiprocessing.Array("i", n, lock = False)
+        self._samples = multiprocessing.Array("l", n, lock = False)
+        self._latency = multiprocessing.Array("d", n, lock = False)
+        self._ejected_at = multiprocessing.Array("d", n, lock = False)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self):
+        """ Pick the healthy engine with the fewest requests in flight, and
+        count a request to it, waiting while every engine is ejected
+
+        Returns:
+            The index of the engine in endpoints
+        """
+
+        while True:
+            with self._lock:
+                best = None
+                for i in range(len(self.endpoints)):
+                    if (not self._healthy[i]):
+                        continue
+                    key = (self._outstanding[i], self._latency[i])
+                    if ((best is None) or (key < best[0])):
+                        best = (key, i)
+                if (best is not None):
+                    self._outstanding[best[1]] += 1
+                    return best[1]
+            # without health checks, nothing else readmits engines
+            if ((self.probe is None) and (self.check() > 0)):
+                continue
+            time.sleep(NO_ENGINE_POLL_INTERVAL)
+
+    def release(self, i, seconds = None, error = False):
+        """ Count the end of a request to an engine, ejecting the engine if it
+        is failing or slow
+
+        Args:
+            i: The index of the engine
+            seconds: How long the request took, if it did not raise
+            error: Whether or not the request raised
+        """
+
+        with self._lock:
+            self._outstanding[i] -= 1
+            if (error):
+                self._errors[i] += 1
+                if (self._errors[i] >= self.max_errors):
+                    self._eject(i, "%d errors in a row" % self._errors[i])
+                return
+
+            self._errors[i] = 0
+            if (self._samples[i] == 0):
+                self._latency[i] = seconds
+            else:
+                self._latency[i] += (
+                    LATENCY_SMOOTHING * (seconds - self._latency[i])
+                )
+            self._samples[i] += 1
+
+            if ((self.slow_factor is not None)
+                    and (self._samples[i] >= self.min_samples)):
+                others = sorted(
+                    self._latency[j] for j in range(len(self.endpoints))
+                    if ((j != i) and self._healthy[j]
+                        and (self._samples[j] >= self.min_samples))
+                )
+                if (len(others) > 0):
+                    median = others[len(others) // 2]
+                    if (self._latency[i] > self.slow_factor * median):
+                        self._eject(i, "%.1f ms average vs %.1f ms median" % (
+                            self._latency[i] * 1000, median * 1000
+                        ))
+
+    def _eject(self, i, reason):
+        """ Take an engine out of the pool; must be called while holding the
+        lock """
+
+        if (not self._healthy[i]):
+            return
+        self._healthy[i] = False
+        self._ejected_at[i] = time.time()
+        if (self.verbose):
+            print("Ejected %s: %s" % (self.endpoints[i], reason))
+
+    def _admit(self, i):
+        """ Put an engine back into the pool with a clean history; must be
+        called while holding the lock """
+
+        self._healthy[i] = True
+        self._errors[i] = 0
+        self._samples[i] = 0
+        self._latency[i] = 0.0
+        if (self.verbose):
+            print("Readmitted %s" % self.endpoints[i])
+
+    def check(self, now = None):
+        """ Health check every engine, ejecting engines that fail and
+        readmitting ejected engines that pass once eject_seconds have passed
+        since they were ejected; without a probe, ejected engines are
+        readmitted once eject_seconds have passed
+
+        Returns:
+            The number of engines that were readmitted
+        """
+
+        if (now is None):
+            now = time.time()
+        admitted = 0
+        for (i, endpoint) in enumerate(self.endpoints):
+            with self._lock:
+                healthy = bool(self._healthy[i])
+                due = (now - self._ejected_at[i] >= self.eject_seconds)
+            if ((not healthy) and (not due)):
+                continue
+            ready = (self.probe is None) or self.probe(endpoint)
+            with self._lock:
+                if (healthy and (not ready)):
+                    self._eject(i, "health check failed")
+                elif ((not self._healthy[i]) and ready):
+                    self._admit(i)
+                    admitted += 1
+        return admitted
+
+    def status(self):
+        """ Return a list of dicts describing every engine: its endpoint,
+        whether it is healthy, and its requests in flight and moving average
+        latency """
+
+        with self._lock:
+            return [
+                {
+                    "endpoint": endpoint,
+                    "healthy": bool(self._healthy[i]),
+                    "outstanding": self._outstanding[i],
+                    "latency": self._latency[i]
+                }
+                for (i, endpoint) in enumerate(self.endpoints)
+            ]
+
+class HealthChecker(threading.Thread):
+
+    """ Background thread that periodically health checks an EndpointPool """
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.pool = pool
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while (not self._stop_event.wait(self.pool.check_interval)):
+            self.pool.check()
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# chunked, compressed TNRA output files with a seekable block index
+#
+# A block file is laid out as follows, with every integer little-endian:
+#
+#     MAGIC
+#     block header (compressed size, number of records), compressed block
+#     block header (compressed size, number of records), compressed block
+#     ...
+#     index: (offset, compressed size, number of records) for every block
+#     trailer: (offset of the index, number of blocks, INDEX_MAGIC)
+#
+# Every block is independently zlib compressed and holds a run of
+# newline-terminated records. The index lets readers jump straight to the
+# block holding any record; if a file was not closed properly and has no
+# index, the block headers are scanned instead.
+
+import bisect
+import multiprocessing
+import os
+import struct
+import zlib
+
+MAGIC = b"TNRABLK1"
+INDEX_MAGIC = b"TNRAIDX1"
+
+BLOCK_HEADER = struct.Struct("<II")
+INDEX_ENTRY = struct.Struct("<QQQ")
+TRAILER = struct.Struct("<QQ8s")
+
+DEFAULT_BLOCK_RECORDS = 10000
+DEFAULT_BLOCK_BYTES = 4 * 1024 * 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+
+def is_block_file(path):
+    """ Return whether or not the file at the given path is a block file """
+
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_index(f):
+    """ Read the block index of a block file
+
+    Args:
+        f: A file object opened in binary mode
+
+    Returns:
+        A (index, index_offset) tuple, where index is a list of (offset,
+        compressed size, number of records) tuples and index_offset is where
+        the blocks end
+    """
+
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    if (f.read(len(MAGIC)) != MAGIC):
+        raise ValueError("Not a TNRA block file")
+
+    if (size >= len(MAGIC) + TRAILER.size):
+        f.seek(size - TRAILER.size)
+        (index_offset, n_blocks, magic) = TRAILER.unpack(f.read(TRAILER.size))
+        if ((magic == INDEX_MAGIC)
+                and (index_offset + n_blocks * INDEX_ENTRY.size
+                     + TRAILER.size == size)):
+            f.seek(index_offset)
+            data = f.read(n_blocks * INDEX_ENTRY.size)
+            return (list(INDEX_ENTRY.iter_unpack(data)), index_offset)
+
+    # no index; scan the block headers, ignoring any truncated last block
+    index = []
+    offset = len(MAGIC)
+    while (offset + BLOCK_HEADER.size <= size):
+        f.seek(offset)
+        (compressed_size, n_records) = BLOCK_HEADER.unpack(
+            f.read(BLOCK_HEADER.size)
+        )
+        if (offset + BLOCK_HEADER.size + compressed_size > size):
+            break
+        index.append((offset, compressed_size, n_records))
+        offset += BLOCK_HEADER.size + compressed_size
+    return (index, offset)
+
+class BlockWriter(object):
+
+    """ Writes records to a block file
+
+    Records are buffered until block_records records or block_bytes bytes
+    have been buffered, and are then compressed and written as one block. The
+    index is written when the writer is closed.
+    """
+
+    def __init__(self, path, mode = "w", block_records = DEFAULT_BLOCK_RECORDS,
+                 block_bytes = DEFAULT_BLOCK_BYTES,
+                 level = DEFAULT_COMPRESSION_LEVEL):
+        """ Initializes BlockWriter object
+
+        Args:
+            path: The path of the block file
+            mode: "w" to create a new file or "a" to add records to an
+                existing one
+            block_records: The maximum number of records in a block
+            block_bytes: The maximum number of uncompressed bytes in a block
+            level: The zlib compression level
+        """
+
+        self.block_records = block_records
+        self.block_bytes = block_bytes
+        self.level = level
+
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        if (mode.startswith("a") and os.path.exists(path)
+                and (os.path.getsize(path) > 0)):
+            self._file = open(path, "r+b")
+            (self._index, end) = read_index(self._file)
+            self._file.seek(end)
+            self._file.truncate()
+        else:
+            self._file = open(path, "wb")
+            self._file.write(MAGIC)
+            self._index = []
+
+    def write_lines(self, lines):
+        """ Add records to the file
+
+        Args:
+            lines: An iterable of records, as bytes without trailing newlines
+        """
+
+        for line in lines:
+            self._buffer.append(line)
+            self._buffer.append(b"\n")
+            self._buffer_bytes += len(line) + 1
+            if ((len(self._buffer) // 2 >= self.block_records)
+                    or (self._buffer_bytes >= self.block_bytes)):
+                self._write_block()
+
+    def flush(self):
+        """ Flush every completed block to the operating system
+
+        Records that have not filled a block yet stay buffered until the block
+        is full or the writer is closed.
+        """
+
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        """ Write the last block and the index, and close the file """
+
+        self._write_block()
+        index_offset = self._file.tell()
+        self._file.write(b"".join(
+            INDEX_ENTRY.pack(*entry) for entry in self._index
+        ))
+        self._file.write(
+            TRAILER.pack(index_offset, len(self._index), INDEX_MAGIC)
+        )
+        self._file.close()
+
+    def _write_block(self):
+        if (len(self._buffer) == 0):
+            return
+        data = zlib.compress(b"".join(self._buffer), self.level)
+        n_records = len(self._buffer) // 2
+        offset = self._file.tell()
+        self._file.write(BLOCK_HEADER.pack(len(data), n_records))
+        self._file.write(data)
+        self._index.append((offset, len(data), n_records))
+        self._buffer = []
+        self._buffer_bytes = 0
+
+def _read_block(args):
+    """ Read and decompress one block; used by BlockReader.blocks """
+
+    (path, offset, compressed_size) = args
+    with open(path, "rb") as f:
+        f.seek(offset + BLOCK_HEADER.size)
+        return zlib.decompress(f.read(compressed_size)).split(b"\n")[:-1]
+
+class BlockReader(object):
+
+    """ Reads records from a block file
+
+    Attributes:
+        index: A list of (offset, compressed size, number of records) tuples,
+            one per block
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            (self.index, end) = read_index(f)
+
+        self._starts = []
+        n_records = 0
+        for (offset, compressed_size, block_records) in self.index:
+            self._starts.append(n_records)
+            n_records += block_records
+        self._n_records = n_records
+        self._cache = (None, None)
+
+    def __len__(self):
+        return self._n_records
+
+    def __iter__(self):
+        for block in self.blocks():
+            for line in block:
+                yield line
+
+    def read_block(self, i):
+        """ Return the records of block i, as a list of bytes """
+
+        (offset, compressed_size, n_records) = self.index[i]
+        return _read_block((self.path, offset, compressed_size))
+
+    def record(self, n):
+        """ Return record n without reading any other block
+
+        Args:
+            n: The index of the record
+
+        Returns:
+            The record, as bytes without a trailing newline
+        """
+
+        if ((n < 0) or (n >= self._n_records)):
+            raise IndexError("record index out of range")
+        i = bisect.bisect_right(self._starts, n) - 1
+        if (self._cache[0] != i):
+            self._cache = (i, self.read_block(i))
+        return self._cache[1][n - self._starts[i]]
+
+    def blocks(self, processes = 1):
+        """ Iterate over the records of every block, in order
+
+        Args:
+            processes: The number of processes to decompress blocks with
+
+        Yields:
+            Lists of records, one list per block
+        """
+
+        args = [
+            (self.path, offset, compressed_size)
+            for (offset, compressed_size, n_records) in self.index
+        ]
+        if (processes <= 1):
+            for arg in args:
+                yield _read_block(arg)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                for block in pool.imap(_read_block, args):
+                    yield block
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# persistent cache of routing results shared by the workers on a node
+
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+DEFAULT_CACHE_PATH = "route_cache.sqlite"
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_PRECISION = 6
+DEFAULT_NO_ROUTE_TTL = None # seconds to cache "no route"; None to not cache it
+
+EVICT_INTERVAL = 1000 # number of puts between checks of the cache size
+ACCESS_BATCH = 1000   # number of hits whose access times are written at once
+BUSY_TIMEOUT_S = 60   # how long to wait for other processes to release locks
+
+class RouteCache(object):
+
+    """ Persistent cache of routing results, backed by SQLite
+
+    Results are keyed on the identity of the routing graph, the rounded
+    origin and destination, the mode, and the ISO weekday and time of day of
+    departure. The date of departure is not part of the key, as TNRA
+    standardizes departures to the next occurrence of a given weekday and hour,
+    which changes from run to run while the route does not; a new graph (i.e.
+    one built from an updated GTFS feed) should be given a new graph_id.
+
+    The database is opened in WAL mode so that every worker process on a node
+    can share a single cache file. When the cache grows past max_entries, the
+    least recently used entries are evicted. So that hits do not take the
+    write lock, which every worker process shares, the access times of hits
+    are buffered and written with the next put, or once ACCESS_BATCH of them
+    have accumulated.
+
+    Routes that were not found are not cached by default, as they can be due
+    to a transient failure of the routing engine (i.e. a timeout, or a graph
+    that is still loading). With no_route_ttl, they are cached for that many
+    seconds, in a table of their own.
+    """
+
+    def __init__(self, path = DEFAULT_CACHE_PATH, graph_id = "",
+                 max_entries = DEFAULT_MAX_ENTRIES,
+                 precision = DEFAULT_PRECISION,
+                 no_route_ttl = DEFAULT_NO_ROUTE_TTL):
+        """ Initializes RouteCache object
+
+        Args:
+            path: The path to the SQLite database
+            graph_id: A string identifying the routing graph, i.e. the name of
+                the city and the date that the graph was built
+            max_entries: The maximum number of results to keep
+            precision: The number of decimal places to round coordinates to
+            no_route_ttl: The number of seconds to cache routes that were not
+                found for, or None to not cache them
+        """
+
+        self.path = path
+        self.graph_id = graph_id
+        self.max_entries = max_entries
+        self.precision = precision
+        self.no_route_ttl = no_route_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._puts = 0
+        self._accessed = {} # key -> access time of hits not yet written
+        self._connection = sqlite3.connect(path, timeout = BUSY_TIMEOUT_S)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "key BLOB PRIMARY KEY, result BLOB, accessed REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS routes_accessed "
+                "ON routes (accessed)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS no_routes ("
+                "key BLOB PRIMARY KEY, expires REAL)"
+            )
+
+    def key(self, origin_x, origin_y, dest_x, dest_y, mode, departure_time):
+        """ Return the cache key of a route
+
+        Args:
+            origin_x, origin_y, dest_x, dest_y: Routing arguments
+            mode: The route_distances mode of transportation
+            departure_time: A datetime.datetime of the departure
+
+        Returns:
+            The key, as bytes
+        """
+
+        return hashlib.sha1(json.dumps([
+            self.graph_id,
+            [round(coord, self.precision)
+             for coord in (origin_x, origin_y, dest_x, dest_y)],
+            mode,
+            departure_time.isoweekday(),
+            departure_time.strftime("%H:%M:%S")
+        ]).encode("utf-8")).digest()
+
+    def get(self, *args):
+        """ Look up the result of a route
+
+        Args:
+            args: Arguments to RouteCache.key
+
+        Returns:
+            A (hit, result) tuple, where hit is whether or not the route was
+            in the cache and result is the cached result, which may be None if
+            no route was found
+        """
+
+        key = self.key(*args)
+        now = time.time()
+        row = self._connection.execute(
+            "SELECT result FROM routes WHERE key = ?", (key, )
+        ).fetchone()
+        if (row is not None):
+            self.hits += 1
+            self._accessed[key] = now
+            if (len(self._accessed) >= ACCESS_BATCH):
+                with self._connection:
+                    self._write_accessed()
+            return (True, json.loads(zlib.decompress(row[0]).decode("utf-8")))
+
+        if (self.no_route_ttl is not None):
+            row = self._connection.execute(
+                "SELECT expires FROM no_routes WHERE key = ?", (key, )
+            ).fetchone()
+            if ((row is not None) and (row[0] > now)):
+                self.hits += 1
+                return (True, None)
+
+        self.misses += 1
+        return (False, None)
+
+    def put(self, origin_x, origin_y, dest_x, dest_y, mode, departure_time,
+            result):
+        """ Store the result of a route
+
+        Args:
+            origin_x, origin_y, dest_x, dest_y: Routing arguments
+            mode: The route_distances mode of transportation
+            departure_time: A datetime.datetime of the departure
+            result: The JSON serializable result, or None if no route was
+                found, which is only cached if no_route_ttl is set
+        """
+
+        key = self.key(origin_x, origin_y, dest_x, dest_y, mode,
+                       departure_time)
+        if (result is None):
+            if (self.no_route_ttl is not None):
+                with self._connection:
+                    self._write_accessed()
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO no_routes VALUES (?, ?)",
+                        (key, time.time() + self.no_route_ttl)
+                    )
+            return
+
+        with self._connection:
+            self._write_accessed()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?)",
+                (
+                    key,
+                    zlib.compress(json.dumps(result).encode("utf-8")),
+                    time.time()
+                )
+            )
+
+        self._puts += 1
+        if (self._puts % EVICT_INTERVAL == 0):
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used results beyond max_entries, and
+        routes that were not found whose time in the cache is up """
+
+        with self._connection:
+            self._write_accessed()
+            self._connection.execute(
+                "DELETE FROM no_routes WHERE expires <= ?", (time.time(), )
+            )
+            (count, ) = self._connection.execute(
+                "SELECT COUNT(*) FROM routes"
+            ).fetchone()
+            if (count > self.max_entries):
+                self._connection.execute(
+                    "DELETE FROM routes WHERE key IN ("
+                    "SELECT key FROM routes ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries, )
+                )
+
+    def _write_accessed(self):
+        """ Write the buffered access times of hits
+
+        Must be called within a transaction.
+        """
+
+        if (len(self._accessed) > 0):
+            self._connection.executemany(
+                "UPDATE routes SET accessed = ? WHERE key = ?",
+                [(accessed, key) for (key, accessed) in self._accessed.items()]
+            )
+            self._accessed = {}
+
+    def close(self):
+        with self._connection:
+            self._write_accessed()
+        self._connection.close()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# adaptive number of active routers on a node
+#
+# Too many routers make the routing engine thrash and time out, and too few
+# leave it idle; how many is right depends on the graph, the modes and the
+# machine. start_routers can start a fixed number of router processes and let
+# an AIMDController decide how many of them are active: every interval, the
+# routers' latencies and failures since the last decision are compared with
+# the best latency seen so far, and the number of active routers grows by a
+# fixed step while the routing engine keeps up and is cut by a factor when its
+# latency inflates or too many routes fail, like TCP congestion control.
+#
+# Routers share a Gate with the controller, which holds the number of active
+# routers and the counters of the routes calculated since the last decision.
+# Router number i only takes new jobs while i is below the number of active
+# routers; a router that is paused finishes the jobs it has already taken.
+
+import math
+import multiprocessing
+import threading
+import time
+
+DEFAULT_INTERVAL = 10.0         # seconds between decisions
+DEFAULT_LATENCY_TOLERANCE = 2.0 # multiple of the best latency to back off at
+DEFAULT_MAX_FAILURE_RATE = 0.2  # share of failed routes to back off at
+DEFAULT_INCREASE = 1            # routers added after a good interval
+DEFAULT_DECREASE = 0.5          # factor the routers are cut by after a bad one
+DEFAULT_MIN_ROUTES = 20         # routes needed in an interval to decide on it
+
+PAUSE_POLL_INTERVAL = 0.5       # seconds between checks of a paused router
+
+class Gate(object):
+
+    """ Number of active routers and route counters shared between the
+    router processes of a node and their controller
+
+    Must be created before the router processes are started, and passed to
+    them when they are.
+    """
+
+    def __init__(self, active):
+        """ Initializes Gate object
+
+        Args:
+            active: The initial number of active routers
+        """
+
+        self._lock = multiprocessing.Lock()
+        self._active = multiprocessing.Value("i", active, lock = False)
+        self._done = multiprocessing.Value("b", False, lock = False)
+        self._routes = multiprocessing.Value("l", 0, lock = False)
+        self._failures = multiprocessing.Value("l", 0, lock = False)
+        self._latency = multiprocessing.Value("d", 0.0, lock = False)
+
+    @property
+    def active(self):
+        return self._active.value
+
+    @active.setter
+    def active(self, active):
+        self._active.value = active
+
+    def finish(self):
+        """ Let every paused router go, i.e. once the queue is empty """
+
+        self._done.value = True
+
+    def wait(self, index):
+        """ Block router number index while it is paused """
+
+        while ((index >= self._active.value) and (not self._done.value)):
+            time.sleep(PAUSE_POLL_INTERVAL)
+
+    def record(self, seconds, success):
+        """ Count a route sent to the routing engine
+
+        Args:
+            seconds: How long the routing engine took
+            success: Whether or not a route was found
+        """
+
+        with self._lock:
+            self._routes.value += 1
+            if (not success):
+                self._failures.value += 1
+            self._latency.value += seconds
+
+    def take(self):
+        """ Return and reset the number of routes, failed routes and the total
+        latency recorded since the last call """
+
+        with self._lock:
+            counts = (
+                self._routes.value, self._failures.value, self._latency.value
+            )
+            self._routes.value = 0
+            self._failures.value = 0
+            self._latency.value = 0.0
+        return counts
+
+class Slot(object):
+
+    """ The place of one router process at a Gate """
+
+    def __init__(self, gate, index):
+        self.gate = gate
+        self.index = index
+
+    def wait(self):
+        self.gate.wait(self.index)
+
+    def record(self, seconds, success):
+        self.gate.record(seconds, success)
+
+class AIMDController(object):
+
+    """ Decides how many routers are active from their latency and failure
+    rate, with additive increase and multiplicative decrease
+
+    Attributes:
+        active: The current number of active routers
+        best_latency: The lowest mean latency of an interval so far, in
+            seconds
+        decisions: A list of (time, active routers, routes, mean latency,
+            failure rate, reason) tuples, one per decision
+    """
+
+    def __init__(self, min_routers = 1, max_routers = None, initial = None,
+                 latency_tolerance = DEFAULT_LATENCY_TOLERANCE,
+                 max_latency = None,
+                 max_failure_rate = DEFAULT_MAX_FAILURE_RATE,
+                 increase = DEFAULT_INCREASE, decrease = DEFAULT_DECREASE,
+                 min_routes = DEFAULT_MIN_ROUTES):
+        """ Initializes AIMDController object
+
+        Args:
+            min_routers, max_routers: Bounds on the number of active routers;
+                max_routers defaults to the number of CPUs
+            initial: The initial number of active routers, by default halfway
+                between the bounds
+            latency_tolerance: The multiple of the best mean latency seen so
+                far above which the routing engine is considered overloaded
+            max_latency: A mean latency in seconds above which the routing
+                engine is considered overloaded, or None
+            max_failure_rate: The share of failed routes above which the
+                routing engine is considered overloaded
+            increase: The number of routers to add after an interval in which
+                the routing engine kept up
+            decrease: The factor to multiply the number of routers by after an
+                interval in which it was overloaded
+            min_routes: The number of routes that an interval needs for a
+                decision to be made on it
+        """
+
+        if (max_routers is None):
+            max_routers = multiprocessing.cpu_count()
+        max_routers = max(max_routers, min_routers)
+        if (initial is None):
+            initial = (min_routers + max_routers + 1) // 2
+
+        self.min_routers = min_routers
+        self.max_routers = max_routers
+        self.latency_tolerance = latency_tolerance
+        self.max_latency = max_latency
+        self.max_failure_rate = max_failure_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.min_routes = min_routes
+
+        self.active = self._bound(initial)
+        self.best_latency = None
+        self.decisions = []
+
+    def _bound(self, active):
+        return max(self.min_routers, min(self.max_routers, active))
+
+    def update(self, routes, failures, latency, now = None):
+        """ Decide how many routers are active after an interval
+
+        Args:
+            routes: The number of routes sent to the routing engine in the
+                interval
+            failures: The number of those that failed
+            latency: The total latency of those routes, in seconds
+            now: The time of the decision
+
+        Returns:
+            The new number of active routers
+        """
+
+        if (now is None):
+            now = time.time()
+
+        if (routes < self.min_routes):
+            # too few routes to tell; routes can also be scarce because the
+            # queue is running out, which says nothing about the engine
+            self.decisions.append((now, self.active, routes, None, None,
+                                   "hold"))
+            return self.active
+
+        mean_latency = latency / routes
+        failure_rate = failures / routes
+        if ((self.best_latency is None) or (mean_latency < self.best_latency)):
+            self.best_latency = mean_latency
+
+        if (failure_rate > self.max_failure_rate):
+            reason = "failures"
+        elif ((self.max_latency is not None)
+                and (mean_latency > self.max_latency)):
+            reason = "latency"
+        elif (mean_latency > self.best_latency * self.latency_tolerance):
+            reason = "latency"
+        else:
+            reason = None
+
+        if (reason is None):
+            self.active = self._bound(self.active + self.increase)
+            reason = "increase"
+        else:
+            self.active = self._bound(
+                min(self.active - 1, math.floor(self.active * self.decrease))
+            )
+
+        self.decisions.append(
+            (now, self.active, routes, mean_latency, failure_rate, reason)
+        )
+        return self.active
+
+class ControllerThread(threading.Thread):
+
+    """ Background thread that periodically feeds the counters of a Gate to
+    an AIMDController and applies its decisions """
+
+    def __init__(self, gate, controller, interval = DEFAULT_INTERVAL,
+                 verbose = True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.gate = gate
+        self.controller = controller
+        self.interval = interval
+        self.verbose = verbose
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while (not self._stop_event.wait(self.interval)):
+            (routes, failures, latency) = self.gate.take()
+            before = self.controller.active
+            active = self.controller.update(routes, failures, latency)
+            self.gate.active = active
+            if (self.verbose):
+                print(format_decision(self.controller.decisions[-1], before))
+
+    def stop(self):
+        self._stop_event.set()
+
+def format_decision(decision, before):
+    """ Return a line describing a decision of an AIMDController
+
+    Args:
+        decision: An item of AIMDController.decisions
+        before: The number of active routers before the decision
+    """
+
+    (now, active, routes, mean_latency, failure_rate, reason) = decision
+    if (mean_latency is None):
+        return "routers: %d active (hold; %d routes)" % (active, routes)
+    return ("routers: %d -> %d active (%s; %d routes, %.1f ms mean, "
+            "%.1f%% failed)" % (
+                before, active, reason, routes, mean_latency * 1000,
+                100 * failure_rate
+            ))
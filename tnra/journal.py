@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# write-ahead journal and snapshots that make the server queue durable
+#
+# A journal directory holds at most one snapshot and one journal:
+#
+#     queue.snapshot     the queue and server state as of some generation g
+#     journal.<g>        every operation since that snapshot was taken
+#
+# Taking a snapshot writes the state as generation g + 1 to a temporary file,
+# renames it over the old snapshot, and only then starts journal.<g + 1> and
+# deletes journal.<g>, so that a crash at any point leaves a snapshot and the
+# journal that follows it (and possibly journal.<g>, which recovery deletes).
+# Recovery loads the snapshot and replays its journal, so it takes time
+# proportional to the size of the snapshot plus at most snapshot_bytes of
+# journal, however long the server has been running.
+
+import json
+import os
+import struct
+import time
+import zlib
+
+from . import protocol, queues
+
+SNAPSHOT_NAME = "queue.snapshot"
+JOURNAL_PREFIX = "journal."
+
+SNAPSHOT_MAGIC = b"TNRASNP1"
+SNAPSHOT_HEADER = struct.Struct("<QQ") # generation, length of the state JSON
+
+# every journal record is a header of (op, payload length, payload CRC32)
+# followed by the payload
+RECORD_HEADER = struct.Struct("<BII")
+COUNT = struct.Struct("<Q")
+JOB_ID = struct.Struct("<q")
+
+OPS = {
+    "enqueue": 1, # routes added to the queue, with their job IDs
+    "pop": 2,     # number of routes popped from the queue
+    "clear": 3,   # every route removed from the queue
+    "wait": 4,    # attributes of a duplicate route waiting on a job
+    "finish": 5,  # job that was finished
+    "dead": 6,    # job that was moved to the dead-letter queue
+    "create": 7,  # named queue that was created
+    "drop": 8,    # named queue that was removed
+    "matrix": 9,  # matrix job that was added
+    "expand": 10  # number of routes expanded from a matrix job
+}
+OP_NAMES = {code: name for (name, code) in OPS.items()}
+
+DEFAULT_SNAPSHOT_BYTES = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = None
+
+class Journal(object):
+
+    """ Append-only log of queue operations, with periodic snapshots
+
+    Operations are buffered in memory and written with a single write call by
+    commit, which the server calls after every command; consecutive enqueues
+    are written as one record. Committed operations survive the server
+    process dying; if fsync_interval is set, the journal is also fsynced
+    after a commit if at least that many seconds have passed since the last
+    fsync, so that they survive the machine dying.
+
+    Attributes:
+        directory: The journal directory
+        generation: The generation of the current snapshot
+    """
+
+    def __init__(self, directory, snapshot_bytes = DEFAULT_SNAPSHOT_BYTES,
+                 fsync_interval = DEFAULT_FSYNC_INTERVAL):
+        """ Initializes Journal object
+
+        Args:
+            directory: The directory to keep the snapshot and journal in,
+                which is created if needed
+            snapshot_bytes: The size of the journal after which
+                should_snapshot returns True
+            fsync_interval: The minimum number of seconds between fsyncs, or
+                None to leave syncing to the operating system
+        """
+
+        self.directory = directory
+        self.snapshot_bytes = snapshot_bytes
+        self.fsync_interval = fsync_interval
+        self.generation = 0
+
+        self._file = None
+        self._records = []
+        self._routes = []
+        self._last_fsync = time.time()
+
+        os.makedirs(directory, exist_ok = True)
+
+    def recover(self):
+        """ Load the latest snapshot and read the journal that follows it, and
+        start appending to that journal
+
+        Returns:
+            A (queue, state, ops) tuple, where queue is the snapshotted
+            QueueSet (empty if there is no snapshot), state is the
+            snapshotted server state (None if there is no snapshot), and ops
+            is a list of (op name, argument) tuples to be replayed in order
+        """
+
+        queue = queues.QueueSet()
+        state = None
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        if (os.path.exists(path)):
+            with open(path, "rb") as f:
+                (self.generation, queue, state) = _read_snapshot(f)
+
+        # journals of other generations are left over from a crash while a
+        # snapshot was being taken, and are already part of the snapshot
+        for name in os.listdir(self.directory):
+            if (name.startswith(JOURNAL_PREFIX)
+                    and (name != os.path.basename(self._journal_path()))):
+                os.remove(os.path.join(self.directory, name))
+
+        ops = []
+        path = self._journal_path()
+        if (os.path.exists(path)):
+            end = 0
+            with open(path, "rb") as f:
+                for (op, argument, end) in self._read_records(f):
+                    ops.append((op, argument))
+            # drop a record that was cut off by a crash
+            os.truncate(path, end)
+
+        self._file = open(path, "ab")
+        return (queue, state, ops)
+
+    def enqueue(self, item):
+        """ Log a route added to the queue
+
+        Args:
+            item: An (args, kwargs) tuple, whose kwargs include its job ID
+        """
+
+        self._routes.append(item)
+
+    def pop(self, n, names = None, modes = None):
+        """ Log n routes popped from the given queues and modes """
+
+        self._add("pop", COUNT.pack(n)
+                  + json.dumps([names, modes]).encode("utf-8"))
+
+    def clear(self, name = None):
+        """ Log every route being removed from a queue, or from every queue if
+        name is None """
+
+        self._add("clear", json.dumps(name).encode("utf-8"))
+
+    def create(self, name, ordering, priority):
+        """ Log a named queue being created """
+
+        self._add("create", json.dumps([name, ordering, priority]).encode(
+            "utf-8"
+        ))
+
+    def drop(self, name):
+        """ Log a named queue being removed """
+
+        self._add("drop", json.dumps(name).encode("utf-8"))
+
+    def matrix(self, matrix_id, matrix):
+        """ Log a matrix job being added
+
+        Args:
+            matrix_id: The ID of the job
+            matrix: The output of tnra.queues.MatrixJob.to_dict
+        """
+
+        self._add("matrix", json.dumps([matrix_id, matrix]).encode("utf-8"))
+
+    def expand(self, matrix_id, n):
+        """ Log n routes being expanded from a matrix job; the routes are
+        logged as enqueued separately """
+
+        self._add("expand", json.dumps([matrix_id, n]).encode("utf-8"))
+
+    def wait(self, job_id, attributes):
+        """ Log the attributes of a duplicate route waiting on a job """
+
+        self._add("wait", JOB_ID.pack(job_id)
+                  + json.dumps(attributes).encode("utf-8"))
+
+    def finish(self, job_id):
+        """ Log a job being finished """
+
+        self._add("finish", JOB_ID.pack(job_id))
+
+    def dead(self, job_id):
+        """ Log a leased job being moved to the dead-letter queue """
+
+        self._add("dead", JOB_ID.pack(job_id))
+
+    def commit(self):
+        """ Write every buffered operation to the journal """
+
+        self._add_routes()
+        if (len(self._records) == 0):
+            return
+        self._file.write(b"".join(self._records))
+        self._file.flush()
+        self._records = []
+
+        if ((self.fsync_interval is not None)
+                and (time.time() - self._last_fsync >= self.fsync_interval)):
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.time()
+
+    def should_snapshot(self):
+        """ Return whether or not the journal has grown past snapshot_bytes """
+
+        return self._file.tell() >= self.snapshot_bytes
+
+    def snapshot(self, queue, state):
+        """ Replace the snapshot and start a new, empty journal
+
+        Must be called while holding the server lock, so that no operation
+        is logged while the snapshot is being taken.
+
+        Args:
+            queue: The QueueSet to snapshot
+            state: The JSON serializable server state to snapshot
+        """
+
+        self.commit()
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        write_snapshot(path, self.generation + 1, queue, state)
+
+        old_journal = self._journal_path()
+        self._file.close()
+        self.generation += 1
+        self._file = open(self._journal_path(), "wb")
+        os.remove(old_journal)
+        self._last_fsync = time.time()
+
+    def close(self):
+        if (self._file is not None):
+            self.commit()
+            self._file.close()
+            self._file = None
+
+    def _journal_path(self):
+        return os.path.join(
+            self.directory, "%s%d" % (JOURNAL_PREFIX, self.generation)
+        )
+
+    def _add(self, op, payload):
+        """ Buffer a record, after any buffered routes """
+
+        self._add_routes()
+        self._records.append(
+            RECORD_HEADER.pack(OPS[op], len(payload), zlib.crc32(payload))
+        )
+        self._records.append(payload)
+
+    def _add_routes(self):
+        """ Buffer the buffered routes as a single enqueue record """
+
+        if (len(self._routes) == 0):
+            return
+        (coords, kwargs) = protocol.ROUTES.encode(self._routes)
+        self._routes = []
+        self._add("enqueue", COUNT.pack(len(coords)) + coords + kwargs)
+
+    def _read_records(self, f):
+        """ Yield the (op name, argument, end offset) of every complete,
+        intact record in a journal file """
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if (len(header) < RECORD_HEADER.size):
+                return
+            (op, size, crc) = RECORD_HEADER.unpack(header)
+            payload = f.read(size)
+            if ((len(payload) < size) or (zlib.crc32(payload) != crc)):
+                return
+
+            name = OP_NAMES[op]
+            if (name == "enqueue"):
+                (coords_size, ) = COUNT.unpack_from(payload)
+                start = COUNT.size
+                argument = protocol.ROUTES.decode([
+                    payload[start:start + coords_size],
+                    payload[start + coords_size:]
+                ])
+            elif (name == "pop"):
+                (n, ) = COUNT.unpack_from(payload)
+                (names, modes) = json.loads(
+                    payload[COUNT.size:].decode("utf-8")
+                )
+                argument = (n, names, modes)
+            elif (name == "wait"):
+                (job_id, ) = JOB_ID.unpack_from(payload)
+                argument = (
+                    job_id,
+                    json.loads(payload[JOB_ID.size:].decode("utf-8"))
+                )
+            elif (name in ("finish", "dead")):
+                (argument, ) = JOB_ID.unpack(payload)
+            else:
+                argument = json.loads(payload.decode("utf-8"))
+            yield (name, argument, f.tell())
+
+def write_snapshot(path, generation, queue, state):
+    """ Atomically write a snapshot of a queue and server state
+
+    Args:
+        path: The path of the snapshot
+        generation: The generation of the snapshot
+        queue: The QueueSet to snapshot
+        state: The JSON serializable server state to snapshot
+    """
+
+    state = json.dumps(state).encode("utf-8")
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(SNAPSHOT_HEADER.pack(generation, len(state)))
+        f.write(state)
+        queue.dump(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def read_snapshot(path):
+    """ Read a snapshot written by write_snapshot
+
+    Args:
+        path: The path of the snapshot
+
+    Returns:
+        A (queue, state) tuple
+    """
+
+    with open(path, "rb") as f:
+        (generation, queue, state) = _read_snapshot(f)
+    return (queue, state)
+
+def _read_snapshot(f):
+    """ Return the (generation, queue, state) of a snapshot file """
+
+    if (f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC):
+        raise ValueError("Not a TNRA snapshot")
+    (generation, state_size) = SNAPSHOT_HEADER.unpack(
+        f.read(SNAPSHOT_HEADER.size)
+    )
+    state = json.loads(f.read(state_size).decode("utf-8"))
+    return (generation, queues.QueueSet.load(f), state)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# origin-destination matrices of TNRA results
+#
+# Routes between every origin and every destination, i.e. enqueued with
+# tnra.Client().enqueue_matrix, are usually analyzed as a table with one row
+# per origin and one column per destination. load_matrix reads the duration
+# and distance of every route of an output file into such a table, as NumPy
+# arrays, identifying origins and destinations by one of their attributes.
+#
+# For matrices that are large or read often, export_matrix streams an output
+# file into a directory of .npy files instead, which open_matrix memory-maps so
+# that a matrix opens instantly and only the parts that are used are read:
+#
+#     duration.npy, distance.npy  float arrays, NaN where there is no route
+#     found.npy                   boolean fill mask, True where there is one
+#     origins.json                the ID of every row, as a JSON list
+#     destinations.json           the ID of every column, as a JSON list
+#
+# NumPy is only needed by this module.
+
+import argparse
+import json
+import math
+import os
+
+import numpy
+
+from . import reader
+
+FIELDS = ["duration", "distance"]
+ORIGINS_FILE = "origins.json"
+DESTINATIONS_FILE = "destinations.json"
+
+class ODMatrix(object):
+
+    """ Durations and distances between a set of origins and a set of
+    destinations
+
+    Attributes:
+        origin_ids, destination_ids: The ID of every row and column
+        duration, distance: Arrays of floats with one row per origin and one
+            column per destination, NaN where there is no route
+        found: A boolean array that is True where there is a route, or None
+            to tell from the durations
+    """
+
+    def __init__(self, origin_ids, destination_ids, duration, distance,
+                 found = None):
+        self.origin_ids = list(origin_ids)
+        self.destination_ids = list(destination_ids)
+        self.duration = duration
+        self.distance = distance
+        self.found = found
+
+    @property
+    def shape(self):
+        return self.duration.shape
+
+    @property
+    def missing(self):
+        """ Boolean array that is True where there is no route """
+
+        if (self.found is not None):
+            return ~self.found
+        return numpy.isnan(self.duration)
+
+    def origin_index(self):
+        """ Return a dict of origin ID -> row """
+
+        return {
+            origin_id: i for (i, origin_id) in enumerate(self.origin_ids)
+        }
+
+    def destination_index(self):
+        """ Return a dict of destination ID -> column """
+
+        return {
+            destination_id: j
+            for (j, destination_id) in enumerate(self.destination_ids)
+        }
+
+def _value(value):
+    """ Return a duration or distance as a float, or NaN if there is none """
+
+    if (isinstance(value, (int, float)) and (not isinstance(value, bool))):
+        return float(value)
+    return math.nan
+
+def matrix_ids(path, origin_key, destination_key, processes = 1,
+               where = None):
+    """ Return the IDs of the origins and destinations of an output file, in
+    the order in which they first appear
+
+    Args:
+        path: The path to the output file
+        origin_key, destination_key: The attributes that identify the origin
+            and destination of a route, i.e. "blockgroup_geoid" and
+            "shelter_objectid"
+        processes: The number of processes to read the file with
+        where: A filter on the attributes of records (see tnra.Reader.records)
+
+    Returns:
+        An (origin IDs, destination IDs) tuple of lists
+    """
+
+    origins = {}
+    destinations = {}
+    for record in reader.Reader(path, processes).records(
+                fields = ["attributes"], where = where
+            ):
+        attributes = record["attributes"]
+        if ((not isinstance(attributes, dict))
+                or (origin_key not in attributes)
+                or (destination_key not in attributes)):
+            continue
+        origins.setdefault(attributes[origin_key], None)
+        destinations.setdefault(attributes[destination_key], None)
+    return (list(origins), list(destinations))
+
+def load_matrix(path, origin_key, destination_key, origin_ids = None,
+                destination_ids = None, processes = 1, where = None):
+    """ Read the durations and distances of an output file into an ODMatrix
+
+    Only the attributes, duration and distance of each record are parsed.
+    Records without both keys, or whose origin or destination is not in
+    origin_ids or destination_ids, are skipped, as are the durations and
+    distances of jobs routed with several modes or hours; when a route was
+    written more than once, the last result that found a route is kept.
+
+    Args:
+        path: The path to the output file
+        origin_key, destination_key: The attributes that identify the origin
+            and destination of a route
+        origin_ids, destination_ids: The IDs of the rows and columns of the
+            matrix, by default every ID in the file, in the order in which
+            they first appear; reading them takes another pass over the file
+        processes: The number of processes to read the file with
+        where: A filter on the attributes of records (see tnra.Reader.records)
+
+    Returns:
+        An ODMatrix
+    """
+
+    (origin_ids, destination_ids) = _ids(
+        path, origin_key, destination_key, origin_ids, destination_ids,
+        processes, where
+    )
+    matrix = ODMatrix(
+        origin_ids, destination_ids,
+        numpy.full((len(origin_ids), len(destination_ids)), numpy.nan),
+        numpy.full((len(origin_ids), len(destination_ids)), numpy.nan)
+    )
+    _fill(matrix, path, origin_key, destination_key, processes, where)
+    return matrix
+
+def _ids(path, origin_key, destination_key, origin_ids, destination_ids,
+         processes, where):
+    """ Fill in the IDs that were not given with those of the file """
+
+    if ((origin_ids is None) or (destination_ids is None)):
+        (file_origin_ids, file_destination_ids) = matrix_ids(
+            path, origin_key, destination_key, processes, where
+        )
+        if (origin_ids is None):
+            origin_ids = file_origin_ids
+        if (destination_ids is None):
+            destination_ids = file_destination_ids
+    return (origin_ids, destination_ids)
+
+def _fill(matrix, path, origin_key, destination_key, processes, where):
+    """ Write the durations and distances of an output file into the arrays
+    of an ODMatrix, which are already filled with NaN """
+
+    origin_index = matrix.origin_index()
+    destination_index = matrix.destination_index()
+
+    for record in reader.Reader(path, processes).records(
+                fields = ["attributes"] + FIELDS, where = where
+            ):
+        attributes = record["attributes"]
+        if (not isinstance(attributes, dict)):
+            continue
+        i = origin_index.get(attributes.get(origin_key))
+        j = destination_index.get(attributes.get(destination_key))
+        if ((i is None) or (j is None)):
+            continue
+        duration = _value(record["duration"])
+        if (not math.isnan(duration)):
+            matrix.duration[i, j] = duration
+            matrix.distance[i, j] = _value(record["distance"])
+            if (matrix.found is not None):
+                matrix.found[i, j] = True
+
+def export_matrix(path, directory, origin_key, destination_key,
+                  origin_ids = None, destination_ids = None, processes = 1,
+                  where = None, dtype = "float64"):
+    """ Stream the durations and distances of an output file into a directory
+    of memory-mapped .npy files, which open_matrix opens
+
+    Records are handled as in load_matrix, but are written to the files
+    through memory maps, so the matrix never needs to fit in memory.
+
+    Args:
+        path: The path to the output file
+        directory: The directory to write the matrix to, which is created if
+            it does not exist; files of a previous export are overwritten
+        origin_key, destination_key: The attributes that identify the origin
+            and destination of a route
+        origin_ids, destination_ids: The IDs of the rows and columns of the
+            matrix, by default every ID in the file, in the order in which
+            they first appear
+        processes: The number of processes to read the file with
+        where: A filter on the attributes of records (see tnra.Reader.records)
+        dtype: The type of the durations and distances, i.e. "float32" to
+            halve the size of the files
+
+    Returns:
+        The exported ODMatrix, memory-mapped read-only
+    """
+
+    (origin_ids, destination_ids) = _ids(
+        path, origin_key, destination_key, origin_ids, destination_ids,
+        processes, where
+    )
+    if (not os.path.isdir(directory)):
+        os.makedirs(directory)
+
+    shape = (len(origin_ids), len(destination_ids))
+    arrays = []
+    for (name, array_dtype) in [("duration", dtype), ("distance", dtype),
+                                ("found", bool)]:
+        array = numpy.lib.format.open_memmap(
+            os.path.join(directory, name + ".npy"), mode = "w+",
+            dtype = array_dtype, shape = shape
+        )
+        array[:] = False if (array_dtype is bool) else numpy.nan
+        arrays.append(array)
+
+    matrix = ODMatrix(origin_ids, destination_ids, *arrays)
+    _fill(matrix, path, origin_key, destination_key, processes, where)
+    for array in arrays:
+        array.flush()
+    del arrays, matrix
+
+    # the index files are written last, so that a matrix whose export did not
+    # finish does not open
+    for (filename, ids) in [(ORIGINS_FILE, origin_ids),
+                            (DESTINATIONS_FILE, destination_ids)]:
+        with open(os.path.join(directory, filename), "w") as f:
+            json.dump(list(ids), f)
+    return open_matrix(directory)
+
+def open_matrix(directory, mmap_mode = "r"):
+    """ Open a matrix written by export_matrix without reading it into memory
+
+    Args:
+        directory: The directory of the matrix
+        mmap_mode: The mode to memory-map the arrays with (see numpy.load),
+            or None to read them into memory
+
+    Returns:
+        An ODMatrix
+    """
+
+    ids = []
+    for filename in [ORIGINS_FILE, DESTINATIONS_FILE]:
+        with open(os.path.join(directory, filename), "r") as f:
+            ids.append(json.load(f))
+    (duration, distance, found) = [
+        numpy.load(os.path.join(directory, name + ".npy"),
+                   mmap_mode = mmap_mode)
+        for name in ["duration", "distance", "found"]
+    ]
+    return ODMatrix(ids[0], ids[1], duration, distance, found)
+
+def start_export():
+    parser = argparse.ArgumentParser(
+        description = "Export the durations and distances of a TNRA output "
+                      "file as a memory-mapped origin-destination matrix"
+    )
+    parser.add_argument("path", help = "The path of the output file")
+    parser.add_argument("directory",
+                        help = "The directory to write the matrix to")
+    parser.add_argument("-o", "--origin-key", required = True,
+                        help = "The attribute that identifies the origin of "
+                               "a route, i.e. blockgroup_geoid")
+    parser.add_argument("-d", "--destination-key", required = True,
+                        help = "The attribute that identifies the destination "
+                               "of a route, i.e. shelter_objectid")
+    parser.add_argument("-P", "--processes", type = int, default = 1,
+                        help = "Number of processes to read the file with")
+    parser.add_argument("--float32", action = "store_true",
+                        help = "Store durations and distances as 32-bit "
+                               "floats")
+    args = parser.parse_args()
+
+    matrix = export_matrix(
+        args.path, args.directory, args.origin_key, args.destination_key,
+        processes = args.processes,
+        dtype = "float32" if args.float32 else "float64"
+    )
+    print("Exported %d x %d routes (%d found) to %s" % (
+        len(matrix.origin_ids), len(matrix.destination_ids),
+        numpy.count_nonzero(matrix.found), args.directory
+    ))
+
+if (__name__ == "__main__"):
+    start_export()
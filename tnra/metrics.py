@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# route counters and latency histograms that workers report to the server
+#
+# Workers count the routes, failures and cache hits of every mode and record
+# routing latencies in log-linear histograms, in the style of HdrHistogram:
+# latencies are bucketed with HISTOGRAM_SUB_BUCKETS linear buckets per power of
+# two, so every bucket is within about 3% of the latencies in it, and a
+# histogram covering microseconds to hours has a few hundred buckets. Workers
+# periodically send the counts accumulated since their last report, which the
+# server adds to running totals.
+
+import collections
+import threading
+import time
+
+HISTOGRAM_UNIT = 1e-4         # resolution of recorded latencies, in seconds
+HISTOGRAM_SUB_BUCKET_BITS = 5 # log2 of the number of buckets per power of two
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+
+DEFAULT_REPORT_INTERVAL = 5.0 # seconds between reports from a worker
+DEFAULT_RATE_WINDOW = 60.0    # seconds of reports that rates are taken over
+
+PERCENTILES = (50, 90, 99)
+
+class Histogram(object):
+
+    """ Log-linear histogram of latencies
+
+    Attributes:
+        counts: A dict of bucket index -> number of latencies in the bucket
+        count: The number of latencies recorded
+        total: The sum of the latencies recorded, in seconds
+        max: The largest latency recorded, in seconds
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """ Add a latency to the histogram
+
+        Args:
+            seconds: The latency, in seconds
+        """
+
+        i = bucket_index(seconds)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if (seconds > self.max):
+            self.max = seconds
+
+    def merge(self, other):
+        """ Add the latencies of another histogram to this one """
+
+        for (i, count) in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        if (self.count == 0):
+            return None
+        return self.total / self.count
+
+    def percentile(self, p):
+        """ Return the latency below which p percent of latencies fall, to
+        within the precision of a bucket, or None if the histogram is empty """
+
+        if (self.count == 0):
+            return None
+        rank = max(1, int(round(p / 100 * self.count)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if (seen >= rank):
+                return min(bucket_value(i), self.max)
+        return self.max
+
+    def summary(self):
+        """ Return the mean, PERCENTILES and max of the histogram, in seconds
+        """
+
+        summary = {"mean": self.mean()}
+        for p in PERCENTILES:
+            summary["p%d" % p] = self.percentile(p)
+        summary["max"] = self.max if (self.count > 0) else None
+        return summary
+
+    def to_dict(self):
+        """ Return a JSON serializable representation of the histogram """
+
+        return {
+            "counts": [[i, count] for (i, count) in self.counts.items()],
+            "total": self.total,
+            "max": self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a histogram from the output of to_dict """
+
+        histogram = cls()
+        for (i, count) in data["counts"]:
+            histogram.counts[i] = count
+            histogram.count += count
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+def bucket_index(seconds):
+    """ Return the index of the histogram bucket holding a latency """
+
+    value = int(seconds / HISTOGRAM_UNIT)
+    if (value < HISTOGRAM_SUB_BUCKETS):
+        return max(value, 0)
+    shift = value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+    return shift * HISTOGRAM_SUB_BUCKETS + (value >> shift)
+
+def bucket_value(i):
+    """ Return the latency in the middle of histogram bucket i, in seconds """
+
+    if (i < HISTOGRAM_SUB_BUCKETS):
+        return (i + 0.5) * HISTOGRAM_UNIT
+    shift = i // HISTOGRAM_SUB_BUCKETS - 1
+    low = (i - shift * HISTOGRAM_SUB_BUCKETS) << shift
+    return (low + (1 << shift) / 2) * HISTOGRAM_UNIT
+
+class Metrics(object):
+
+    """ Per-mode route counters and latency histograms of a worker
+
+    Safe to record to from many threads. take returns the counts accumulated
+    since it was last called, to be sent to the server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def record(self, mode, seconds = None, success = True, cached = False):
+        """ Count a route
+
+        Args:
+            mode: The mode of the route
+            seconds: How long the routing engine took, or None if the route
+                was not sent to the routing engine
+            success: Whether or not a route was found
+            cached: Whether or not the route came from the route cache
+        """
+
+        with self._lock:
+            counts = self._modes.get(mode)
+            if (counts is None):
+                counts = self._modes[mode] = _ModeCounts()
+            counts.routes += 1
+            if (not success):
+                counts.failures += 1
+            if (cached):
+                counts.cache_hits += 1
+            if (seconds is not None):
+                counts.latency.record(seconds)
+
+    def take(self):
+        """ Return and reset the counts accumulated since the last call
+
+        Returns:
+            A JSON serializable dict of mode -> counts, or None if nothing
+            was recorded
+        """
+
+        with self._lock:
+            (modes, self._modes) = (self._modes, {})
+        if (len(modes) == 0):
+            return None
+        return {
+            str(mode): counts.to_dict() for (mode, counts) in modes.items()
+        }
+
+class _ModeCounts(object):
+
+    def __init__(self):
+        self.routes = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.latency = Histogram()
+
+    def add(self, data):
+        self.routes += data["routes"]
+        self.failures += data["failures"]
+        self.cache_hits += data["cache_hits"]
+        self.latency.merge(Histogram.from_dict(data["latency"]))
+
+    def summary(self):
+        return {
+            "routes": self.routes,
+            "failures": self.failures,
+            "failure_rate": self.failures / self.routes if self.routes else 0.0,
+            "cache_hits": self.cache_hits,
+            "latency": self.latency.summary()
+        }
+
+    def to_dict(self):
+        return {
+            "routes": self.routes,
+            "failures": self.failures,
+            "cache_hits": self.cache_hits,
+            "latency": self.latency.to_dict()
+        }
+
+class StatsAggregator(object):
+
+    """ Running totals of the metrics reported by every worker, kept by the
+    server
+
+    Routes per second are taken over the reports received in the last
+    rate_window seconds.
+    """
+
+    def __init__(self, rate_window = DEFAULT_RATE_WINDOW):
+        self.rate_window = rate_window
+        self._modes = {}
+        self._workers = {} # worker -> time of its last report
+        self._recent = collections.deque() # (time, mode, routes)
+        self._start_time = time.time()
+
+    def report(self, worker, report, now = None):
+        """ Add the counts reported by a worker
+
+        Args:
+            worker: A name that identifies the worker
+            report: The output of Metrics.take
+            now: The time that the report was received
+        """
+
+        if (now is None):
+            now = time.time()
+        self._workers[worker] = now
+        for (mode, data) in (report or {}).items():
+            counts = self._modes.get(mode)
+            if (counts is None):
+                counts = self._modes[mode] = _ModeCounts()
+            counts.add(data)
+            self._recent.append((now, mode, data["routes"]))
+
+    def summary(self, now = None):
+        """ Return the totals and recent rates of every mode, and of every mode
+        combined
+
+        Returns:
+            A JSON serializable dict holding "modes", a dict of mode ->
+            counters, latency summary and routes per second; "total", the same
+            for every mode combined; and "workers", the number of workers that
+            reported within the rate window
+        """
+
+        if (now is None):
+            now = time.time()
+        while (self._recent and (self._recent[0][0] < now - self.rate_window)):
+            self._recent.popleft()
+        span = max(min(self.rate_window, now - self._start_time), 1e-9)
+
+        recent_routes = collections.Counter()
+        for (report_time, mode, routes) in self._recent:
+            recent_routes[mode] += routes
+
+        total = _ModeCounts()
+        modes = {}
+        for (mode, counts) in self._modes.items():
+            total.add(counts.to_dict())
+            modes[mode] = counts.summary()
+            modes[mode]["routes_per_second"] = recent_routes[mode] / span
+        total = total.summary()
+        total["routes_per_second"] = sum(recent_routes.values()) / span
+
+        return {
+            "modes": modes,
+            "total": total,
+            "workers": sum(
+                1 for last_report in self._workers.values()
+                if (last_report >= now - self.rate_window)
+            )
+        }
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# sampled timings of the stages of the router hot path
+#
+# A Profiler times named stages, which nest: a stage entered while another is
+# running is recorded under the path of every stage around it, i.e.
+# job;routing_engine. Only a sample of top-level stages are timed, chosen at
+# random with probability sample_rate; the stages inside a top-level stage that
+# was not chosen are not timed either, so an unsampled job costs a call to
+# random.random and a few attribute lookups.
+#
+# Every process keeps the latency histogram and the self time (the time not
+# spent in nested stages) of every stage path, and periodically rewrites its
+# own profile, named after the configured profile path like route logs are
+# (see tnra.routelog). tnra_profile merges the profiles of every process into
+# one table, and can write the merged self times as collapsed stacks, which
+# flamegraph.pl and speedscope read.
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from . import metrics, routelog
+
+DEFAULT_PROFILE_PATH = "profile.json"
+DEFAULT_SAMPLE_RATE = 0.01   # share of top-level stages that are timed
+DEFAULT_DUMP_INTERVAL = 60.0 # seconds between rewrites of the profile
+
+class _NullStage(object):
+
+    """ Stage that is not timed """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = _NullStage()
+
+class _Unsampled(object):
+
+    """ Top-level stage that was not chosen to be timed, which keeps the
+    stages inside it from being timed """
+
+    def __init__(self, local):
+        self._local = local
+
+    def __enter__(self):
+        self._local.suppressed = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self._local.suppressed = False
+        return False
+
+class _Stage(object):
+
+    def __init__(self, profiler, stack, name):
+        self._profiler = profiler
+        self._stack = stack
+        self._name = name
+
+    def __enter__(self):
+        # [name, start time, time spent in nested stages]
+        self._stack.append([self._name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc_info):
+        end_time = time.perf_counter()
+        path = ";".join(frame[0] for frame in self._stack)
+        (name, start_time, nested) = self._stack.pop()
+        elapsed = end_time - start_time
+        if (len(self._stack) > 0):
+            self._stack[-1][2] += elapsed
+        self._profiler._record(path, elapsed, elapsed - nested)
+        if (len(self._stack) == 0):
+            self._profiler._maybe_dump()
+        return False
+
+class Profiler(object):
+
+    """ Sampled timings of nested stages, dumped to a per-process profile
+
+    Safe to use from many threads; every thread has its own stack of stages.
+
+    Attributes:
+        path: The path of the profile of this process
+        sample_rate: The share of top-level stages that are timed
+    """
+
+    def __init__(self, path = DEFAULT_PROFILE_PATH,
+                 sample_rate = DEFAULT_SAMPLE_RATE,
+                 dump_interval = DEFAULT_DUMP_INTERVAL, flamegraph = False,
+                 worker = None):
+        """ Initializes Profiler object
+
+        Args:
+            path: The configured profile path; the profile of this process is
+                named after it with the worker name added, i.e. profile.json
+                becomes profile.node1-4242.json
+            sample_rate: The share of top-level stages to time, between 0 and 1
+            dump_interval: The number of seconds between rewrites of the
+                profile
+            flamegraph: Whether or not to also write the self times of every
+                stage path as collapsed stacks, to the profile path with a
+                .folded extension
+            worker: A name that identifies the process, by default its host
+                name and process ID
+        """
+
+        self.path = routelog.worker_log_path(path, worker)
+        self.sample_rate = sample_rate
+        self.dump_interval = dump_interval
+        self.flamegraph = flamegraph
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock() # held while the files are written
+        self._stages = {} # path -> [histogram, self seconds]
+        self._last_dump = time.time()
+
+    def stage(self, name):
+        """ Return a context manager that times a stage, if it is sampled
+
+        Args:
+            name: The name of the stage; must not contain semicolons
+        """
+
+        local = self._local
+        if (getattr(local, "suppressed", False)):
+            return NULL_STAGE
+        stack = getattr(local, "stack", None)
+        if (stack is None):
+            stack = local.stack = []
+        if ((len(stack) == 0) and (random.random() >= self.sample_rate)):
+            return _Unsampled(local)
+        return _Stage(self, stack, name)
+
+    def _record(self, path, seconds, self_seconds):
+        with self._lock:
+            stage = self._stages.get(path)
+            if (stage is None):
+                stage = self._stages[path] = [metrics.Histogram(), 0.0]
+            stage[0].record(seconds)
+            stage[1] += self_seconds
+
+    def _maybe_dump(self):
+        # a thread that finds another one dumping goes back to routing
+        if ((time.time() - self._last_dump >= self.dump_interval)
+                and self._dump_lock.acquire(blocking = False)):
+            try:
+                if (time.time() - self._last_dump >= self.dump_interval):
+                    self._dump()
+            finally:
+                self._dump_lock.release()
+
+    def to_dict(self):
+        """ Return a JSON serializable representation of the profile """
+
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "stages": {
+                    path: {
+                        "latency": histogram.to_dict(),
+                        "self_seconds": self_seconds
+                    }
+                    for (path, (histogram, self_seconds))
+                    in self._stages.items()
+                }
+            }
+
+    def dump(self):
+        """ Rewrite the profile of this process, and its collapsed stacks if
+        flamegraph is enabled
+
+        The threads of a process share its files, so dumps are serialized.
+        """
+
+        with self._dump_lock:
+            self._dump()
+
+    def _dump(self):
+        self._last_dump = time.time()
+        profile = self.to_dict()
+        _replace(self.path, json.dumps(profile))
+        if (self.flamegraph):
+            _replace(
+                os.path.splitext(self.path)[0] + ".folded",
+                collapsed_stacks(merge([profile]))
+            )
+
+    def close(self):
+        self.dump()
+
+def _replace(path, text):
+    """ Write a file under a temporary name and move it into place, so that
+    readers never see a partly written file """
+
+    temp_path = "%s.tmp" % path
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def merge(profiles):
+    """ Merge the profiles of many processes
+
+    Self times are divided by the sample rate of their profile, so that they
+    estimate the time that every process spent in every stage.
+
+    Args:
+        profiles: Outputs of Profiler.to_dict
+
+    Returns:
+        A dict of stage path -> (latency histogram, estimated self seconds)
+    """
+
+    merged = {}
+    for profile in profiles:
+        sample_rate = profile["sample_rate"]
+        for (path, stage) in profile["stages"].items():
+            (histogram, self_seconds) = merged.get(
+                path, (metrics.Histogram(), 0.0)
+            )
+            histogram.merge(metrics.Histogram.from_dict(stage["latency"]))
+            if (sample_rate > 0):
+                self_seconds += stage["self_seconds"] / sample_rate
+            merged[path] = (histogram, self_seconds)
+    return merged
+
+def collapsed_stacks(merged):
+    """ Return merged self times as collapsed stacks, one stage path and its
+    self time in microseconds per line
+
+    Args:
+        merged: The output of merge
+    """
+
+    return "".join(
+        "%s %d\n" % (path, round(self_seconds * 1e6))
+        for (path, (histogram, self_seconds)) in sorted(merged.items())
+        if (self_seconds >= 5e-7)
+    )
+
+def render(merged):
+    """ Return a table of the merged timings of every stage path
+
+    The share of a stage is its estimated total time as a share of the
+    estimated total time of every top-level stage, which, with concurrent
+    routing, is a share of the time of every thread rather than of wall time.
+
+    Args:
+        merged: The output of merge
+
+    Returns:
+        The text of the table, as str
+    """
+
+    top_level = sum(
+        _estimated_total(merged, path) for path in merged if (";" not in path)
+    )
+
+    lines = ["%-36s %9s %7s %8s %8s %8s %8s %8s %8s" % (
+        "stage", "samples", "share %", "self %", "mean ms", "p50 ms",
+        "p90 ms", "p99 ms", "max ms"
+    )]
+    for path in sorted(merged):
+        (histogram, self_seconds) = merged[path]
+        summary = histogram.summary()
+        depth = path.count(";")
+        name = "  " * depth + path.rsplit(";", 1)[-1]
+        lines.append("%-36s %9d %7.2f %8.2f %8s %8s %8s %8s %8s" % (
+            name[:36], histogram.count,
+            100 * _estimated_total(merged, path) / max(top_level, 1e-12),
+            100 * self_seconds / max(top_level, 1e-12),
+            _format_ms(summary["mean"]), _format_ms(summary["p50"]),
+            _format_ms(summary["p90"]), _format_ms(summary["p99"]),
+            _format_ms(summary["max"])
+        ))
+    return "\n".join(lines)
+
+def _estimated_total(merged, path):
+    """ Return the estimated total time of a stage path: its self time plus
+    the self time of every stage path nested in it """
+
+    prefix = path + ";"
+    return sum(
+        self_seconds for (other, (histogram, self_seconds)) in merged.items()
+        if ((other == path) or other.startswith(prefix))
+    )
+
+def _format_ms(seconds):
+    if (seconds is None):
+        return "-"
+    return "%.2f" % (seconds * 1000)
+
+def start_profile():
+    parser = argparse.ArgumentParser(
+        description = "Merge the stage profiles of every router process"
+    )
+    parser.add_argument("profiles", nargs = "*",
+                        help = "The profiles to merge; by default, the "
+                               "profiles of every process that profiled to "
+                               "--path")
+    parser.add_argument("--path", default = DEFAULT_PROFILE_PATH,
+                        help = "The profile path that the routers were "
+                               "configured with")
+    parser.add_argument("--flamegraph", metavar = "OUTPUT",
+                        help = "Also write the merged self times of every "
+                               "stage as collapsed stacks to OUTPUT")
+    args = parser.parse_args()
+
+    paths = args.profiles or routelog.worker_log_paths(args.path)
+    profiles = []
+    for path in paths:
+        with open(path) as f:
+            profiles.append(json.load(f))
+    merged = merge(profiles)
+
+    print("Merged %d profiles" % len(profiles))
+    print(render(merged))
+    if (args.flamegraph):
+        with open(args.flamegraph, "w") as f:
+            f.write(collapsed_stacks(merged))
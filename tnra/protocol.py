@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# binary wire protocol used between the TNRA server and its clients
+
+import array
+import json
+import struct
+import sys
+
+PROTOCOL_VERSION = 1
+
+# every message starts with a header frame of (protocol version, code), where
+# the code is a command for messages sent to the server and a response for
+# messages sent back to clients
+HEADER = struct.Struct("!BB")
+
+# routes are (origin_x, origin_y, dest_x, dest_y) followed by keyword arguments
+ROUTE_COORDS = 4
+
+# results carry the ID of the job that they belong to, or NO_JOB_ID
+RESULT_HEADER = struct.Struct("<q")
+NO_JOB_ID = -1
+
+class ProtocolError(ValueError):
+    pass
+
+def _decode_json(frame):
+    """ Decode a JSON frame
+
+    Raises:
+        ProtocolError: The frame is not valid UTF-8 encoded JSON
+    """
+
+    try:
+        return json.loads(frame.decode("utf-8"))
+    except ValueError as e: # includes JSON and Unicode decode errors
+        raise ProtocolError("Malformed JSON frame: %s" % e)
+
+class Schema(object):
+
+    """ Describes how the body of a message is laid out in frames
+
+    The default schema sends the body as a single JSON frame.
+    """
+
+    def encode(self, body):
+        """ Convert a message body into a list of frames
+
+        Args:
+            body: The body of the message
+
+        Returns:
+            A list of bytes objects
+        """
+
+        return [json.dumps(body).encode("utf-8")]
+
+    def decode(self, frames):
+        """ Convert a list of frames back into a message body
+
+        Args:
+            frames: The frames that followed the header frame
+
+        Returns:
+            The body of the message
+
+        Raises:
+            ProtocolError: The frames are not a valid body
+        """
+
+        if (len(frames) != 1):
+            raise ProtocolError("Expected 1 JSON frame, got %d" % len(frames))
+        return _decode_json(frames[0])
+
+class RoutesSchema(Schema):
+
+    """ A list of (args, kwargs) routes, sent as one frame of packed
+    little-endian doubles holding the coordinates of every route followed by
+    one JSON frame holding the keyword arguments of every route """
+
+    def encode(self, body):
+        coords = array.array("d")
+        kwargs = []
+        for (route_args, route_kwargs) in body:
+            if (len(route_args) != ROUTE_COORDS):
+                raise ProtocolError(
+                    "Routes must have exactly %d coordinates" % ROUTE_COORDS
+                )
+            coords.extend(route_args)
+            kwargs.append(route_kwargs)
+        if (sys.byteorder == "big"):
+            coords.byteswap()
+        return [coords.tobytes(), json.dumps(kwargs).encode("utf-8")]
+
+    def decode(self, frames):
+        if (len(frames) != 2):
+            raise ProtocolError("Expected 2 route frames, got %d" % len(frames))
+        coords_size = array.array("d").itemsize
+        if (len(frames[0]) % coords_size != 0):
+            raise ProtocolError("Route coordinates are not packed doubles")
+        coords = array.array("d")
+        coords.frombytes(frames[0])
+        if (sys.byteorder == "big"):
+            coords.byteswap()
+        kwargs = _decode_json(frames[1])
+        if ((not isinstance(kwargs, list))
+                or (not all(isinstance(item, dict) for item in kwargs))):
+            raise ProtocolError("Route kwargs must be a list of objects")
+        if (len(coords) != len(kwargs) * ROUTE_COORDS):
+            raise ProtocolError("Route coordinates and kwargs do not match")
+        return list(zip(zip(*[iter(coords)] * ROUTE_COORDS), kwargs))
+
+class RouteSchema(RoutesSchema):
+
+    """ A single (args, kwargs) route, laid out like a RoutesSchema of one """
+
+    def encode(self, body):
+        return RoutesSchema.encode(self, [body])
+
+    def decode(self, frames):
+        routes = RoutesSchema.decode(self, frames)
+        if (len(routes) != 1):
+            raise ProtocolError("Expected 1 route, got %d" % len(routes))
+        return routes[0]
+
+class RawSchema(Schema):
+
+    """ A bytes object that is passed through as-is, i.e. a result record that
+    is written straight to the output file """
+
+    def encode(self, body):
+        if (isinstance(body, str)):
+            body = body.encode("utf-8")
+        return [body]
+
+    def decode(self, frames):
+        if (len(frames) != 1):
+            raise ProtocolError("Expected 1 raw frame, got %d" % len(frames))
+        return frames[0]
+
+class ResultSchema(Schema):
+
+    """ A (job_id, attributes, record) result, sent as a fixed-layout job ID
+    frame, a JSON frame of the route attributes, and a raw frame holding the
+    JSON record without its attributes. The attributes and record are passed
+    through as bytes so that the server can write them without decoding them;
+    an empty record frame means that no route was found. """
+
+    def encode(self, body):
+        (job_id, attributes, record) = body
+        if (job_id is None):
+            job_id = NO_JOB_ID
+        if (isinstance(attributes, str)):
+            attributes = attributes.encode("utf-8")
+        if (isinstance(record, str)):
+            record = record.encode("utf-8")
+        return [RESULT_HEADER.pack(job_id), attributes, record]
+
+    def decode(self, frames):
+        if (len(frames) != 3):
+            raise ProtocolError(
+                "Expected 3 result frames, got %d" % len(frames)
+            )
+        try:
+            (job_id, ) = RESULT_HEADER.unpack(frames[0])
+        except struct.error:
+            raise ProtocolError("Malformed result header")
+        if (job_id == NO_JOB_ID):
+            job_id = None
+        return (job_id, frames[1], frames[2])
+
+JSON = Schema()
+ROUTE = RouteSchema()
+ROUTES = RoutesSchema()
+RAW = RawSchema()
+RESULT = ResultSchema()
+
+def pack(code, body = None, schema = None):
+    """ Encode a message
+
+    Args:
+        code: The command or response code of the message
+        body: The body of the message
+        schema: The Schema describing how the body is laid out, or None if
+            the message has no body
+
+    Returns:
+        A list of frames, starting with the header frame
+    """
+
+    frames = [HEADER.pack(PROTOCOL_VERSION, code)]
+    if (schema is not None):
+        frames.extend(schema.encode(body))
+    return frames
+
+def unpack_header(frames):
+    """ Decode the header frame of a message
+
+    Args:
+        frames: The frames of the message
+
+    Returns:
+        The command or response code of the message
+
+    Raises:
+        ProtocolError: The header is malformed or has the wrong version
+    """
+
+    if ((len(frames) == 0) or (len(frames[0]) != HEADER.size)):
+        raise ProtocolError("Malformed header")
+    (version, code) = HEADER.unpack(frames[0])
+    if (version != PROTOCOL_VERSION):
+        raise ProtocolError(
+            "Unsupported protocol version %d (expected %d)" % (
+                version, PROTOCOL_VERSION
+            )
+        )
+    return code
+
+def has_body(frames):
+    """ Return whether or not a message has a body """
+
+    return len(frames) > 1
+
+def unpack_body(frames, schema = JSON):
+    """ Decode the body of a message
+
+    Args:
+        frames: The frames of the message, including the header frame
+        schema: The Schema describing how the body is laid out
+
+    Returns:
+        The body of the message
+    """
+
+    return schema.decode(frames[1:])
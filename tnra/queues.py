@@ -0,0 +1,1015 @@
+#!/usr/bin/env python3
+# compact in-memory storage for queued routes
+
+import array
+import base64
+import collections
+import heapq
+import itertools
+import json
+import struct
+import sys
+import zlib
+
+from . import protocol
+
+# number of items whose keyword arguments are sampled to build the shared
+# compression dictionary, and the maximum size of that dictionary in bytes
+DICTIONARY_SAMPLE_SIZE = 1000
+DICTIONARY_SIZE = 2048
+COMPRESSION_LEVEL = 6
+
+# blobs are tiny, so a small window and little compressor state are enough;
+# this also keeps the per-route copy of the primed compressor cheap
+WINDOW_BITS = 11
+MEMORY_LEVEL = 1
+
+# dumps start with DUMP_MAGIC and the length of a JSON header, followed by the
+# raw columns in little-endian byte order
+DUMP_MAGIC = b"TNRAQUE1"
+DUMP_HEADER = struct.Struct("<Q")
+
+QUEUE_SET_MAGIC = b"TNRAQST1"
+
+# orderings of named queues; routes without a "queue" keyword argument go to
+# DEFAULT_QUEUE, which has the ordering that the server always had
+ORDERINGS = ("lifo", "fifo", "priority")
+DEFAULT_ORDERING = "lifo"
+DEFAULT_QUEUE = "default"
+
+# routes popped from the front of a queue are only removed from its columns
+# once they make up at least half of the columns and at least this many routes
+COMPACT_MIN_ROUTES = 4096
+
+# smallest number of slots of a KeyIndex, which is resized to keep at most
+# half of its slots in use
+KEY_INDEX_MIN_SLOTS = 8
+
+class ColumnarQueue(object):
+
+    """ Double-ended queue of (args, kwargs) routes stored in typed arrays
+
+    Instead of keeping one Python object per route, every field is kept in a
+    column:
+
+    * coordinates are kept in a flat array of doubles, four per route
+    * job IDs assigned by the server are kept in an array of integers
+    * modes are interned and kept as indices into a table of modes
+    * the keys of the keyword arguments and of attribute dicts are interned as
+      schemas, and kept as indices into a table of schemas
+    * the remaining values are JSON encoded, compressed with raw deflate using
+      a dictionary shared by every route, and appended to a single bytearray
+      along with an array of offsets into it
+
+    The shared dictionary is built from the first DICTIONARY_SAMPLE_SIZE
+    routes; those routes, and any route that does not get smaller when
+    compressed, are stored uncompressed.
+
+    Routes are appended to the end of the columns and can be popped from
+    either end. Routes popped from the front are skipped over by a head index
+    and removed from the columns in bulk, so popping from either end is O(1)
+    amortized.
+    """
+
+    def __init__(self):
+        self._coords = array.array("d")
+        self._job_ids = array.array("q")
+        self._modes = array.array("H")
+        self._schemas = array.array("H")
+        self._flags = array.array("B")
+        self._offsets = array.array("Q")
+        self._blobs = bytearray()
+
+        # index of the oldest route in the columns, and the offset that the
+        # start of self._blobs corresponds to
+        self._head = 0
+        self._blob_base = 0
+
+        self._mode_table = []
+        self._mode_ids = {}
+        self._schema_table = []
+        self._schema_ids = {}
+
+        self._samples = []
+        self._zdict = None
+        self._compressor = None
+
+    def __len__(self):
+        return len(self._modes) - self._head
+
+    def __iter__(self):
+        """ Iterate over queued routes from oldest to newest """
+
+        for i in range(self._head, len(self._modes)):
+            yield self._get(i)
+
+    def nbytes(self):
+        """ Return the number of bytes used by the columns of the queue """
+
+        return (
+            sum(
+                column.itemsize * len(column) for column in self._columns()
+            )
+            + len(self._blobs)
+        )
+
+    def append(self, item):
+        """ Add a route to the queue
+
+        Args:
+            item: An (args, kwargs) tuple, where args are the coordinates of
+                the route and kwargs are the keyword arguments of Router.route
+        """
+
+        (args, kwargs) = item
+        if (len(args) != protocol.ROUTE_COORDS):
+            raise ValueError("Routes must have exactly %d coordinates" % (
+                protocol.ROUTE_COORDS
+            ))
+        kwargs = dict(kwargs)
+
+        job_id = kwargs.pop("job_id", None)
+        has_mode = "mode" in kwargs
+        mode = kwargs.pop("mode", None)
+        has_attributes = "attributes" in kwargs
+        attributes = kwargs.pop("attributes", None)
+        if (isinstance(attributes, dict)):
+            attribute_keys = tuple(attributes)
+            attributes = list(attributes.values())
+        else:
+            attribute_keys = None
+
+        schema = (has_mode, tuple(kwargs), has_attributes, attribute_keys)
+        if (has_attributes or kwargs):
+            blob = json.dumps(
+                [list(kwargs.values()), attributes], separators = (",", ":")
+            ).encode("utf-8")
+        else:
+            blob = b""
+        (blob, compressed) = self._compress(blob)
+
+        self._coords.extend(args)
+        if (job_id is None):
+            job_id = protocol.NO_JOB_ID
+        self._job_ids.append(job_id)
+        self._modes.append(self._intern(mode, self._mode_table, self._mode_ids))
+        self._schemas.append(
+            self._intern(schema, self._schema_table, self._schema_ids)
+        )
+        self._flags.append(compressed)
+        self._offsets.append(self._blob_base + len(self._blobs))
+        self._blobs.extend(blob)
+
+    def extend(self, items):
+        """ Add many routes to the queue
+
+        Args:
+            items: An iterable of (args, kwargs) tuples
+        """
+
+        for item in items:
+            self.append(item)
+
+    def pop(self):
+        """ Remove and return the newest route in the queue
+
+        Returns:
+            An (args, kwargs) tuple
+
+        Raises:
+            IndexError: The queue is empty
+        """
+
+        if (len(self) == 0):
+            raise IndexError("pop from empty queue")
+        i = len(self._modes) - 1
+        item = self._get(i)
+        self._truncate(i)
+        return item
+
+    def pop_many(self, n):
+        """ Remove and return up to n of the newest routes in the queue
+
+        Args:
+            n: The maximum number of routes to pop
+
+        Returns:
+            A list of (args, kwargs) tuples, newest first
+        """
+
+        end = len(self._modes)
+        start = max(end - n, self._head)
+        items = [self._get(i) for i in range(end - 1, start - 1, -1)]
+        self._truncate(start)
+        return items
+
+    def popleft_many(self, n):
+        """ Remove and return up to n of the oldest routes in the queue
+
+        Args:
+            n: The maximum number of routes to pop
+
+        Returns:
+            A list of (args, kwargs) tuples, oldest first
+        """
+
+        end = min(self._head + n, len(self._modes))
+        items = [self._get(i) for i in range(self._head, end)]
+        self._head = end
+        if (self._head == len(self._modes)):
+            self.clear()
+        elif ((self._head >= COMPACT_MIN_ROUTES)
+                and (self._head * 2 >= len(self._modes))):
+            self._compact()
+        return items
+
+    def first_job_id(self):
+        """ Return the job ID of the oldest route in the queue """
+
+        return self._job_ids[self._head]
+
+    def last_job_id(self):
+        """ Return the job ID of the newest route in the queue """
+
+        return self._job_ids[-1]
+
+    def clear(self):
+        """ Remove every route from the queue """
+
+        self._truncate(0)
+
+    def job_ids(self):
+        """ Return the job IDs of the queued routes, oldest first, as an
+        array.array that must not be modified """
+
+        return self._job_ids[self._head:]
+
+    def dump(self, f):
+        """ Write the queue to a file in a binary format that can be loaded
+        back without decoding any route
+
+        Args:
+            f: A file object opened in binary mode
+        """
+
+        self._compact()
+        header = json.dumps({
+            "routes": len(self),
+            "blob_base": self._blob_base,
+            "blob_bytes": len(self._blobs),
+            "modes": self._mode_table,
+            "schemas": self._schema_table,
+            "zdict": (
+                None if (self._zdict is None)
+                else base64.b64encode(self._zdict).decode("ascii")
+            )
+        }).encode("utf-8")
+        f.write(DUMP_MAGIC)
+        f.write(DUMP_HEADER.pack(len(header)))
+        f.write(header)
+        for column in self._columns():
+            if (sys.byteorder == "big"):
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            column.tofile(f)
+        f.write(self._blobs)
+
+    @classmethod
+    def load(cls, f):
+        """ Read a queue written by ColumnarQueue.dump
+
+        Args:
+            f: A file object opened in binary mode
+
+        Returns:
+            A ColumnarQueue
+        """
+
+        if (f.read(len(DUMP_MAGIC)) != DUMP_MAGIC):
+            raise ValueError("Not a TNRA queue dump")
+        (header_size, ) = DUMP_HEADER.unpack(f.read(DUMP_HEADER.size))
+        header = json.loads(f.read(header_size).decode("utf-8"))
+
+        queue = cls()
+        n = header["routes"]
+        for (column, size) in zip(queue._columns(),
+                                  (n * protocol.ROUTE_COORDS, n, n, n, n, n)):
+            column.fromfile(f, size)
+            if (sys.byteorder == "big"):
+                column.byteswap()
+        queue._blob_base = header["blob_base"]
+        queue._blobs = bytearray(f.read(header["blob_bytes"]))
+        if (len(queue._blobs) != header["blob_bytes"]):
+            raise ValueError("Truncated TNRA queue dump")
+
+        for mode in header["modes"]:
+            queue._intern(mode, queue._mode_table, queue._mode_ids)
+        for (has_mode, kwarg_keys, has_attributes, attribute_keys) in \
+                header["schemas"]:
+            if (attribute_keys is not None):
+                attribute_keys = tuple(attribute_keys)
+            queue._intern(
+                (has_mode, tuple(kwarg_keys), has_attributes, attribute_keys),
+                queue._schema_table, queue._schema_ids
+            )
+        if (header["zdict"] is not None):
+            queue._set_dictionary(base64.b64decode(header["zdict"]))
+        return queue
+
+    def _columns(self):
+        """ Return every typed column, in the order that they are dumped """
+
+        return (self._coords, self._job_ids, self._modes, self._schemas,
+                self._flags, self._offsets)
+
+    def _intern(self, value, table, ids):
+        """ Return the index of a value in a table, adding it if needed """
+
+        if (value not in ids):
+            if (len(table) >= 65536):
+                raise OverflowError("Too many distinct values to intern")
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    def _compress(self, blob):
+        """ Compress a blob with the shared dictionary, if it is available and
+        if doing so makes the blob smaller
+
+        Returns:
+            A (blob, compressed) tuple, where compressed is 1 if the returned
+            blob is compressed and 0 otherwise
+        """
+
+        if (len(blob) == 0):
+            return (blob, 0)
+
+        if (self._compressor is None):
+            self._samples.append(blob)
+            if (len(self._samples) >= DICTIONARY_SAMPLE_SIZE):
+                self._set_dictionary(
+                    b"".join(self._samples)[-DICTIONARY_SIZE:]
+                )
+            return (blob, 0)
+
+        compressor = self._compressor.copy()
+        compressed = compressor.compress(blob) + compressor.flush()
+        if (len(compressed) < len(blob)):
+            return (compressed, 1)
+        return (blob, 0)
+
+    def _set_dictionary(self, zdict):
+        """ Start compressing blobs with the given shared dictionary """
+
+        self._zdict = zdict
+        self._compressor = zlib.compressobj(
+            COMPRESSION_LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEMORY_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+        self._samples = []
+
+    def _get(self, i):
+        """ Decode the route at index i of the columns """
+
+        start = self._offsets[i] - self._blob_base
+        if (i + 1 < len(self._offsets)):
+            end = self._offsets[i + 1] - self._blob_base
+        else:
+            end = len(self._blobs)
+        blob = bytes(self._blobs[start:end])
+        if (self._flags[i]):
+            decompressor = zlib.decompressobj(-WINDOW_BITS, self._zdict)
+            blob = decompressor.decompress(blob) + decompressor.flush()
+
+        (has_mode, kwarg_keys, has_attributes, attribute_keys) = \
+            self._schema_table[self._schemas[i]]
+        kwargs = {}
+        if (self._job_ids[i] != protocol.NO_JOB_ID):
+            kwargs["job_id"] = self._job_ids[i]
+        if (has_mode):
+            kwargs["mode"] = self._mode_table[self._modes[i]]
+        if (len(blob) > 0):
+            (kwarg_values, attributes) = json.loads(blob.decode("utf-8"))
+            kwargs.update(zip(kwarg_keys, kwarg_values))
+            if (has_attributes):
+                if (attribute_keys is not None):
+                    attributes = dict(zip(attribute_keys, attributes))
+                kwargs["attributes"] = attributes
+
+        n_coords = protocol.ROUTE_COORDS
+        args = tuple(self._coords[i * n_coords:(i + 1) * n_coords])
+        return (args, kwargs)
+
+    def _compact(self):
+        """ Remove the routes that were popped from the front from the columns
+        """
+
+        head = self._head
+        if (head == 0):
+            return
+        del self._coords[:head * protocol.ROUTE_COORDS]
+        del self._job_ids[:head]
+        del self._modes[:head]
+        del self._schemas[:head]
+        del self._flags[:head]
+        del self._offsets[:head]
+        self._head = 0
+        if (len(self._offsets) > 0):
+            del self._blobs[:self._offsets[0] - self._blob_base]
+            self._blob_base = self._offsets[0]
+
+    def _truncate(self, i):
+        """ Remove every route from index i of the columns onwards """
+
+        if (i >= len(self._modes)):
+            return
+        if (i <= self._head):
+            # nothing is left, so the routes before the head go too
+            i = 0
+            self._head = 0
+            self._blob_base = 0
+            del self._blobs[:]
+        else:
+            del self._blobs[self._offsets[i] - self._blob_base:]
+        del self._coords[i * protocol.ROUTE_COORDS:]
+        del self._job_ids[i:]
+        del self._modes[i:]
+        del self._schemas[i:]
+        del self._flags[i:]
+        del self._offsets[i:]
+
+class PriorityQueue(object):
+
+    """ Queue of routes that pops routes with the highest "priority" keyword
+    argument first, and routes with equal priorities oldest first
+
+    Routes are kept in one FIFO ColumnarQueue per priority, and the
+    priorities that have routes are kept in a heap, so popping a route is
+    O(log p) for p distinct priorities.
+    """
+
+    def __init__(self):
+        self._levels = {}  # priority -> ColumnarQueue
+        self._heap = []    # negated priorities that have routes
+
+    def __len__(self):
+        return sum(len(level) for level in self._levels.values())
+
+    def __iter__(self):
+        """ Iterate over queued routes from lowest to highest priority """
+
+        for priority in sorted(self._levels):
+            for item in self._levels[priority]:
+                yield item
+
+    def nbytes(self):
+        return sum(level.nbytes() for level in self._levels.values())
+
+    def append(self, item):
+        priority = item[1].get("priority", 0)
+        if (priority not in self._levels):
+            self._levels[priority] = ColumnarQueue()
+            heapq.heappush(self._heap, -priority)
+        self._levels[priority].append(item)
+
+    def pop_many(self, n):
+        """ Remove and return up to n of the routes with the highest priority,
+        highest priority first """
+
+        items = []
+        while ((len(items) < n) and (len(self._heap) > 0)):
+            priority = -self._heap[0]
+            level = self._levels[priority]
+            items.extend(level.popleft_many(n - len(items)))
+            if (len(level) == 0):
+                heapq.heappop(self._heap)
+                del self._levels[priority]
+        return items
+
+    def next_key(self):
+        """ Return a key that is larger for queues whose next route should be
+        popped first """
+
+        priority = -self._heap[0]
+        return (priority, -self._levels[priority].first_job_id())
+
+    def job_ids(self):
+        return itertools.chain.from_iterable(
+            level.job_ids() for level in self._levels.values()
+        )
+
+    def clear(self):
+        self._levels = {}
+        self._heap = []
+
+    def columnar_queues(self):
+        """ Return the (priority, ColumnarQueue) of every priority """
+
+        return list(self._levels.items())
+
+class JobQueue(object):
+
+    """ A named queue of routes, popped in FIFO, LIFO or priority order
+
+    Routes are sharded by their mode into separate queues, so that workers
+    can pop only the routes of the modes that they support. Within a queue,
+    the order holds across shards: the shard whose next route comes first is
+    popped from, using job IDs to tell which route is older.
+
+    Attributes:
+        name: The name of the queue
+        ordering: One of ORDERINGS
+        priority: Routes are popped from queues with higher priorities first
+    """
+
+    def __init__(self, name, ordering = DEFAULT_ORDERING, priority = 0):
+        if (ordering not in ORDERINGS):
+            raise ValueError("Unknown ordering %s" % ordering)
+        self.name = name
+        self.ordering = ordering
+        self.priority = priority
+        self._shards = {} # mode -> ColumnarQueue or PriorityQueue
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards.values())
+
+    def __iter__(self):
+        for shard in self._shards.values():
+            for item in shard:
+                yield item
+
+    def nbytes(self):
+        return sum(shard.nbytes() for shard in self._shards.values())
+
+    def modes(self):
+        """ Return the modes of the routes in the queue """
+
+        return [mode for (mode, shard) in self._shards.items() if (shard)]
+
+    def append(self, item):
+        mode = item[1].get("mode")
+        if (mode not in self._shards):
+            if (self.ordering == "priority"):
+                self._shards[mode] = PriorityQueue()
+            else:
+                self._shards[mode] = ColumnarQueue()
+        self._shards[mode].append(item)
+
+    def pop_many(self, n, modes = None):
+        """ Remove and return up to n routes, in the order of the queue
+
+        Args:
+            n: The maximum number of routes to pop
+            modes: A list of the modes of the routes to pop, or None to pop
+                routes of any mode
+
+        Returns:
+            A list of (args, kwargs) tuples
+        """
+
+        shards = [
+            shard for (mode, shard) in self._shards.items()
+            if ((len(shard) > 0) and ((modes is None) or (mode in modes)))
+        ]
+        if (len(shards) == 1):
+            return self._pop_shard(shards[0], n)
+
+        items = []
+        while ((len(items) < n) and (len(shards) > 0)):
+            shard = max(shards, key = self._next_key)
+            items.extend(self._pop_shard(shard, 1))
+            if (len(shard) == 0):
+                shards.remove(shard)
+        return items
+
+    def job_ids(self):
+        return itertools.chain.from_iterable(
+            shard.job_ids() for shard in self._shards.values()
+        )
+
+    def clear(self):
+        self._shards = {}
+
+    def columnar_queues(self):
+        """ Return the (mode, priority, ColumnarQueue) of every shard, where
+        priority is None unless the queue is a priority queue """
+
+        columnar_queues = []
+        for (mode, shard) in self._shards.items():
+            if (self.ordering == "priority"):
+                columnar_queues.extend(
+                    (mode, priority, level)
+                    for (priority, level) in shard.columnar_queues()
+                )
+            else:
+                columnar_queues.append((mode, None, shard))
+        return columnar_queues
+
+    def _next_key(self, shard):
+        if (self.ordering == "lifo"):
+            return shard.last_job_id()
+        elif (self.ordering == "fifo"):
+            return -shard.first_job_id()
+        return shard.next_key()
+
+    def _pop_shard(self, shard, n):
+        if (self.ordering == "fifo"):
+            return shard.popleft_many(n)
+        return shard.pop_many(n)
+
+class QueueSet(object):
+
+    """ The set of named JobQueues on a server
+
+    Routes are added to the queue named by their "queue" keyword argument, or
+    to DEFAULT_QUEUE; queues that do not exist yet are created with the
+    default ordering. Routes are popped from the queues with the highest
+    priority first, and from queues with equal priorities in the order that
+    they were created.
+    """
+
+    def __init__(self):
+        self._queues = collections.OrderedDict()
+        self.create(DEFAULT_QUEUE)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def __iter__(self):
+        for queue in self._queues.values():
+            for item in queue:
+                yield item
+
+    def __contains__(self, name):
+        return name in self._queues
+
+    def __getitem__(self, name):
+        return self._queues[name]
+
+    def names(self):
+        return list(self._queues)
+
+    def nbytes(self):
+        return sum(queue.nbytes() for queue in self._queues.values())
+
+    def create(self, name, ordering = DEFAULT_ORDERING, priority = 0):
+        """ Create a queue, or change the priority of an existing one
+
+        Raises:
+            ValueError: The queue exists with a different ordering and is not
+                empty
+        """
+
+        queue = self._queues.get(name)
+        if ((queue is not None) and (queue.ordering != ordering)):
+            if (len(queue) > 0):
+                raise ValueError(
+                    "Queue %s is not empty and is %s, not %s" % (
+                        name, queue.ordering, ordering
+                    )
+                )
+            queue = None
+        if (queue is None):
+            queue = JobQueue(name, ordering, priority)
+            self._queues[name] = queue
+        queue.priority = priority
+        return queue
+
+    def drop(self, name):
+        """ Remove a queue and every route in it """
+
+        if (name == DEFAULT_QUEUE):
+            self._queues[name].clear()
+        else:
+            self._queues.pop(name, None)
+
+    def append(self, item):
+        name = item[1].get("queue", DEFAULT_QUEUE)
+        if (name not in self._queues):
+            self.create(name)
+        self._queues[name].append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def pop_many(self, n, names = None, modes = None):
+        """ Remove and return up to n routes
+
+        Args:
+            n: The maximum number of routes to pop
+            names: A list of the names of the queues to pop from, or None to
+                pop from every queue
+            modes: A list of the modes of the routes to pop, or None to pop
+                routes of any mode
+
+        Returns:
+            A list of (args, kwargs) tuples
+        """
+
+        queues = [
+            queue for queue in self._queues.values()
+            if ((names is None) or (queue.name in names))
+        ]
+        queues.sort(key = lambda queue: -queue.priority)
+
+        items = []
+        for queue in queues:
+            if (len(items) >= n):
+                break
+            items.extend(queue.pop_many(n - len(items), modes))
+        return items
+
+    def job_ids(self):
+        return itertools.chain.from_iterable(
+            queue.job_ids() for queue in self._queues.values()
+        )
+
+    def clear(self):
+        for queue in self._queues.values():
+            queue.clear()
+
+    def dump(self, f):
+        """ Write every queue to a file; see ColumnarQueue.dump
+
+        Args:
+            f: A file object opened in binary mode
+        """
+
+        layout = []
+        columnar_queues = []
+        for queue in self._queues.values():
+            shards = queue.columnar_queues()
+            layout.append([
+                queue.name, queue.ordering, queue.priority,
+                [[mode, priority] for (mode, priority, shard) in shards]
+            ])
+            columnar_queues.extend(shard for (mode, priority, shard) in shards)
+
+        header = json.dumps(layout).encode("utf-8")
+        f.write(QUEUE_SET_MAGIC)
+        f.write(DUMP_HEADER.pack(len(header)))
+        f.write(header)
+        for shard in columnar_queues:
+            shard.dump(f)
+
+    @classmethod
+    def load(cls, f):
+        """ Read queues written by QueueSet.dump
+
+        Args:
+            f: A file object opened in binary mode
+
+        Returns:
+            A QueueSet
+        """
+
+        if (f.read(len(QUEUE_SET_MAGIC)) != QUEUE_SET_MAGIC):
+            raise ValueError("Not a TNRA queue set dump")
+        (header_size, ) = DUMP_HEADER.unpack(f.read(DUMP_HEADER.size))
+        layout = json.loads(f.read(header_size).decode("utf-8"))
+
+        queue_set = cls()
+        for (name, ordering, priority, shards) in layout:
+            queue = queue_set.create(name, ordering, priority)
+            for (mode, shard_priority) in shards:
+                shard = ColumnarQueue.load(f)
+                if (shard_priority is None):
+                    queue._shards[mode] = shard
+                else:
+                    if (mode not in queue._shards):
+                        queue._shards[mode] = PriorityQueue()
+                    levels = queue._shards[mode]
+                    levels._levels[shard_priority] = shard
+                    heapq.heappush(levels._heap, -shard_priority)
+        return queue_set
+
+class KeyIndex(object):
+
+    """ Hash table of 64-bit keys -> job IDs stored in typed arrays
+
+    Used by the server to find the job of a deduplicated route without keeping
+    a Python object per route. Keys are nonzero unsigned 64-bit integers,
+    i.e. digests, and job IDs are nonnegative integers. Slots are probed
+    linearly; removed entries keep their key with a job ID of -1 until the
+    table is resized, so that probing does not stop at them.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def nbytes(self):
+        """ Return the number of bytes used by the slots of the index """
+
+        return (self._keys.itemsize + self._job_ids.itemsize) * len(self._keys)
+
+    def get(self, key, default = None):
+        i = self._slot(key)
+        if ((self._keys[i] != key) or (self._job_ids[i] < 0)):
+            return default
+        return self._job_ids[i]
+
+    def __setitem__(self, key, job_id):
+        i = self._slot(key)
+        if (self._keys[i] != key):
+            self._keys[i] = key
+            self._used += 1
+        if (self._job_ids[i] < 0):
+            self._size += 1
+        self._job_ids[i] = job_id
+        if (self._used * 2 > len(self._keys)):
+            self._resize()
+
+    def pop(self, key, default = None):
+        i = self._slot(key)
+        if ((self._keys[i] != key) or (self._job_ids[i] < 0)):
+            return default
+        job_id = self._job_ids[i]
+        self._job_ids[i] = -1
+        self._size -= 1
+        return job_id
+
+    def clear(self):
+        self._keys = array.array("Q", bytes(8 * KEY_INDEX_MIN_SLOTS))
+        self._job_ids = array.array("q", [-1]) * KEY_INDEX_MIN_SLOTS
+        self._size = 0 # live entries
+        self._used = 0 # live and removed entries
+
+    def _slot(self, key):
+        """ Return the slot that holds a key, or the empty slot that it would
+        be put in """
+
+        mask = len(self._keys) - 1
+        i = key & mask
+        while ((self._keys[i] != 0) and (self._keys[i] != key)):
+            i = (i + 1) & mask
+        return i
+
+    def _resize(self):
+        """ Rehash the live entries into a table at most a quarter full """
+
+        items = [
+            (key, job_id)
+            for (key, job_id) in zip(self._keys, self._job_ids)
+            if (job_id >= 0)
+        ]
+        slots = KEY_INDEX_MIN_SLOTS
+        while (slots < 4 * len(items)):
+            slots *= 2
+        self._keys = array.array("Q", bytes(8 * slots))
+        self._job_ids = array.array("q", [-1]) * slots
+        self._size = 0
+        self._used = 0
+        for (key, job_id) in items:
+            self[key] = job_id
+
+class MatrixJob(object):
+
+    """ Every route between a set of origins and a set of destinations,
+    expanded into routes only as they are needed
+
+    Only the coordinates and attributes of the origins and destinations are
+    stored, along with the position of the next route to expand, so a job
+    takes memory proportional to the number of origins plus the number of
+    destinations rather than to their product. Routes are expanded origin by
+    origin, and every route gets the keyword arguments of the job.
+
+    The attributes of a route are the attributes of its origin updated with
+    those of its destination, where the attributes of an origin or
+    destination without any are {"origin": i} or {"destination": j}, i and j
+    being its index.
+
+    Attributes:
+        kwargs: The keyword arguments shared by every route (i.e. mode)
+        position: The index of the next route to expand
+    """
+
+    def __init__(self, origins, destinations, kwargs = None,
+                 origin_attributes = None, destination_attributes = None,
+                 position = 0):
+        """ Initializes MatrixJob object
+
+        Args:
+            origins, destinations: Iterables of (x, y) coordinates
+            kwargs: Keyword arguments shared by every route
+            origin_attributes, destination_attributes: Lists of dicts of
+                attributes with one item per origin or destination, or None
+            position: The number of routes that have already been expanded
+        """
+
+        self.origins = array.array("d")
+        for coords in origins:
+            self.origins.extend(coords)
+        self.destinations = array.array("d")
+        for coords in destinations:
+            self.destinations.extend(coords)
+        if ((len(self.origins) % 2) or (len(self.destinations) % 2)):
+            raise ValueError("Origins and destinations must be (x, y) pairs")
+
+        self.kwargs = dict(kwargs or {})
+        self.origin_attributes = _matrix_attributes(
+            origin_attributes, len(self.origins) // 2, "origin"
+        )
+        self.destination_attributes = _matrix_attributes(
+            destination_attributes, len(self.destinations) // 2,
+            "destination"
+        )
+        self.position = position
+
+    def __len__(self):
+        """ Return the number of routes that have not been expanded yet """
+
+        return self.size() - self.position
+
+    def size(self):
+        """ Return the number of routes in the job """
+
+        return (len(self.origins) // 2) * (len(self.destinations) // 2)
+
+    def take(self, n):
+        """ Expand up to n routes
+
+        Args:
+            n: The maximum number of routes to expand
+
+        Returns:
+            A list of (args, kwargs) tuples
+        """
+
+        n_destinations = len(self.destinations) // 2
+        end = min(self.position + n, self.size())
+        items = []
+        for k in range(self.position, end):
+            (i, j) = divmod(k, n_destinations)
+            kwargs = dict(self.kwargs)
+            attributes = dict(self.origin_attributes[i] or {"origin": i})
+            attributes.update(
+                self.destination_attributes[j] or {"destination": j}
+            )
+            kwargs["attributes"] = attributes
+            items.append((
+                (self.origins[2 * i], self.origins[2 * i + 1],
+                 self.destinations[2 * j], self.destinations[2 * j + 1]),
+                kwargs
+            ))
+        self.position = end
+        return items
+
+    def to_dict(self):
+        """ Return a JSON serializable representation of the job """
+
+        return {
+            "origins": _pack_coords(self.origins),
+            "destinations": _pack_coords(self.destinations),
+            "kwargs": self.kwargs,
+            "origin_attributes": self.origin_attributes,
+            "destination_attributes": self.destination_attributes,
+            "position": self.position
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a job from the output of to_dict """
+
+        job = cls(
+            [], [], data["kwargs"], position = data["position"]
+        )
+        job.origins = _unpack_coords(data["origins"])
+        job.destinations = _unpack_coords(data["destinations"])
+        job.origin_attributes = data["origin_attributes"]
+        job.destination_attributes = data["destination_attributes"]
+        return job
+
+def _matrix_attributes(attributes, n, name):
+    """ Check that there is an item of attributes per origin or destination,
+    returning a list of n Nones if there are no attributes """
+
+    if (attributes is None):
+        return [None] * n
+    attributes = list(attributes)
+    if (len(attributes) != n):
+        raise ValueError("%d %s attributes for %d %ss" % (
+            len(attributes), name, n, name
+        ))
+    return attributes
+
+def _pack_coords(coords):
+    """ Encode an array of doubles as little-endian base64 text """
+
+    if (sys.byteorder == "big"):
+        coords = array.array("d", coords)
+        coords.byteswap()
+    return base64.b64encode(coords.tobytes()).decode("ascii")
+
+def _unpack_coords(text):
+    coords = array.array("d")
+    coords.frombytes(base64.b64decode(text))
+    if (sys.byteorder == "big"):
+        coords.byteswap()
+    return coords
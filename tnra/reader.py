@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# lazy reader for TNRA output files
+
+import array
+import json
+import mmap
+import multiprocessing
+import os
+
+from . import blockfile
+
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024 # bytes of lines per unit of work
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+def _skip_whitespace(s, i):
+    while ((i < len(s)) and (s[i] in _WHITESPACE)):
+        i += 1
+    return i
+
+def parse_fields(line, fields = None):
+    """ Parse the top-level fields of a JSON record, stopping as soon as every
+    requested field has been found
+
+    TNRA records put the small fields (attributes, duration and distance)
+    before the raw routing response, so projecting onto the small fields never
+    parses the response.
+
+    Args:
+        line: The JSON record, as str
+        fields: An iterable of top-level keys to return, or None to parse and
+            return the whole record
+
+    Returns:
+        A dict of the requested fields that are in the record
+    """
+
+    if (fields is None):
+        return json.loads(line)
+
+    remaining = set(fields)
+    record = {}
+    i = _skip_whitespace(line, 0)
+    if (line[i:i + 1] != "{"):
+        raise ValueError("Record is not a JSON object")
+    i = _skip_whitespace(line, i + 1)
+    if (line[i:i + 1] == "}"):
+        return record
+
+    while (remaining):
+        if (line[i:i + 1] != "\""):
+            raise ValueError("Expected a key at position %d" % i)
+        (key, i) = json.decoder.scanstring(line, i + 1)
+        i = _skip_whitespace(line, i)
+        if (line[i:i + 1] != ":"):
+            raise ValueError("Expected ':' at position %d" % i)
+        i = _skip_whitespace(line, i + 1)
+        (value, i) = _DECODER.raw_decode(line, i)
+        if (key in remaining):
+            record[key] = value
+            remaining.remove(key)
+        i = _skip_whitespace(line, i)
+        if (line[i:i + 1] == ","):
+            i = _skip_whitespace(line, i + 1)
+        elif (line[i:i + 1] == "}"):
+            break
+        else:
+            raise ValueError("Expected ',' or '}' at position %d" % i)
+    return record
+
+class _Query(object):
+
+    """ A projection and filter applied to the lines of a file; kept separate
+    from Reader so that it can be sent to worker processes """
+
+    def __init__(self, fields = None, where = None):
+        self.fields = None if (fields is None) else list(fields)
+        self.where = where
+
+        # each equality filter needs its JSON encoded value to appear
+        # somewhere in a line, which rules out most lines without parsing them
+        if (isinstance(where, dict)):
+            self._needles = [
+                json.dumps(value).encode("utf-8") for value in where.values()
+            ]
+        else:
+            self._needles = []
+
+    def apply(self, line):
+        """ Return the projected record of a line, or None if the line is
+        blank or does not pass the filter """
+
+        for needle in self._needles:
+            if (needle not in line):
+                return None
+
+        line = line.decode("utf-8")
+        if (len(line.strip()) == 0):
+            return None
+
+        if (self.where is not None):
+            attributes = parse_fields(line, ["attributes"]).get("attributes")
+            if (not self._match(attributes)):
+                return None
+
+        record = parse_fields(line, self.fields)
+        if (self.fields is not None):
+            return {field: record.get(field) for field in self.fields}
+        return record
+
+    def _match(self, attributes):
+        if (callable(self.where)):
+            return self.where(attributes)
+        if (not isinstance(attributes, dict)):
+            return False
+        for (key, value) in self.where.items():
+            if ((key not in attributes) or (attributes[key] != value)):
+                return False
+        return True
+
+def _line_offsets(args):
+    """ Return the offsets of the lines starting in [start, end) of a file """
+
+    (path, start, end) = args
+    offsets = array.array("Q")
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        i = start
+        while (i < end):
+            offsets.append(i)
+            i = data.find(b"\n", i, end)
+            if (i == -1):
+                break
+            i += 1
+    return offsets
+
+def _read_chunk(args):
+    """ Return the projected records of the lines in [start, end) of a file,
+    or of a block of a block file """
+
+    (path, start, end, query) = args
+    if (end is None):
+        lines = blockfile._read_block((path, start[0], start[1]))
+    else:
+        with open(path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            lines = data[start:end].split(b"\n")
+
+    records = []
+    for line in lines:
+        record = query.apply(line)
+        if (record is not None):
+            records.append(record)
+    return records
+
+class Reader(object):
+
+    """ Reads TNRA output files lazily
+
+    Both one-JSON-per-line files and block files (see tnra.blockfile) are
+    supported. Plain files are memory-mapped and split into chunks of about
+    chunk_bytes at line boundaries, and block files are split into their
+    blocks; chunks are then parsed in order, by a pool of processes if
+    processes is greater than 1.
+
+    Records can be projected onto a few top-level fields, i.e.
+    ["attributes", "duration", "distance"], in which case the routing response
+    is never parsed, and filtered on their attributes before the rest of the
+    record is parsed.
+
+    Example:
+        reader = tnra.Reader("routes.json", processes = 8)
+        for record in reader.records(
+                fields = ["duration", "distance"],
+                where = {"destination_name": "harvard university"}):
+            print(record["duration"])
+    """
+
+    def __init__(self, path, processes = 1,
+                 chunk_bytes = DEFAULT_CHUNK_BYTES):
+        """ Initializes Reader object
+
+        Args:
+            path: The path to the output file
+            processes: The number of processes to parse records with
+            chunk_bytes: The approximate number of bytes in a chunk of a plain
+                output file
+        """
+
+        self.path = path
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        self.size = os.path.getsize(path)
+        self.is_block_file = (
+            (self.size > 0) and blockfile.is_block_file(path)
+        )
+
+        self._blocks = None
+        self._offsets = None
+        if (self.is_block_file):
+            self._blocks = blockfile.BlockReader(path)
+
+    def __len__(self):
+        if (self._blocks is not None):
+            return len(self._blocks)
+        return len(self.offsets())
+
+    def __iter__(self):
+        return self.records()
+
+    def __getitem__(self, n):
+        """ Return record n, parsed in full, reading only that record """
+
+        if (self._blocks is not None):
+            line = self._blocks.record(n)
+        else:
+            offsets = self.offsets()
+            start = offsets[n]
+            if (n + 1 < len(offsets)):
+                end = offsets[n + 1]
+            else:
+                end = self.size
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                line = f.read(end - start)
+        return json.loads(line.decode("utf-8"))
+
+    def chunks(self):
+        """ Return the units of work that the file is split into
+
+        Returns:
+            A list of (start, end) byte ranges, each of which starts at the
+            start of a line and ends just past a newline or at the end of the
+            file; or for block files, a list of ((offset, compressed size),
+            None) tuples, one per block
+        """
+
+        if (self._blocks is not None):
+            return [
+                ((offset, compressed_size), None)
+                for (offset, compressed_size, n_records) in self._blocks.index
+            ]
+
+        chunks = []
+        with open(self.path, "rb") as f:
+            if (self.size == 0):
+                return chunks
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                start = 0
+                while (start < self.size):
+                    end = data.find(b"\n", start + self.chunk_bytes)
+                    end = self.size if (end == -1) else end + 1
+                    chunks.append((start, end))
+                    start = end
+        return chunks
+
+    def offsets(self):
+        """ Return the byte offset of the start of every line of a plain
+        output file, building the index on first use
+
+        Returns:
+            An array.array of offsets
+        """
+
+        if (self._blocks is not None):
+            raise TypeError("Block files are indexed by block, not by line")
+        if (self._offsets is None):
+            offsets = array.array("Q")
+            for chunk_offsets in self._map(_line_offsets, [
+                        (self.path, start, end)
+                        for (start, end) in self.chunks()
+                    ]):
+                offsets.extend(chunk_offsets)
+            self._offsets = offsets
+        return self._offsets
+
+    def records(self, fields = None, where = None):
+        """ Iterate over the records of the file, in order
+
+        Args:
+            fields: A list of top-level fields to yield, i.e. ["attributes",
+                "duration", "distance"], or None to yield whole records;
+                fields missing from a record are None
+            where: Either a dict of attribute values that a record's
+                attributes must equal, or a function that takes a record's
+                attributes and returns whether or not to keep the record; with
+                more than one process, the function must be defined at the
+                top level of a module so that it can be pickled
+
+        Yields:
+            Records, as dicts
+        """
+
+        query = _Query(fields, where)
+        args = [(self.path, start, end, query) for (start, end) in self.chunks()]
+        for records in self._map(_read_chunk, args):
+            for record in records:
+                yield record
+
+    def _map(self, function, args):
+        """ Apply a function to a list of arguments, lazily and in order,
+        using a pool of processes if configured to """
+
+        if ((self.processes <= 1) or (len(args) <= 1)):
+            for arg in args:
+                yield function(arg)
+        else:
+            with multiprocessing.Pool(self.processes) as pool:
+                for result in pool.imap(function, args):
+                    yield result
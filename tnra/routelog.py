@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# buffered per-process route logs, and a tool to merge them
+#
+# Every router process writes its own log, named after the configured route log
+# path with the host name and process ID of the process added, i.e.
+# routing_logs.json becomes routing_logs.node1-4242.json. Records are buffered
+# in memory and appended with one write call once flush_bytes have been
+# buffered or flush_interval seconds have passed since the last flush, so
+# processes never share a file and routes cost no system calls of their own.
+
+import argparse
+import glob
+import heapq
+import json
+import os
+import socket
+import threading
+import time
+
+DEFAULT_FLUSH_BYTES = 1024 * 1024 # flush once this many bytes are buffered
+DEFAULT_FLUSH_INTERVAL = 5.0      # or once the last flush is this old
+
+def worker_log_path(path, worker = None):
+    """ Return the path of the log of a process
+
+    Args:
+        path: The configured route log path
+        worker: A name that identifies the process, by default its host name
+            and process ID
+
+    Returns:
+        The path with the worker name added before its extension
+    """
+
+    if (worker is None):
+        worker = "%s-%d" % (socket.gethostname(), os.getpid())
+    (root, extension) = os.path.splitext(path)
+    return "%s.%s%s" % (root, worker, extension)
+
+def worker_log_paths(path):
+    """ Return the paths of the logs of every process that logged to the given
+    route log path, along with the path itself if it exists """
+
+    (root, extension) = os.path.splitext(path)
+    paths = sorted(glob.glob("%s.*%s" % (glob.escape(root), extension)))
+    if (os.path.exists(path)):
+        paths.insert(0, path)
+    return paths
+
+class RouteLog(object):
+
+    """ Buffered log of routes, written as one JSON per line
+
+    Safe to write to from many threads.
+
+    Attributes:
+        path: The path of the log
+    """
+
+    def __init__(self, path, flush_bytes = DEFAULT_FLUSH_BYTES,
+                 flush_interval = DEFAULT_FLUSH_INTERVAL):
+        """ Initializes RouteLog object
+
+        Args:
+            path: The path of the log, which is appended to
+            flush_bytes: The number of buffered bytes that triggers a flush
+            flush_interval: The number of seconds after a flush that the next
+                write triggers a flush
+        """
+
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._last_flush = time.time()
+
+    def write(self, record):
+        """ Buffer a record
+
+        Args:
+            record: A JSON serializable dict
+        """
+
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            self._buffer_bytes += len(line)
+            if ((self._buffer_bytes >= self.flush_bytes)
+                    or (time.time() - self._last_flush >= self.flush_interval)):
+                self._flush()
+
+    def flush(self):
+        """ Append every buffered record to the log """
+
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _flush(self):
+        self._last_flush = time.time()
+        if (len(self._buffer) == 0):
+            return
+        with open(self.path, "a") as f:
+            f.write("".join(self._buffer))
+        self._buffer = []
+        self._buffer_bytes = 0
+
+def _records(path):
+    with open(path) as f:
+        for line in f:
+            if (len(line.strip()) > 0):
+                yield json.loads(line)
+
+def merge(paths, output):
+    """ Merge route logs into one log, ordered by time
+
+    Every log is expected to be ordered by time, up to the few records that
+    the threads of a router may write out of order; the logs are merged
+    without being read into memory.
+
+    Args:
+        paths: The paths of the logs to merge
+        output: The path to write the merged log to
+
+    Returns:
+        The number of records merged
+    """
+
+    n = 0
+    with open(output, "w") as f:
+        for record in heapq.merge(
+                    *[_records(path) for path in paths],
+                    key = lambda record: record["time"]
+                ):
+            f.write(json.dumps(record))
+            f.write("\n")
+            n += 1
+    return n
+
+def start_merge():
+    parser = argparse.ArgumentParser(
+        description = "Merge the route logs of every router process"
+    )
+    parser.add_argument("output", help = "The path of the merged log")
+    parser.add_argument("logs", nargs = "*",
+                        help = "The logs to merge; by default, the logs of "
+                               "every process that logged to --path")
+    parser.add_argument("--path", default = "routing_logs.json",
+                        help = "The route log path that the routers were "
+                               "configured with")
+    parser.add_argument("--delete", action = "store_true",
+                        help = "Delete the merged logs afterwards")
+    args = parser.parse_args()
+
+    paths = args.logs or worker_log_paths(args.path)
+    paths = [
+        path for path in paths
+        if (os.path.abspath(path) != os.path.abspath(args.output))
+    ]
+    n = merge(paths, args.output)
+    print("Merged %d routes from %d logs into %s" % (
+        n, len(paths), args.output
+    ))
+    if (args.delete):
+        for path in paths:
+            os.remove(path)
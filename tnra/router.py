@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 # continuously pulls from the main node's queue and returns calculations
 
+import collections
+import concurrent.futures
 import datetime
-import json
+import functools
+import math
 import multiprocessing
+import multiprocessing.connection
 import os
+import sys
+import threading
 import time
 
 import route_distances
 
-from . import server
+from . import (
+    balancer, cache, controller, metrics, profiler, routelog, server
+)
 
 MAX_THREADS = multiprocessing.cpu_count()
 
@@ -19,6 +27,20 @@ DEPARTURE_HOUR = 11   # hour of day to stanrardize departures to
 ROUTE_LOGGING = True
 ROUTE_LOG_PATH = "routing_logs.json"
 
+CONCURRENCY = 1 # number of routes that each router calculates at once
+
+PREFETCH = True
+PREFETCH_MIN_SIZE = 1     # smallest number of jobs to keep buffered
+PREFETCH_MAX_SIZE = 500   # largest number of jobs to keep buffered
+PREFETCH_SECONDS = 2.0    # seconds of work to keep buffered
+PREFETCH_SMOOTHING = 0.1  # weight of the newest route latency in the average
+
+# once the queue is empty, routers keep polling the server while jobs are
+# leased, so that jobs whose leases expire are routed in the same run
+WAIT_FOR_LEASES = True
+LEASE_POLL_MIN_INTERVAL = 0.5 # seconds before the first poll
+LEASE_POLL_MAX_INTERVAL = 5.0 # longest number of seconds between polls
+
 VERBOSE = True
 
 HOURS_IN_DAY = 60 * 60 * 24
@@ -50,10 +72,218 @@ def next_weekday(datetime_now = None, desired_weekday = 3):
         datetime_now.timestamp() + timestamp_delta
     )
 
+def departure_datetime(weekday = DEPARTURE_WEEKDAY, hour = DEPARTURE_HOUR,
+                       today = None):
+    """ Find the departure time on the next given week day at the given hour
+
+    Departure times are cached per day, so that routes do not recompute them.
+
+    Args:
+        weekday: The ISO week day of departure; 1 = monday, 7 = sunday
+        hour: The hour of departure
+        today: The datetime.date to count from, or None for today
+
+    Returns:
+        A datetime.datetime object
+    """
+
+    if (today is None):
+        today = datetime.date.today()
+    return _departure_datetime(today, weekday, hour)
+
+@functools.lru_cache(maxsize = 1024)
+def _departure_datetime(today, weekday, hour):
+    day = today + datetime.timedelta(days = (weekday - today.isoweekday()) % 7)
+    return datetime.datetime(day.year, day.month, day.day, hour)
+
+def wait_for_leases(client, pop):
+    """ Keep popping from an empty queue, with a backoff, while the server
+    has jobs leased to workers, any of which may be requeued if its worker
+    dies before its lease expires
+
+    Args:
+        client: A tnra.Client connected to the server
+        pop: A function that pops from the queue and returns a falsy value
+            when it is empty
+
+    Returns:
+        What pop returned once it returned jobs, or once no jobs were leased
+    """
+
+    interval = LEASE_POLL_MIN_INTERVAL
+    while True:
+        stats = client.lease_stats()
+        if ((not stats) or (stats["leases"] == 0)):
+            # expired leases are requeued before they stop counting
+            return pop()
+        time.sleep(interval)
+        interval = min(2 * interval, LEASE_POLL_MAX_INTERVAL)
+        items = pop()
+        if (items):
+            return items
+
+class Prefetcher(threading.Thread):
+
+    """ Background thread that keeps a local buffer of jobs filled
+
+    Jobs are pulled from the server with queue_pop_many whenever the buffer
+    drops below half of its target size. The target size is the number of
+    jobs that are expected to take PREFETCH_SECONDS to route, based on a moving
+    average of observed route latencies and the number of routes that are
+    calculated at once.
+
+    Attributes:
+        size: The current target size of the buffer
+        latency: The moving average of route latencies, in seconds
+    """
+
+    def __init__(self, host = "localhost", port = server.DEFAULT_PORT,
+                 min_size = PREFETCH_MIN_SIZE, max_size = PREFETCH_MAX_SIZE,
+                 target_seconds = PREFETCH_SECONDS, queues = None,
+                 modes = None, concurrency = CONCURRENCY, slot = None,
+                 wait_for_leases = WAIT_FOR_LEASES):
+        """ Initializes Prefetcher object
+
+        Args:
+            host, port: The location of the TNRA server
+            min_size, max_size: Bounds on the target size of the buffer
+            target_seconds: The number of seconds of work to keep buffered
+            queues, modes: The queues and modes to pop jobs from; see
+                tnra.Client.queue_pop_many
+            concurrency: The number of routes that are calculated at once
+            slot: The tnra.controller.Slot of the router, if the number of
+                active routers is controlled; the buffer is not refilled while
+                the router is paused
+            wait_for_leases: Whether or not to keep polling an empty queue
+                while jobs are leased (see wait_for_leases)
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.queues = queues
+        self.modes = modes
+        self.concurrency = concurrency
+        self.slot = slot
+        self.wait_for_leases = wait_for_leases
+
+        self.size = min_size
+        self.latency = None
+
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._exhausted = False
+        self._stopped = False
+        self._error = None
+
+    def record_latency(self, seconds):
+        """ Update the moving average of route latencies and resize the buffer
+
+        Args:
+            seconds: The number of seconds that the last route took
+        """
+
+        with self._condition:
+            if (self.latency is None):
+                self.latency = seconds
+            else:
+                self.latency += PREFETCH_SMOOTHING * (seconds - self.latency)
+
+            size = math.ceil(
+                self.target_seconds * self.concurrency
+                / max(self.latency, 1e-6)
+            )
+            self.size = max(self.min_size, min(self.max_size, size))
+            self._condition.notify_all()
+
+    def get(self):
+        """ Take the next job from the buffer, waiting for a refill if needed
+
+        Returns:
+            An (args, kwargs) tuple, or None if the server queue is empty
+        """
+
+        with self._condition:
+            while ((len(self._buffer) == 0) and (not self._exhausted)):
+                self._condition.notify_all()
+                self._condition.wait()
+            if (self._error is not None):
+                raise self._error
+            if (len(self._buffer) > 0):
+                item = self._buffer.popleft()
+                self._condition.notify_all()
+                return item
+            return None
+
+    def stop(self):
+        """ Stop refilling the buffer, i.e. once routing has failed, so that
+        the thread exits and closes its connection to the server """
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self):
+        client = server.Client(self.host, self.port)
+        try:
+            while True:
+                with self._condition:
+                    while ((len(self._buffer) > self.size // 2)
+                            and (not self._stopped)):
+                        self._condition.wait()
+                    if (self._stopped):
+                        break
+                    n = self.size - len(self._buffer)
+
+                def pop():
+                    if (self.slot is not None):
+                        self.slot.wait()
+                    return client.queue_pop_many(n, self.queues, self.modes)
+
+                items = pop()
+                if ((not items) and self.wait_for_leases):
+                    items = wait_for_leases(client, pop)
+
+                with self._condition:
+                    if (items):
+                        self._buffer.extend(items)
+                    else:
+                        self._exhausted = True
+                    self._condition.notify_all()
+                if (not items):
+                    break
+        except Exception as err:
+            with self._condition:
+                self._error = err
+                self._exhausted = True
+                self._condition.notify_all()
+        finally:
+            client.close()
+
 class Router(object):
 
+    """ Worker that pulls jobs from the TNRA server and routes them
+
+    With a concurrency greater than 1, up to that many routes are calculated
+    at once on a pool of threads, so that one process can keep several
+    requests to the routing engine in flight. Each thread gets its own router
+    and route cache.
+    """
+
     def __init__(self, router, kwargs, route_logging = ROUTE_LOGGING,
-                 route_log_path = ROUTE_LOG_PATH):
+                 route_log_path = ROUTE_LOG_PATH, prefetch = PREFETCH,
+                 server_host = "localhost", server_port = server.DEFAULT_PORT,
+                 server_result_port = server.DEFAULT_RESULT_PORT,
+                 route_cache = None, queues = None, modes = None,
+                 concurrency = CONCURRENCY,
+                 report_interval = metrics.DEFAULT_REPORT_INTERVAL,
+                 profile = None, slot = None, endpoints = None,
+                 wait_for_leases = WAIT_FOR_LEASES):
         """ Initializes Router object
 
         Args:
@@ -63,44 +293,147 @@ class Router(object):
                 router, in the form of a dict (i.e.
                 {"entrypoint": "localhost:5000"}).
             route_logging: Whether or not to log all routes
-            route_log_pah: The path to log all routes to, if route_logging is True
+            route_log_path: The path to log all routes to, if route_logging is
+                True; every process logs to its own file, named after this
+                path (see tnra.routelog)
+            prefetch: Whether or not to keep a buffer of jobs that is refilled
+                in the background while routes are being calculated
+            server_host, server_port: The location of the TNRA server
+            server_result_port: The port that the TNRA server receives
+                results on
+            route_cache: Keyword arguments to be passed to the initialization
+                of a tnra.cache.RouteCache, in the form of a dict (i.e.
+                {"path": "boston.sqlite", "graph_id": "boston-2017-10"}), or
+                None to always route with the router
+            queues: The names of the server queues to take jobs from, or None
+                to take jobs from every queue
+            modes: The modes that the router supports, or None to take jobs
+                of every mode
+            concurrency: The number of routes to calculate at once
+            report_interval: The number of seconds between reports of route
+                metrics to the server
+            profile: Keyword arguments to be passed to the initialization of a
+                tnra.profiler.Profiler, in the form of a dict (i.e.
+                {"path": "profile.json", "sample_rate": 0.01}), or None to
+                not time the stages of routing
+            slot: The tnra.controller.Slot of the router, if the number of
+                active routers is controlled by start_routers; new jobs are
+                only taken while the router is active
+            endpoints: A tnra.balancer.EndpointPool of routing engines to
+                balance routes between, or None to route with the router
+                initialized with kwargs; every thread then has a router per
+                engine, initialized with kwargs and the entrypoint of the
+                engine
+            wait_for_leases: Whether or not to keep polling the server once
+                its queue is empty, for as long as jobs are leased to workers,
+                so that the jobs of workers that die are routed once their
+                leases expire (after the lease timeout of the server); if
+                not, the router returns as soon as the queue is empty
         """
 
-        self.client = server.Client()
-        self.calculator = router(**kwargs)
+        self.server_host = server_host
+        self.server_port = server_port
+        self.prefetch = prefetch
+        self.queues = queues
+        self.modes = modes
+        self.concurrency = concurrency
+        self.slot = slot
+        self.endpoints = endpoints
+        self.wait_for_leases = wait_for_leases
+        self.client = server.Client(server_host, server_port)
+        self.sink = server.ResultSink(server_host, server_result_port)
         self.logging = route_logging
         self.route_log_path = route_log_path
+        if (route_logging):
+            self.route_log = routelog.RouteLog(
+                routelog.worker_log_path(route_log_path)
+            )
+        else:
+            self.route_log = None
+        self.metrics = metrics.Metrics()
+        self.report_interval = report_interval
+        self._last_report = time.time()
+        if (profile is not None):
+            self.profiler = profiler.Profiler(**profile)
+        else:
+            self.profiler = None
+
+        self._router = router
+        self._router_kwargs = kwargs
+        self._route_cache_kwargs = route_cache
+        self._local = threading.local()
+        self._sink_lock = threading.Lock()
+
+        # fail early if the router cannot be initialized
+        if (endpoints is None):
+            self.calculator
+        else:
+            self._endpoint_calculator(0)
 
-    def route(self, origin_x, origin_y, dest_x, dest_y, mode,
+    @property
+    def calculator(self):
+        """ The router of the current thread """
+
+        if (not hasattr(self._local, "calculator")):
+            self._local.calculator = self._router(**self._router_kwargs)
+        return self._local.calculator
+
+    def _endpoint_calculator(self, i):
+        """ The router of the current thread for engine i of the endpoint pool
+        """
+
+        if (not hasattr(self._local, "calculators")):
+            self._local.calculators = {}
+        calculator = self._local.calculators.get(i)
+        if (calculator is None):
+            calculator = self._local.calculators[i] = self._router(**dict(
+                self._router_kwargs, entrypoint = self.endpoints.endpoints[i]
+            ))
+        return calculator
+
+    @property
+    def cache(self):
+        """ The route cache of the current thread, or None """
+
+        if (self._route_cache_kwargs is None):
+            return None
+        if (not hasattr(self._local, "cache")):
+            self._local.cache = cache.RouteCache(**self._route_cache_kwargs)
+        return self._local.cache
+
+    def route(self, origin_x, origin_y, dest_x, dest_y, mode = None,
               weekday = DEPARTURE_WEEKDAY, hour = DEPARTURE_HOUR,
-              attributes = None):
+              attributes = None, job_id = None, modes = None, hours = None):
         """ Calculate a route between two block groups
 
+        Jobs with modes or hours fan out into a route for every mode and
+        departure hour; see route_many.
+
         Args:
             origin_x, origin_y, dest_x, dest_y: Routing arguments
             mode: The route_distances mode of transportation to use
             weekday: The desired ISO weekday of departure
-            hour: The desired ISO hour of departure
+            hour: The desired hour of departure
             attributes: Data to be added to the route
+            job_id: The job ID assigned to the route by the server
+            modes: A list of modes to route with instead of mode
+            hours: A list of departure hours to route at instead of hour
         """
 
+        if ((modes is not None) or (hours is not None)):
+            self.route_many(
+                origin_x, origin_y, dest_x, dest_y, modes or [mode],
+                weekday, hours or [hour], attributes, job_id
+            )
+            return
+
         output = []
         output.append("%s Attributes: %s" % (mode, attributes))
 
-        departure_datetime = next_weekday(desired_weekday = DEPARTURE_WEEKDAY)
-        departure_time = datetime.datetime(
-            departure_datetime.year,
-            departure_datetime.month,
-            departure_datetime.day,
-            DEPARTURE_HOUR
-        )
-        result = self.calculator.distance(
-            origin_x,
-            origin_y,
-            dest_x,
-            dest_y,
-            mode,
-            departure_time = departure_time
+        with self._stage("departure_time"):
+            departure_time = departure_datetime(weekday, hour)
+        result = self._calculate(
+            origin_x, origin_y, dest_x, dest_y, mode, departure_time
         )
 
         success = 0
@@ -111,49 +444,321 @@ class Router(object):
 
             output.append("%s: => Duration: %f" % (mode, result["duration"]))
             output.append("%s: => Distance: %f" % (mode, result["distance"]))
-            self.client.write_to_disk({
-                "response": result["response"],
-                "attributes": attributes
-            })
+            # the small fields go first so that tnra.Reader can read them
+            # without parsing the response
+            self._write_result({
+                "duration": result["duration"],
+                "distance": result["distance"],
+                "response": result["response"]
+            }, attributes, job_id)
 
         # try to seek for a valid route
         # or have a different script overwrite the queue's origin/dest
         else:
             # TODO
-            pass
+            # for now, let the server know that the job is finished
+            self._write_result(None, attributes, job_id)
 
         if (success == 0):
             output.append("%s: No route" % mode)
 
-        if (self.logging):
-            with open(self.route_log_path, "a") as f:
-                f.write(
-                    json.dumps({
-                        "time": time.time(),
-                        "success": success,
-                        "origin_x": origin_x, "origin_y": origin_y,
-                        "dest_x": dest_x, "dest_y": dest_y,
-                        "departure_time": departure_time.timestamp(),
-                        "attributes": attributes
-                    })
-                )
-                f.write("\n")
+        self._log_route(
+            success, origin_x, origin_y, dest_x, dest_y, mode, departure_time,
+            attributes
+        )
+
+        if (VERBOSE):
+            with self._stage("verbose_output"):
+                print("\n".join(output))
+
+    def route_many(self, origin_x, origin_y, dest_x, dest_y, modes,
+                   weekday = DEPARTURE_WEEKDAY, hours = (DEPARTURE_HOUR, ),
+                   attributes = None, job_id = None):
+        """ Calculate the routes between two block groups for every mode and
+        departure hour, and send them back as one record
+
+        The record holds the modes, weekday and hours that were routed, and
+        "duration" and "distance" lists with a list per mode of one value per
+        hour, which is None where there was no route. Routing responses are
+        left out to keep the record small. If there is no route at all, the
+        job is finished without a record, like a single route.
 
+        Args:
+            origin_x, origin_y, dest_x, dest_y: Routing arguments
+            modes: A list of route_distances modes of transportation
+            weekday: The desired ISO weekday of departure
+            hours: A list of departure hours
+            attributes: Data to be added to the record
+            job_id: The job ID assigned to the job by the server
+        """
+
+        with self._stage("departure_time"):
+            departure_times = [
+                departure_datetime(weekday, hour) for hour in hours
+            ]
+        durations = []
+        distances = []
+        n_routes = 0
+        for mode in modes:
+            mode_durations = []
+            mode_distances = []
+            for departure_time in departure_times:
+                result = self._calculate(
+                    origin_x, origin_y, dest_x, dest_y, mode, departure_time
+                )
+                if (result):
+                    n_routes += 1
+                    mode_durations.append(result["duration"])
+                    mode_distances.append(result["distance"])
+                else:
+                    mode_durations.append(None)
+                    mode_distances.append(None)
+                self._log_route(
+                    1 if result else 0, origin_x, origin_y, dest_x, dest_y,
+                    mode, departure_time, attributes
+                )
+            durations.append(mode_durations)
+            distances.append(mode_distances)
+
+        if (n_routes > 0):
+            self._write_result({
+                "duration": durations,
+                "distance": distances,
+                "modes": list(modes),
+                "weekday": weekday,
+                "hours": list(hours)
+            }, attributes, job_id)
+        else:
+            self._write_result(None, attributes, job_id)
 
         if (VERBOSE):
-            print("\n".join(output))
+            with self._stage("verbose_output"):
+                print("%s Attributes: %s\n%s: => %d of %d routes" % (
+                    ",".join(str(mode) for mode in modes), attributes,
+                    ",".join(str(mode) for mode in modes), n_routes,
+                    len(modes) * len(hours)
+                ))
+
+    def _calculate(self, origin_x, origin_y, dest_x, dest_y, mode,
+                   departure_time):
+        """ Return the result of a route from the route cache or the router
+        """
+
+        if (self.cache is not None):
+            with self._stage("cache_get"):
+                (cached, result) = self.cache.get(
+                    origin_x, origin_y, dest_x, dest_y, mode, departure_time
+                )
+            if (cached):
+                self.metrics.record(mode, None, bool(result), cached = True)
+                return result
+
+        with self._stage("routing_engine"):
+            start_time = time.time()
+            if (self.endpoints is None):
+                result = self.calculator.distance(
+                    origin_x,
+                    origin_y,
+                    dest_x,
+                    dest_y,
+                    mode,
+                    departure_time = departure_time
+                )
+            else:
+                result = self._balanced_distance(
+                    origin_x, origin_y, dest_x, dest_y, mode, departure_time
+                )
+            seconds = time.time() - start_time
+            self.metrics.record(mode, seconds, bool(result))
+            if (self.slot is not None):
+                self.slot.record(seconds, bool(result))
+        if (self.cache is not None):
+            with self._stage("cache_put"):
+                self.cache.put(
+                    origin_x, origin_y, dest_x, dest_y, mode, departure_time,
+                    result or None
+                )
+        return result
+
+    def _balanced_distance(self, origin_x, origin_y, dest_x, dest_y, mode,
+                           departure_time):
+        """ Route with the engine of the endpoint pool that has the fewest
+        requests in flight, retrying on other engines if the request raises
+
+        Raises:
+            The exception raised by the last engine tried, once there has been
+            an attempt per engine
+        """
+
+        for attempt in range(len(self.endpoints)):
+            i = self.endpoints.acquire()
+            start_time = time.time()
+            try:
+                result = self._endpoint_calculator(i).distance(
+                    origin_x,
+                    origin_y,
+                    dest_x,
+                    dest_y,
+                    mode,
+                    departure_time = departure_time
+                )
+            except Exception:
+                self.endpoints.release(i, error = True)
+                if (attempt == len(self.endpoints) - 1):
+                    raise
+                continue
+            self.endpoints.release(i, time.time() - start_time)
+            return result
+
+    def _log_route(self, success, origin_x, origin_y, dest_x, dest_y, mode,
+                   departure_time, attributes):
+        """ Add a route to the route log, if route logging is enabled """
+
+        if (self.route_log is not None):
+            with self._stage("route_log"):
+                self.route_log.write({
+                    "time": time.time(),
+                    "success": success,
+                    "origin_x": origin_x, "origin_y": origin_y,
+                    "dest_x": dest_x, "dest_y": dest_y,
+                    "mode": mode,
+                    "departure_time": departure_time.timestamp(),
+                    "attributes": attributes
+                })
 
     def main(self):
         """ Router main loop
 
-        Continuously pulls self.route kwargs from the Redis queue and
-        calculates routes until the queue is empty
+        Continuously pulls self.route kwargs from the TNRA server queue and
+        calculates routes until the queue is empty and, unless
+        wait_for_leases is off, no jobs are leased. If prefetching is
+        enabled, jobs are taken from a local buffer that is refilled in the
+        background. Before returning, waits for the server to receive every
+        result.
         """
 
-        next_ = self.client.queue_pop()
-        while (next_):
-            self.route(*next_[0], **next_[1])
-            next_ = self.client.queue_pop()
+        if (not self.prefetch):
+            prefetcher = None
+
+            def pop_once():
+                if (self.slot is not None):
+                    self.slot.wait()
+                return self.client.queue_pop(self.queues, self.modes)
+
+            def pop():
+                job = pop_once()
+                if ((not job) and self.wait_for_leases):
+                    job = wait_for_leases(self.client, pop_once)
+                return job
+        else:
+            prefetcher = Prefetcher(
+                self.server_host, self.server_port, queues = self.queues,
+                modes = self.modes, concurrency = self.concurrency,
+                slot = self.slot, wait_for_leases = self.wait_for_leases
+            )
+            prefetcher.start()
+            pop = prefetcher.get
+
+        def next_job():
+            with self._stage("queue_pop"):
+                return pop()
+
+        try:
+            if (self.concurrency <= 1):
+                next_ = next_job()
+                while (next_):
+                    self._route_job(next_, prefetcher)
+                    next_ = next_job()
+            else:
+                self._route_concurrently(next_job, prefetcher)
+        finally:
+            if (prefetcher is not None):
+                prefetcher.stop()
+
+        with self._sink_lock:
+            self._report_metrics()
+        self.sink.flush(self.client)
+        if (self.route_log is not None):
+            self.route_log.close()
+        if (self.profiler is not None):
+            self.profiler.close()
+
+    def _route_job(self, job, prefetcher = None):
+        """ Route an (args, kwargs) job, recording its latency with the
+        prefetcher if there is one """
+
+        start_time = time.time()
+        with self._stage("job"):
+            self.route(*job[0], **job[1])
+        if (prefetcher is not None):
+            prefetcher.record_latency(time.time() - start_time)
+
+    def _route_concurrently(self, next_job, prefetcher = None):
+        """ Route jobs on a pool of threads until there are none left, keeping
+        up to self.concurrency routes in flight
+
+        Jobs are taken by the calling thread as soon as a route finishes, and
+        results are sent by the thread that calculated them, so that taking
+        jobs, routing and sending results overlap.
+
+        Args:
+            next_job: A function that returns the next job, or None once there
+                are no jobs left
+            prefetcher: The Prefetcher that jobs come from, if any
+
+        Raises:
+            The first exception raised by a route, once every route in flight
+            has finished
+        """
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+        errors = []
+
+        def route_job(job):
+            try:
+                self._route_job(job, prefetcher)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                slots.release()
+
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            while (len(errors) == 0):
+                slots.acquire()
+                job = next_job()
+                if (not job):
+                    slots.release()
+                    break
+                pool.submit(route_job, job)
+
+        if (len(errors) > 0):
+            raise errors[0]
+
+    def _write_result(self, record, attributes, job_id):
+        """ Send a result to the server through the sink shared by every
+        thread """
+
+        with self._stage("write_result"), self._sink_lock:
+            self.sink.write_result(record, attributes, job_id)
+            if (time.time() - self._last_report >= self.report_interval):
+                self._report_metrics()
+
+    def _stage(self, name):
+        """ Return a context manager that times a stage of routing with the
+        profiler, if profiling is enabled """
+
+        if (self.profiler is None):
+            return profiler.NULL_STAGE
+        return self.profiler.stage(name)
+
+    def _report_metrics(self):
+        """ Send the route metrics recorded since the last report to the
+        server; must be called while holding the sink lock """
+
+        self._last_report = time.time()
+        report = self.metrics.take()
+        if (report is not None):
+            self.sink.report_stats(report)
 
 def init_router(router_kwargs):
     """ Wrapper function for the initialization of a Router object
@@ -164,14 +769,47 @@ def init_router(router_kwargs):
 
     Router(**router_kwargs).main()
 
-def start_routers(router_kwargs, threads = MAX_THREADS):
+def start_routers(router_kwargs, threads = MAX_THREADS, adaptive = None,
+                  adaptive_interval = controller.DEFAULT_INTERVAL,
+                  endpoints = None, balance = None):
     """ Wrapper function for starting multiple routers
 
+    Routers return once the server queue is empty and no jobs are leased, so
+    that jobs whose workers died are routed in the same run once their leases
+    expire; a run therefore lasts at least until the leases of dead workers
+    expire (see the lease timeout of tnra.Server). With "wait_for_leases":
+    False in the router kwargs, routers return as soon as the queue is empty,
+    and jobs that are requeued afterwards wait for the next run.
+
     Args:
         router_kwargs: A dictionary of kwargs to be passed to Router.__init__
-        threads: The number of threads to start
+        threads: The number of threads to start, or, if adaptive, the largest
+            number of routers that can be active
+        adaptive: Keyword arguments to be passed to the initialization of a
+            tnra.controller.AIMDController, in the form of a dict (i.e.
+            {"min_routers": 2, "max_failure_rate": 0.1}), to vary the number
+            of active routers with the latency and failure rate of the routing
+            engine, or None to keep every router active
+        adaptive_interval: The number of seconds between changes to the
+            number of active routers
+        endpoints: A list of the entrypoints (i.e. "localhost:8080") of
+            routing engines to balance routes between, or None to route with
+            the entrypoint in the router kwargs; see tnra.balancer
+        balance: Keyword arguments to be passed to the initialization of the
+            tnra.balancer.EndpointPool of the endpoints, in the form of a dict
+            (i.e. {"slow_factor": 5})
+
+    Returns:
+        The AIMDController, if adaptive; its decisions attribute holds every
+        change it made
     """
 
+    if ((adaptive is not None) or (endpoints is not None)):
+        return _start_router_processes(
+            router_kwargs, threads, adaptive, adaptive_interval, endpoints,
+            balance
+        )
+
     pool = multiprocessing.Pool(threads)
     pool.map(
         init_router,
@@ -179,3 +817,90 @@ def start_routers(router_kwargs, threads = MAX_THREADS):
     )
     pool.close()
     pool.join()
+
+def _finish_when_drained(gate, processes):
+    """ Wait for a router to stop because the queue is empty, and then let
+    every paused router go
+
+    Routers that exit with an error say nothing about the queue, so paused
+    routers keep waiting for one that exits cleanly, unless only paused
+    routers are left.
+
+    Args:
+        gate: The controller.Gate of the routers
+        processes: The router processes, in the order of their slots
+    """
+
+    running = dict(enumerate(processes))
+    while (len(running) > 0):
+        stopped = multiprocessing.connection.wait(
+            [process.sentinel for process in running.values()]
+        )
+        for (index, process) in list(running.items()):
+            if (process.sentinel not in stopped):
+                continue
+            process.join()
+            del running[index]
+            if (process.exitcode == 0):
+                gate.finish()
+                return
+            print("Router %d exited with code %d" % (
+                index, process.exitcode
+            ), file = sys.stderr)
+        if (all(index >= gate.active for index in running)):
+            gate.finish()
+            return
+
+def _start_router_processes(router_kwargs, threads, adaptive, interval,
+                            endpoints, balance):
+    """ Start routers that share state with this process, and run the
+    AIMDController and health checks that use it until they are done
+
+    Shared memory can only be handed to processes as they are started, so
+    routers are started as processes of their own rather than in a pool.
+    """
+
+    router_kwargs = dict(router_kwargs)
+    health_checker = None
+    if (endpoints is not None):
+        balance = dict({"verbose": VERBOSE}, **(balance or {}))
+        pool = balancer.EndpointPool(endpoints, **balance)
+        router_kwargs["endpoints"] = pool
+        health_checker = balancer.HealthChecker(pool)
+        health_checker.start()
+
+    aimd = None
+    gate = None
+    n_routers = threads
+    if (adaptive is not None):
+        adaptive = dict({"max_routers": threads}, **adaptive)
+        aimd = controller.AIMDController(**adaptive)
+        gate = controller.Gate(aimd.active)
+        n_routers = aimd.max_routers
+
+    processes = []
+    for i in range(n_routers):
+        kwargs = router_kwargs
+        if (gate is not None):
+            kwargs = dict(router_kwargs, slot = controller.Slot(gate, i))
+        processes.append(multiprocessing.Process(
+            target = init_router, args = (kwargs, )
+        ))
+    for process in processes:
+        process.start()
+
+    if (gate is not None):
+        controller_thread = controller.ControllerThread(
+            gate, aimd, interval, VERBOSE
+        )
+        controller_thread.start()
+
+        _finish_when_drained(gate, processes)
+
+    for process in processes:
+        process.join()
+    if (gate is not None):
+        controller_thread.stop()
+    if (health_checker is not None):
+        health_checker.stop()
+    return aimd
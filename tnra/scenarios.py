@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# vectorized evaluation of facility closure scenarios
+#
+# Routes do not depend on which destinations are open, so a study of many
+# scenarios in which only some destinations (i.e. shelters) are open only needs
+# the travel times between every origin and every destination, routed once.
+# evaluate takes those as an origin x destination array and the scenarios as a
+# scenario x destination mask of open destinations, and finds the nearest open
+# destination of every origin in every scenario with a few NumPy operations
+# over blocks of scenarios, along with the weighted (i.e. by population) mean
+# travel time and the share of the weight covered within travel time
+# thresholds.
+#
+# NumPy is only needed by this module.
+
+import numpy
+
+DEFAULT_CHUNK_BYTES = 128 * 1024 * 1024 # bytes of travel times per block
+
+def scenario_masks(scenarios, destination_ids):
+    """ Build the mask matrix of a list of scenarios
+
+    Args:
+        scenarios: A list with one iterable of the IDs of the destinations
+            that are open per scenario
+        destination_ids: The ID of every column of the travel time matrix
+
+    Returns:
+        A boolean array with one row per scenario and one column per
+        destination, True where the destination is open
+
+    Raises:
+        ValueError: A scenario has an ID that is not in destination_ids
+    """
+
+    index = {
+        destination_id: j for (j, destination_id) in enumerate(destination_ids)
+    }
+    masks = numpy.zeros((len(scenarios), len(index)), dtype = bool)
+    for (i, open_ids) in enumerate(scenarios):
+        for destination_id in open_ids:
+            if (destination_id not in index):
+                raise ValueError("Unknown destination %r in scenario %d" % (
+                    destination_id, i
+                ))
+            masks[i, index[destination_id]] = True
+    return masks
+
+def evaluate(times, masks, weights = None, thresholds = (),
+             chunk_bytes = DEFAULT_CHUNK_BYTES):
+    """ Find the nearest open destination of every origin in every scenario
+
+    Args:
+        times: An array of travel times with one row per origin and one column
+            per destination, NaN where there is no route, i.e. the duration
+            of a tnra.matrix.ODMatrix
+        masks: A boolean array with one row per scenario and one column per
+            destination, True where the destination is open (see
+            scenario_masks)
+        weights: The weight of every origin, i.e. its population, or None to
+            weigh every origin equally
+        thresholds: Travel times to compute the coverage of every scenario
+            within
+        chunk_bytes: The approximate size of the scenario x origin x
+            destination block of travel times that is worked on at once
+
+    Returns:
+        A dict of arrays:
+            "nearest": The column of the nearest open destination of every
+                origin, with one row per scenario and one column per origin,
+                -1 where no open destination can be reached
+            "time": The travel time to that destination, NaN where there is
+                none
+            "mean_time": The weighted mean travel time of the origins that
+                can reach an open destination, per scenario
+            "unreachable": The share of the weight of origins that cannot
+                reach an open destination, per scenario
+            "coverage": The share of the weight of origins that can reach an
+                open destination within every threshold, with one row per
+                scenario and one column per threshold
+    """
+
+    times = numpy.asarray(times, dtype = float)
+    masks = numpy.asarray(masks, dtype = bool)
+    (n_origins, n_destinations) = times.shape
+    if (masks.shape[1] != n_destinations):
+        raise ValueError("%d destinations in the masks and %d in the times" % (
+            masks.shape[1], n_destinations
+        ))
+    n_scenarios = masks.shape[0]
+
+    if (weights is None):
+        weights = numpy.ones(n_origins)
+    weights = numpy.asarray(weights, dtype = float)
+    if (weights.shape != (n_origins, )):
+        raise ValueError("%d weights for %d origins" % (
+            len(weights), n_origins
+        ))
+    total_weight = weights.sum()
+    thresholds = numpy.asarray(thresholds, dtype = float)
+
+    nearest = numpy.empty((n_scenarios, n_origins), dtype = numpy.int64)
+    best = numpy.empty((n_scenarios, n_origins))
+
+    # closed destinations and missing routes are both infinitely far away
+    times = numpy.where(numpy.isnan(times), numpy.inf, times)
+    chunk = max(1, chunk_bytes // max(1, n_origins * n_destinations * 8))
+    for start in range(0, n_scenarios, chunk):
+        end = min(start + chunk, n_scenarios)
+        masked = numpy.where(
+            masks[start:end, None, :], times[None, :, :], numpy.inf
+        )
+        nearest[start:end] = masked.argmin(axis = 2)
+        best[start:end] = numpy.take_along_axis(
+            masked, nearest[start:end, :, None], axis = 2
+        )[:, :, 0]
+
+    reachable = numpy.isfinite(best)
+    reachable_weight = reachable @ weights
+    with numpy.errstate(invalid = "ignore", divide = "ignore"):
+        mean_time = (
+            numpy.where(reachable, best, 0) @ weights / reachable_weight
+        )
+    coverage = numpy.empty((n_scenarios, len(thresholds)))
+    for (k, threshold) in enumerate(thresholds):
+        coverage[:, k] = (best <= threshold) @ weights / total_weight
+
+    nearest[~reachable] = -1
+    best[~reachable] = numpy.nan
+
+    return {
+        "nearest": nearest,
+        "time": best,
+        "mean_time": mean_time,
+        "unreachable": 1 - reachable_weight / total_weight,
+        "coverage": coverage
+    }
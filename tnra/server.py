@@ -1,13 +1,50 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import hashlib
+import itertools
 import json
-import pickle
+import os
+import queue
+import socket
+import sys
 import threading
-import zlib
+import time
+import traceback
+import uuid
 import zmq
 
+from . import journal, metrics, protocol, queues, writer
+
 DEFAULT_PORT = 5555
+DEFAULT_RESULT_PORT = 5556
+DEFAULT_SINK_LINGER_MS = 60000
+DEFAULT_SINK_FLUSH_TIMEOUT_S = 60
 DEFAULT_TIMEOUT_MS = 5000
+DEFAULT_BATCH_SIZE = 5000
+
+# number of decimal places that coordinates are rounded to when deduplicating
+# routes, and the number of finished results that are kept for reuse
+DEFAULT_DEDUP_PRECISION = 6
+DEFAULT_RESULT_CACHE_SIZE = 1000
+
+# number of seconds that a worker has to finish a popped job before it is put
+# back on the queue, and the number of times that a job is handed out before
+# it is given up on and moved to the dead-letter queue
+DEFAULT_LEASE_TIMEOUT = 600
+DEFAULT_MAX_DELIVERIES = 3
+LEASE_CHECK_INTERVAL_MS = 1000
+
+# keyword arguments of queued routes that the server sets itself
+SERVER_KWARGS = ("job_id", "deliveries")
+
+# arguments of tnra.router.Router.route that can follow the coordinates of an
+# enqueued route positionally
+ROUTE_ARGS = ("mode", "weekday", "hour", "attributes")
+
+ENGINES = ("rep", "router")
+DEFAULT_ENGINE = "router"
 
 COMMANDS = {
     "exit": 10,
@@ -18,19 +55,59 @@ COMMANDS = {
     "queue_pop": 21,
     "queue_size": 22,
     "queue_flush": 23,
+    "enqueue_many": 24,
+    "queue_pop_many": 25,
+    "dedup_stats": 26,
+    "lease_stats": 27,
+    "dead_letters": 28,
+    "requeue_dead_letters": 29,
 
     "open_file": 30,
     "close_file": 31,
     "write_to_disk": 32,
     "save_queue": 33,
     "load_queue": 34,
+    "write_result": 35,
+    "sink_flush": 36,
+    "sink_flushed": 37,
+    "write_stats": 38,
 
     "get_var": 40,
     "set_var": 41,
     "save_vars": 42,
-    "load_vars": 43
+    "load_vars": 43,
+
+    "create_queue": 50,
+    "drop_queue": 51,
+    "queue_info": 52,
+    "enqueue_matrix": 53,
+
+    "stats": 60,
+    "report_stats": 61,
+    "register_node": 62,
+    "nodes": 63
 }
 
+# commands that are run on the I/O thread of the router engine
+IO_COMMANDS = set([
+    COMMANDS["open_file"],
+    COMMANDS["close_file"],
+    COMMANDS["save_queue"],
+    COMMANDS["load_queue"],
+    COMMANDS["save_vars"],
+    COMMANDS["load_vars"]
+])
+
+# commands that are accepted on the result socket, and are not responded to
+SINK_COMMANDS = set([
+    COMMANDS["write_result"],
+    COMMANDS["sink_flush"],
+    COMMANDS["report_stats"]
+])
+
+# maximum number of results handled before checking for commands again
+MAX_RESULTS_PER_POLL = 1000
+
 RESPONSES = {
     "ok": 10,
     "notok": 11,
@@ -38,6 +115,138 @@ RESPONSES = {
     "queue_empty": 20
 }
 
+# how the bodies of commands and OK responses are laid out in frames; anything
+# not listed here is sent as a single JSON frame
+COMMAND_SCHEMAS = {
+    COMMANDS["enqueue"]: protocol.ROUTE,
+    COMMANDS["enqueue_many"]: protocol.ROUTES,
+    COMMANDS["write_to_disk"]: protocol.RAW,
+    COMMANDS["write_result"]: protocol.RESULT
+}
+
+RESPONSE_SCHEMAS = {
+    COMMANDS["queue_pop"]: protocol.ROUTE,
+    COMMANDS["queue_pop_many"]: protocol.ROUTES
+}
+
+def encode_cmd(message):
+    """ Convert a command into a list of frames """
+
+    if ("body" in message):
+        return protocol.pack(
+            message["cmd"], message["body"],
+            COMMAND_SCHEMAS.get(message["cmd"], protocol.JSON)
+        )
+    return protocol.pack(message["cmd"])
+
+def decode_cmd(frames):
+    """ Convert a list of frames into a command
+
+    Raises:
+        protocol.ProtocolError: The frames are not a valid command
+    """
+
+    message = {"cmd": protocol.unpack_header(frames)}
+    if (protocol.has_body(frames)):
+        message["body"] = protocol.unpack_body(
+            frames, COMMAND_SCHEMAS.get(message["cmd"], protocol.JSON)
+        )
+    return message
+
+def encode_rsp(cmd, message):
+    """ Convert a response to the given command into a list of frames """
+
+    if ("body" in message):
+        if (message["rsp"] == RESPONSES["ok"]):
+            schema = RESPONSE_SCHEMAS.get(cmd, protocol.JSON)
+        else:
+            schema = protocol.JSON
+        return protocol.pack(message["rsp"], message["body"], schema)
+    return protocol.pack(message["rsp"])
+
+def decode_rsp(cmd, frames):
+    """ Convert a list of frames into a response to the given command
+
+    Raises:
+        protocol.ProtocolError: The frames are not a valid response
+    """
+
+    message = {"rsp": protocol.unpack_header(frames)}
+    if (protocol.has_body(frames)):
+        if (message["rsp"] == RESPONSES["ok"]):
+            schema = RESPONSE_SCHEMAS.get(cmd, protocol.JSON)
+        else:
+            schema = protocol.JSON
+        message["body"] = protocol.unpack_body(frames, schema)
+    return message
+
+def compose_record(attributes, record):
+    """ Combine JSON encoded attributes and a JSON encoded record without
+    attributes into a single line of output, without decoding either
+
+    Args:
+        attributes: The JSON encoded attributes, as bytes
+        record: The JSON encoded record object, as bytes
+
+    Returns:
+        The JSON encoded record with an "attributes" key, as bytes
+    """
+
+    record = record.strip()
+    if (record == b"{}"):
+        return b"{\"attributes\": " + attributes + b"}"
+    return b"{\"attributes\": " + attributes + b", " + record[1:]
+
+def result_body(record, attributes = None, job_id = None):
+    """ Build the body of a write_result command
+
+    Args:
+        record: A JSON serializable dict holding the result of the route,
+            without its attributes, or None if no route was found
+        attributes: The attributes of the route
+        job_id: The job ID that the route was popped with, if any
+
+    Returns:
+        A (job_id, attributes, record) tuple to be encoded with
+        protocol.RESULT
+    """
+
+    if (record is None):
+        record = b""
+    else:
+        record = json.dumps(record)
+    return (job_id, json.dumps(attributes), record)
+
+def route_item(args, kwargs):
+    """ Build the (args, kwargs) item of a route that is enqueued with the
+    arguments of tnra.router.Router.route
+
+    Routes are sent with exactly protocol.ROUTE_COORDS coordinates, so any
+    positional arguments after the coordinates (i.e. a mode) are moved into
+    the keyword arguments.
+
+    Raises:
+        TypeError: There are more positional arguments than ROUTE_ARGS, or
+            one of them is also given as a keyword argument
+    """
+
+    args = tuple(args)
+    extra = args[protocol.ROUTE_COORDS:]
+    if (len(extra) == 0):
+        return (args, kwargs)
+    if (len(extra) > len(ROUTE_ARGS)):
+        raise TypeError(
+            "Routes take at most %d positional arguments (%d given)" % (
+                protocol.ROUTE_COORDS + len(ROUTE_ARGS), len(args)
+            )
+        )
+    kwargs = dict(kwargs)
+    for (name, value) in zip(ROUTE_ARGS, extra):
+        if (name in kwargs):
+            raise TypeError("Route got multiple values for %s" % name)
+        kwargs[name] = value
+    return (args[:protocol.ROUTE_COORDS], kwargs)
+
 def parse_body(response):
     """ Return the body of a message only if the response is OK, or True if
     there is no body"""
@@ -53,153 +262,1196 @@ def parse_body(response):
 class TimeoutError(IOError):
     pass
 
+class EnqueueError(IOError):
+
+    """ Raised when the server rejects a batch of routes
+
+    Attributes:
+        enqueued: The number of routes that were enqueued before the batch
+            that was rejected
+    """
+
+    def __init__(self, enqueued):
+        IOError.__init__(
+            self, "The server rejected a batch of routes after %d routes "
+                  "were enqueued" % enqueued
+        )
+        self.enqueued = enqueued
+
 class Server(threading.Thread):
 
-    """ Implementation of lightweight FILO queue server and endpoint for
-    data dumping using ZeroMQ """
+    """ Implementation of lightweight queue server and endpoint for data
+    dumping using ZeroMQ
+
+    Routes are kept in named queues (see tnra.queues.QueueSet), each of which
+    pops routes in LIFO, FIFO or priority order. Routes are enqueued to the
+    queue given by their "queue" keyword argument, or to the default LIFO
+    queue, and workers can pop from only some queues, and only routes of the
+    modes that they support.
+
+    Two engines are available. The "rep" engine handles every command
+    serially on a single REP socket. The "router" engine uses a ROUTER socket
+    so that many clients can have requests in flight at once; queue commands
+    are handled on the server thread while file and other disk commands are
+    handed off to an internal I/O thread, so that slow disk writes do not
+    stall queue operations.
+
+    Every enqueued route is given a job ID. Unless deduplication is disabled,
+    routes are keyed on their rounded coordinates and every keyword argument
+    other than their attributes (i.e. mode and departure time); only the first
+    route with a given key is handed out to workers, and its result is written
+    once for every set of attributes that was enqueued with that key. The most
+    recent results are also kept so that routes enqueued after their key has
+    finished are written without being routed again. Keys are 64-bit digests,
+    kept in a tnra.queues.KeyIndex for queued jobs, so that deduplication adds
+    little to the memory used per queued route.
+
+    Matrix jobs hold every route between a set of origins and a set of
+    destinations (see tnra.queues.MatrixJob). They belong to a named queue, and
+    their routes are only expanded into that queue, a batch at a time, once
+    popping finds no other routes in the queues and modes being popped from,
+    so that a matrix job takes memory proportional to its origins and
+    destinations. Expanded routes are deduplicated like any other.
+
+    Unless leasing is disabled, popping a job leases it to the worker that
+    popped it until the worker acknowledges it by writing its result (or
+    writing that no route was found) with its job ID. Jobs that are not
+    acknowledged within lease_timeout seconds are put back on the queue; jobs
+    that have been handed out max_deliveries times without being acknowledged
+    are moved to a dead-letter queue instead, from which they can be inspected
+    and requeued. A job that is acknowledged after its lease expired is not
+    handed out again.
+
+    Results can be sent with the write_result command, or without waiting for
+    a response by pushing them to a separate PULL socket with a ResultSink.
+    Either way, lines are handed to a ResultWriter thread that writes them to
+    the output file in batches.
+
+    If given a journal directory, every change to the queue and to the jobs
+    waiting on results is logged to a tnra.journal.Journal before the command
+    is answered, and the queue is snapshotted whenever the journal grows past
+    its snapshot size and when the server exits. A server started with the
+    same journal directory recovers the queue from the latest snapshot and
+    journal. Results that were cached for reuse are not recovered.
+    """
+
+    def __init__(self, port = DEFAULT_PORT, engine = DEFAULT_ENGINE,
+                 dedup_precision = DEFAULT_DEDUP_PRECISION,
+                 result_cache_size = DEFAULT_RESULT_CACHE_SIZE,
+                 result_port = DEFAULT_RESULT_PORT, writer_kwargs = None,
+                 journal_dir = None, journal_kwargs = None,
+                 lease_timeout = DEFAULT_LEASE_TIMEOUT,
+                 max_deliveries = DEFAULT_MAX_DELIVERIES):
+        """ Initializes Server object
+
+        Args:
+            port: The port to listen on
+            engine: The server engine to use; one of ENGINES
+            dedup_precision: The number of decimal places to round
+                coordinates to when deduplicating routes, or None to disable
+                deduplication
+            result_cache_size: The number of finished results to keep for
+                reuse by routes that are enqueued later
+            result_port: The port to receive results from ResultSinks on
+            writer_kwargs: Keyword arguments to be passed to the
+                initialization of the tnra.writer.ResultWriter, in the form of
+                a dict (i.e. {"fsync_interval": 10})
+            journal_dir: The directory to journal the queue to, or None to
+                keep the queue in memory only
+            journal_kwargs: Keyword arguments to be passed to the
+                initialization of the tnra.journal.Journal, in the form of a
+                dict (i.e. {"snapshot_bytes": 2 ** 30})
+            lease_timeout: The number of seconds that a worker has to
+                acknowledge a popped job, or None to disable leasing
+            max_deliveries: The number of times that a job is handed out
+                before it is moved to the dead-letter queue
+        """
 
-    def __init__(self, port = DEFAULT_PORT):
         threading.Thread.__init__(self)
 
-        self._file = None
+        assert engine in ENGINES, "Unknown engine %s" % engine
+
+        self.writer = writer.ResultWriter(**(writer_kwargs or {}))
+        self._flushed_tokens = set()
+        self._lock = threading.RLock()
+        self._io_jobs = queue.Queue()
+        self._replies_address = "inproc://tnra-replies-%d" % id(self)
 
         self._context = zmq.Context()
 
-        self._socket = self._context.socket(zmq.REP)
+        if (engine == "router"):
+            self._socket = self._context.socket(zmq.ROUTER)
+        else:
+            self._socket = self._context.socket(zmq.REP)
         self._socket.bind("tcp://*:%d" % port)
         self._socket.setsockopt(zmq.LINGER, 0)
 
+        self._results_socket = self._context.socket(zmq.PULL)
+        self._results_socket.bind("tcp://*:%d" % result_port)
+        self._results_socket.setsockopt(zmq.LINGER, 0)
+
         self.port = port
-        self.queue = []
+        self.result_port = result_port
+        self.engine = engine
+        self.queue = queues.QueueSet()
         self.vars = {}
 
-    def send_rsp(self, message):
-        """ Wrapper for zmq.Context.socket.send
+        self.dedup_precision = dedup_precision
+        self.result_cache_size = result_cache_size
+        self.dedup_stats = {"hits": 0, "misses": 0, "cache_hits": 0}
+        self._next_job_id = 0
+        self._pending = queues.KeyIndex() # job key -> job ID of routed job
+        self._job_keys = {}    # job ID -> job key of popped, unfinished jobs
+        self._waiters = {}     # job ID -> attributes of duplicate routes
+        self._results = collections.OrderedDict() # job key -> record
+        self.matrices = collections.OrderedDict() # matrix ID -> MatrixJob
+        self._next_matrix_id = 0
+
+        self.lease_timeout = lease_timeout
+        self.max_deliveries = max_deliveries
+        self.lease_stats = {"leased": 0, "expired": 0, "acked": 0}
+        self._leases = collections.OrderedDict() # job ID -> (deadline, item)
+        self._requeued = set() # IDs of expired jobs that were put back
+        self._dead_jobs = collections.OrderedDict() # job ID -> item
+        self._last_lease_check = time.time()
+
+        self.stats = metrics.StatsAggregator()
+        self.nodes = {} # node name -> what the node registered with
+
+        self.journal = None
+        if (journal_dir is not None):
+            journal_ = journal.Journal(journal_dir, **(journal_kwargs or {}))
+            try:
+                self._recover(journal_)
+            except Exception:
+                # a context with open sockets would hang the process on exit
+                self._socket.close()
+                self._results_socket.close()
+                self._context.term()
+                raise
+            self.journal = journal_
+
+        self._handlers = {
+            COMMANDS["echo"]: self._echo,
+            COMMANDS["ping"]: self._ping,
+
+            COMMANDS["enqueue"]: self._enqueue,
+            COMMANDS["queue_pop"]: self._queue_pop,
+            COMMANDS["queue_size"]: self._queue_size,
+            COMMANDS["queue_flush"]: self._queue_flush,
+            COMMANDS["enqueue_many"]: self._enqueue_many,
+            COMMANDS["queue_pop_many"]: self._queue_pop_many,
+            COMMANDS["dedup_stats"]: self._dedup_stats,
+            COMMANDS["lease_stats"]: self._lease_stats,
+            COMMANDS["dead_letters"]: self._dead_letters,
+            COMMANDS["requeue_dead_letters"]: self._requeue_dead_letters,
+
+            COMMANDS["open_file"]: self._open_file,
+            COMMANDS["close_file"]: self._close_file,
+            COMMANDS["write_to_disk"]: self._write_to_disk,
+            COMMANDS["write_result"]: self._write_result,
+            COMMANDS["sink_flush"]: self._sink_flush,
+            COMMANDS["sink_flushed"]: self._sink_flushed,
+            COMMANDS["write_stats"]: self._write_stats,
+            COMMANDS["save_queue"]: self._save_queue,
+            COMMANDS["load_queue"]: self._load_queue,
+
+            COMMANDS["get_var"]: self._get_var,
+            COMMANDS["set_var"]: self._set_var,
+            COMMANDS["save_vars"]: self._save_vars,
+            COMMANDS["load_vars"]: self._load_vars,
+
+            COMMANDS["create_queue"]: self._create_queue,
+            COMMANDS["drop_queue"]: self._drop_queue,
+            COMMANDS["queue_info"]: self._queue_info,
+            COMMANDS["enqueue_matrix"]: self._enqueue_matrix,
+
+            COMMANDS["stats"]: self._stats,
+            COMMANDS["report_stats"]: self._report_stats,
+            COMMANDS["register_node"]: self._register_node,
+            COMMANDS["nodes"]: self._nodes
+        }
+
+    def send_rsp(self, cmd, message):
+        """ Wrapper for zmq.Context.socket.send_multipart
 
         Args:
+            cmd: The command that is being responded to
             message: The message to send
         """
 
         assert "rsp" in message, "Poorly formatted response"
-        self._socket.send(pickle.dumps(message))
+        self._socket.send_multipart(encode_rsp(cmd, message))
 
     def recv_cmd(self):
-        """ Wrapper for zmq.Context.socket.recv
+        """ Wrapper for zmq.Context.socket.recv_multipart
 
         Returns:
-            The received message
+            The received message, or None if it could not be decoded
         """
 
-        message = pickle.loads(self._socket.recv())
-        assert "cmd" in message, "Poorly formatted command"
-        return message
+        try:
+            return decode_cmd(self._socket.recv_multipart())
+        except protocol.ProtocolError:
+            return None
+
+    def dispatch(self, message):
+        """ Run the handler for a command
+
+        Commands that are not I/O commands are run while holding the server
+        lock; I/O commands acquire the lock themselves only for the parts that
+        touch the queue or the variables. A handler that raises, i.e. on a
+        body that is missing a field or an output file that cannot be opened,
+        is logged and answered with notok, so that the server and its I/O
+        thread keep serving.
+
+        Args:
+            message: The received command
+
+        Returns:
+            The response to be sent back to the client
+        """
+
+        handler = self._handlers.get(message["cmd"])
+        if (handler is None):
+            return {"rsp": RESPONSES["notok"]}
+        elif (message["cmd"] in IO_COMMANDS):
+            return self._handle(handler, message)
+        else:
+            with self._lock:
+                response = self._handle(handler, message)
+                # whatever a failed handler changed before it raised has
+                # been logged, and is kept
+                self._commit_journal()
+            return response
+
+    def _handle(self, handler, message):
+        """ Run a handler, logging the error and answering notok if it raises
+        """
+
+        try:
+            return handler(message.get("body"))
+        except Exception:
+            print("Error handling command %d:" % message["cmd"],
+                  file = sys.stderr)
+            traceback.print_exc()
+            return {"rsp": RESPONSES["notok"]}
 
     def run(self):
+        self.writer.start()
+        if (self.engine == "router"):
+            self._run_router()
+        else:
+            self._run_rep()
+        self.writer.stop()
+        if (self.journal is not None):
+            with self._lock:
+                self._snapshot()
+                self.journal.close()
+        self._socket.close()
+        self._results_socket.close()
+        self._context.term()
+
+    def _recv_results(self):
+        """ Handle the results waiting on the result socket """
+
+        for i in range(MAX_RESULTS_PER_POLL):
+            try:
+                frames = self._results_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            try:
+                message = decode_cmd(frames)
+            except protocol.ProtocolError:
+                continue
+            if (message["cmd"] in SINK_COMMANDS):
+                self.dispatch(message)
+
+    def _run_rep(self):
+        """ Serially receive commands from and respond to one client at a time
+        """
+
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._results_socket, zmq.POLLIN)
+
         while True:
-            message = self.recv_cmd()
+            events = dict(poller.poll(LEASE_CHECK_INTERVAL_MS))
+            self._check_leases()
+            if (self._results_socket in events):
+                self._recv_results()
+            if (self._socket not in events):
+                continue
 
-            ## 1X ##############################################################
+            message = self.recv_cmd()
+            if (message is None):
+                self._socket.send_multipart(
+                    protocol.pack(RESPONSES["notok"])
+                )
+                continue
             if (message["cmd"] == COMMANDS["exit"]):
-                if (self._file is not None):
-                    self._file.close()
                 break
+            self.send_rsp(message["cmd"], self.dispatch(message))
 
-            elif (message["cmd"] == COMMANDS["echo"]):
-                print(message["body"])
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+    def _run_router(self):
+        """ Receive commands from many clients at once, handing I/O commands
+        off to the I/O thread and answering everything else immediately
+        """
 
-            elif (message["cmd"] == COMMANDS["ping"]):
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+        replies = self._context.socket(zmq.PULL)
+        replies.bind(self._replies_address)
+
+        io_thread = threading.Thread(target = self._io_loop)
+        io_thread.daemon = True
+        io_thread.start()
+
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._results_socket, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+
+        running = True
+        while (running):
+            events = dict(poller.poll(LEASE_CHECK_INTERVAL_MS))
+            self._check_leases()
+
+            if (self._results_socket in events):
+                self._recv_results()
+
+            # responses to I/O commands that have finished
+            if (replies in events):
+                while (replies.poll(0)):
+                    self._socket.send_multipart(replies.recv_multipart())
+
+            while (self._socket.poll(0)):
+                frames = self._socket.recv_multipart()
+                if (b"" not in frames):
+                    continue
+                split = frames.index(b"") + 1
+                envelope = frames[:split]
+                try:
+                    message = decode_cmd(frames[split:])
+                except protocol.ProtocolError:
+                    self._socket.send_multipart(
+                        envelope + protocol.pack(RESPONSES["notok"])
+                    )
+                    continue
+
+                if (message["cmd"] == COMMANDS["exit"]):
+                    running = False
+                    break
+                elif (message["cmd"] in IO_COMMANDS):
+                    self._io_jobs.put((envelope, message))
+                else:
+                    self._socket.send_multipart(
+                        envelope + encode_rsp(
+                            message["cmd"], self.dispatch(message)
+                        )
+                    )
+
+        self._io_jobs.put(None)
+        io_thread.join()
+        replies.close()
+
+    def _io_loop(self):
+        """ Run I/O commands in the order that they were received, sending
+        responses back to the server thread
+        """
 
-            ## 2X ##############################################################
-            elif (message["cmd"] == COMMANDS["enqueue"]):
-                self.queue.append(zlib.compress(pickle.dumps(message["body"])))
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+        replies = self._context.socket(zmq.PUSH)
+        replies.connect(self._replies_address)
 
-            elif (message["cmd"] == COMMANDS["queue_pop"]):
-                if (len(self.queue) > 0):
-                    self.send_rsp({
-                        "rsp": RESPONSES["ok"],
-                        "body": pickle.loads(zlib.decompress(self.queue.pop()))
-                    })
-                else:
-                    self.send_rsp({
-                        "rsp": RESPONSES["queue_empty"],
-                    })
+        while True:
+            job = self._io_jobs.get()
+            if (job is None):
+                break
+            (envelope, message) = job
+            replies.send_multipart(
+                envelope + encode_rsp(message["cmd"], self.dispatch(message))
+            )
+
+        replies.close()
+
+    def _job_key(self, args, kwargs):
+        """ Return the key used to deduplicate a route, a nonzero 64-bit
+        digest of its rounded coordinates and keyword arguments other than its
+        attributes """
+
+        precision = self.dedup_precision
+        digest = hashlib.blake2b(
+            json.dumps(
+                [
+                    [float(round(coord, precision)) for coord in args],
+                    {
+                        key: value for (key, value) in kwargs.items()
+                        if ((key != "attributes")
+                            and (key not in SERVER_KWARGS))
+                    }
+                ],
+                sort_keys = True
+            ).encode("utf-8"),
+            digest_size = 8
+        ).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _add_job(self, item):
+        """ Give a route a job ID and add it to the queue, unless a route with
+        the same key is already queued or finished
+
+        Must be called while holding the server lock.
 
-            elif (message["cmd"] == COMMANDS["queue_size"]):
-                self.send_rsp({
-                    "rsp": RESPONSES["ok"],
-                    "body": len(self.queue)
-                })
-
-            elif (message["cmd"] == COMMANDS["queue_flush"]):
-                self.queue = []
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            ## 3X ##############################################################
-            elif (message["cmd"] == COMMANDS["open_file"]):
-                if (self._file):
-                    self._file.close()
-                self._file = open(
-                    message["body"]["filename"], message["body"]["mode"]
+        Args:
+            item: An (args, kwargs) tuple
+        """
+
+        # a route that already had a job, i.e. one reloaded from a saved
+        # queue, starts over as a new job that has never been delivered
+        (args, kwargs) = item
+        kwargs = {
+            key: value for (key, value) in kwargs.items()
+            if (key not in SERVER_KWARGS)
+        }
+
+        if (self.dedup_precision is not None):
+            key = self._job_key(args, kwargs)
+
+            job_id = self._pending.get(key)
+            if (job_id is not None):
+                self._waiters.setdefault(job_id, []).append(
+                    kwargs.get("attributes")
                 )
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            elif (message["cmd"] == COMMANDS["close_file"]):
-                assert self._file is not None
-                self._file.close()
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            elif (message["cmd"] == COMMANDS["write_to_disk"]):
-                assert self._file is not None
-                self._file.write("%s\n" % message["body"])
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            elif (message["cmd"] == COMMANDS["save_queue"]):
-                with open(message["body"]["filename"], "w") as f:
-                    for item in queue:
-                        f.write("%s\n" % pickle.loads(zlib.decompress(item)))
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            elif (message["cmd"] == COMMANDS["load_queue"]):
-                with open(message["body"]["filename"], "r") as f:
-                    while True:
-                        item = f.readline()
-                        if (len(item) == 0):
-                            break
-                        else:
-                            self.queue.append(
-                                zlib.compress(pickle.dumps(message["body"]))
-                            )
-                self.send_rsp({"rsp": RESPONSES["ok"]})
-
-            ## 4X ##############################################################
-            elif (message["cmd"] == COMMANDS["get_var"]):
-                if message["body"]["key"] in self.vars:
-                    self.send_rsp({
-                        "rsp": RESPONSES["ok"],
-                        "body": self.vars[message["body"]["key"]]
-                    })
-                else:
-                    self.send_rsp({
-                        "rsp": RESPONSES["ok"],
-                        "body": None
-                    })
+                self._log("wait", job_id, kwargs.get("attributes"))
+                self.dedup_stats["hits"] += 1
+                return
+
+            if (key in self._results):
+                self._results.move_to_end(key)
+                self._write_line(compose_record(
+                    json.dumps(kwargs.get("attributes")).encode("utf-8"),
+                    self._results[key]
+                ))
+                self.dedup_stats["cache_hits"] += 1
+                return
+
+            self.dedup_stats["misses"] += 1
+
+        job_id = self._next_job_id
+        self._next_job_id += 1
+        if (self.dedup_precision is not None):
+            self._pending[key] = job_id
+
+        kwargs = dict(kwargs)
+        kwargs["job_id"] = job_id
+        self.queue.append((args, kwargs))
+        self._log("enqueue", (args, kwargs))
+
+    def _finish_job(self, job_id, record):
+        """ Forget a finished job, returning the attributes of the duplicate
+        routes that were waiting on it
+
+        Must be called while holding the server lock.
+
+        Args:
+            job_id: The job ID of the finished job
+            record: The JSON encoded record without attributes, or None if
+                no route was found
+
+        Returns:
+            A list of attributes
+        """
+
+        if ((job_id in self._job_keys) or (job_id in self._waiters)
+                or (job_id in self._leases) or (job_id in self._requeued)
+                or (job_id in self._dead_jobs)):
+            self._log("finish", job_id)
+            self._ack(job_id)
+        key = self._job_keys.pop(job_id, None)
+        if (key is not None):
+            self._pending.pop(key)
+            if ((record is not None) and (self.result_cache_size > 0)):
+                self._results[key] = record
+                while (len(self._results) > self.result_cache_size):
+                    self._results.popitem(last = False)
+        return self._waiters.pop(job_id, [])
+
+    def _pop(self, n, names = None, modes = None):
+        """ Pop and lease up to n jobs, skipping jobs that were acknowledged
+        after their lease expired and they were put back on the queue
+
+        Must be called while holding the server lock.
+
+        Args:
+            n: The maximum number of jobs to pop
+            names: The names of the queues to pop from, or None for every queue
+            modes: The modes of the jobs to pop, or None for every mode
+
+        Returns:
+            A list of (args, kwargs) tuples, in the order of their queues
+        """
+
+        self._expire_leases()
+        items = []
+        popped = 0
+        while (len(items) < n):
+            batch = self.queue.pop_many(n - len(items), names, modes)
+            if (len(batch) == 0):
+                # pops are logged before expansions, so that they are replayed
+                # before the expanded routes are in the queue
+                if (popped > 0):
+                    self._log("pop", popped, names, modes)
+                    popped = 0
+                if (self._expand_matrices(n - len(items), names, modes) == 0):
+                    break
+                continue
+            popped += len(batch)
+            for item in batch:
+                item = self._lease(item)
+                if (item is not None):
+                    items.append(item)
+        if (popped > 0):
+            self._log("pop", popped, names, modes)
+        return items
+
+    def _add_matrix(self, matrix_id, matrix):
+        """ Add a matrix job, creating its queue if needed
+
+        Must be called while holding the server lock.
+        """
+
+        name = self._matrix_queue(matrix)
+        if (name not in self.queue):
+            self.queue.create(name)
+        self.matrices[matrix_id] = matrix
+        self._next_matrix_id = max(self._next_matrix_id, matrix_id + 1)
+
+    def _matrix_queue(self, matrix):
+        return matrix.kwargs.get("queue", queues.DEFAULT_QUEUE)
+
+    def _matrix_size(self, name = None):
+        """ Return the number of routes that are left to expand from the
+        matrix jobs of a queue, or of every queue if name is None """
+
+        return sum(
+            len(matrix) for matrix in self.matrices.values()
+            if ((name is None) or (self._matrix_queue(matrix) == name))
+        )
+
+    def _expand_matrices(self, n, names = None, modes = None):
+        """ Expand up to n routes from matrix jobs into the queue, taking
+        them from the matrix jobs of the queues with the highest priority
+        first, and from the oldest matrix job first
+
+        Must be called while holding the server lock.
+
+        Args:
+            n: The maximum number of routes to expand
+            names: The names of the queues whose matrix jobs to expand, or
+                None for every queue
+            modes: The modes of the matrix jobs to expand, or None for every
+                mode
+
+        Returns:
+            The number of routes that were expanded, some of which may have
+            been deduplicated rather than queued
+        """
+
+        candidates = [
+            (matrix_id, matrix) for (matrix_id, matrix)
+            in self.matrices.items()
+            if (((names is None) or (self._matrix_queue(matrix) in names))
+                and ((modes is None) or (matrix.kwargs.get("mode") in modes)))
+        ]
+        candidates.sort(
+            key = lambda candidate: -self.queue[
+                self._matrix_queue(candidate[1])
+            ].priority
+        )
+
+        expanded = 0
+        for (matrix_id, matrix) in candidates:
+            if (expanded >= n):
+                break
+            k = min(n - expanded, len(matrix))
+            self._log("expand", matrix_id, k)
+            for item in matrix.take(k):
+                self._add_job(item)
+            expanded += k
+            if (len(matrix) == 0):
+                del self.matrices[matrix_id]
+        return expanded
+
+    def _lease(self, item):
+        """ Lease a popped job
+
+        Must be called while holding the server lock.
+
+        Args:
+            item: The (args, kwargs) tuple popped from the queue
+
+        Returns:
+            The (args, kwargs) tuple to hand out, or None if the job has
+            already been acknowledged
+        """
+
+        (args, kwargs) = item
+        job_id = kwargs.get("job_id")
+        deliveries = kwargs.pop("deliveries", 0)
+        if (deliveries > 0):
+            if (job_id not in self._requeued):
+                return None
+            self._requeued.remove(job_id)
+
+        # only the keys of jobs that have been handed out are kept by job ID,
+        # as the keys of queued jobs can be recomputed from the queue
+        if ((self.dedup_precision is not None) and (job_id is not None)
+                and (job_id not in self._job_keys)):
+            self._job_keys[job_id] = self._job_key(args, kwargs)
+
+        if ((self.lease_timeout is not None) and (job_id is not None)):
+            leased = dict(kwargs)
+            leased["deliveries"] = deliveries + 1
+            self._leases[job_id] = (
+                time.time() + self.lease_timeout, (args, leased)
+            )
+            self.lease_stats["leased"] += 1
+
+        # workers are only given the arguments of Router.route
+        kwargs.pop("queue", None)
+        kwargs.pop("priority", None)
+        return (args, kwargs)
+
+    def _ack(self, job_id):
+        """ Release the lease of a finished job
+
+        Must be called while holding the server lock.
+        """
+
+        if ((self._leases.pop(job_id, None) is not None)
+                or (job_id in self._requeued)
+                or (self._dead_jobs.pop(job_id, None) is not None)):
+            self.lease_stats["acked"] += 1
+        self._requeued.discard(job_id)
+
+    def _expire_leases(self):
+        """ Put jobs whose leases have expired back on the queue, or on the
+        dead-letter queue if they have been handed out too many times
+
+        Must be called while holding the server lock.
+        """
+
+        now = time.time()
+        self._last_lease_check = now
+        while (len(self._leases) > 0):
+            (job_id, (deadline, item)) = next(iter(self._leases.items()))
+            if (deadline > now):
+                break
+            del self._leases[job_id]
+            self.lease_stats["expired"] += 1
+
+            if (item[1]["deliveries"] >= self.max_deliveries):
+                self._dead_jobs[job_id] = item
+                self._log("dead", job_id)
+            else:
+                self.queue.append(item)
+                self._requeued.add(job_id)
+                self._log("enqueue", item)
+
+    def _check_leases(self):
+        """ Expire leases if they have not been checked for a while """
+
+        if ((len(self._leases) > 0) and (
+                time.time() - self._last_lease_check
+                >= LEASE_CHECK_INTERVAL_MS / 1000)):
+            with self._lock:
+                self._expire_leases()
+                self._commit_journal()
+
+    def _write_line(self, line):
+        """ Queue a line to be written to the output file by the writer thread,
+        which holds on to it until a file is opened if there is no output file
+        yet
+
+        Args:
+            line: The line to write, as bytes
+        """
+
+        self.writer.write(line)
+
+    def _log(self, op, *args):
+        """ Log an operation to the journal, if there is one
 
-            elif (message["cmd"] == COMMANDS["set_var"]):
-                self.vars[message["body"]["key"]] = message["body"]["value"]
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+        Must be called while holding the server lock.
+
+        Args:
+            op: The name of a tnra.journal.Journal method
+            args: The arguments of the method
+        """
 
-            elif (message["cmd"] == COMMANDS["save_vars"]):
-                with open(message["body"]["filename"], "w") as f:
-                    json.dump(self.vars, f, indent = 4)
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+        if (self.journal is not None):
+            getattr(self.journal, op)(*args)
 
-            elif (message["cmd"] == COMMANDS["load_vars"]):
-                with open(message["body"]["filename"], "r") as f:
-                    self.vars = json.load(f)
-                self.send_rsp({"rsp": RESPONSES["ok"]})
+    def _commit_journal(self):
+        """ Write the logged operations to the journal, snapshotting the queue
+        if the journal has grown too large
+
+        Must be called while holding the server lock.
+        """
+
+        if (self.journal is not None):
+            self.journal.commit()
+            if (self.journal.should_snapshot()):
+                self._snapshot()
+
+    def _state(self):
+        """ Return the JSON serializable state that is snapshotted along with
+        the queue
+
+        Only the keys of jobs that have been popped but not finished are kept;
+        the keys of queued jobs are recomputed from the queue.
+        """
+
+        return {
+            "next_job_id": self._next_job_id,
+            "job_keys": list(self._job_keys.items()),
+            "waiters": list(self._waiters.items()),
+            "leases": [item for (deadline, item) in self._leases.values()],
+            "requeued": list(self._requeued),
+            "dead_letters": list(self._dead_jobs.values()),
+            "matrices": [
+                [matrix_id, matrix.to_dict()]
+                for (matrix_id, matrix) in self.matrices.items()
+            ]
+        }
+
+    def _snapshot(self):
+        """ Snapshot the queue and start a new journal
+
+        Must be called while holding the server lock.
+        """
+
+        self.journal.snapshot(self.queue, self._state())
+
+    def _recover(self, journal_):
+        """ Restore the queue and job state from a journal, replaying every
+        operation that was logged after the latest snapshot
+
+        Args:
+            journal_: The tnra.journal.Journal to recover from
+        """
+
+        (self.queue, state, ops) = journal_.recover()
+        if (state is not None):
+            self._next_job_id = state["next_job_id"]
+            for (job_id, key) in state["job_keys"]:
+                self._job_keys[job_id] = key
+                self._pending[key] = job_id
+            self._waiters.update(
+                (job_id, attributes) for (job_id, attributes)
+                in state["waiters"]
+            )
+            # leases start over, as workers may have been waiting on the
+            # server while it was down
+            deadline = time.time() + (
+                self.lease_timeout or DEFAULT_LEASE_TIMEOUT
+            )
+            for (args, kwargs) in state["leases"]:
+                self._leases[kwargs["job_id"]] = (deadline, (args, kwargs))
+            self._requeued.update(state["requeued"])
+            for (args, kwargs) in state["dead_letters"]:
+                self._dead_jobs[kwargs["job_id"]] = (args, kwargs)
+            for (matrix_id, matrix) in state.get("matrices", []):
+                self._add_matrix(
+                    matrix_id, queues.MatrixJob.from_dict(matrix)
+                )
+        if (self.dedup_precision is not None):
+            for (args, kwargs) in self.queue:
+                self._recover_job(args, kwargs)
+
+        for (op, argument) in ops:
+            if (op == "enqueue"):
+                self.queue.extend(argument)
+                for (args, kwargs) in argument:
+                    self._recover_job(args, kwargs)
+                    # expired and requeued dead letters
+                    job_id = kwargs["job_id"]
+                    if ("deliveries" in kwargs):
+                        self._leases.pop(job_id, None)
+                        self._requeued.add(job_id)
+                    else:
+                        self._dead_jobs.pop(job_id, None)
+            elif (op == "pop"):
+                (n, names, modes) = argument
+                for item in self.queue.pop_many(n, names, modes):
+                    self._lease(item)
+            elif (op == "dead"):
+                # the job is not leased if the server was restarted with
+                # leasing disabled
+                lease = self._leases.pop(argument, None)
+                if (lease is not None):
+                    self._dead_jobs[argument] = lease[1]
+            elif (op == "clear"):
+                self._flush_queue(argument)
+            elif (op == "create"):
+                self.queue.create(*argument)
+            elif (op == "drop"):
+                self._flush_queue(argument)
+                self.queue.drop(argument)
+            elif (op == "wait"):
+                (job_id, attributes) = argument
+                self._waiters.setdefault(job_id, []).append(attributes)
+            elif (op == "finish"):
+                self._finish_job(argument, None)
+            elif (op == "matrix"):
+                (matrix_id, matrix) = argument
+                self._add_matrix(
+                    matrix_id, queues.MatrixJob.from_dict(matrix)
+                )
+            elif (op == "expand"):
+                # the expanded routes follow as enqueued routes
+                (matrix_id, n) = argument
+                matrix = self.matrices[matrix_id]
+                matrix.position = min(matrix.position + n, matrix.size())
+                if (len(matrix) == 0):
+                    del self.matrices[matrix_id]
+
+    def _recover_job(self, args, kwargs):
+        """ Restore the job ID and key of a recovered route """
+
+        job_id = kwargs["job_id"]
+        self._next_job_id = max(self._next_job_id, job_id + 1)
+        if (self.dedup_precision is not None):
+            self._pending[self._job_key(args, kwargs)] = job_id
+
+    ## 1X ######################################################################
+    def _echo(self, body):
+        print(body)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _ping(self, body):
+        return {"rsp": RESPONSES["ok"]}
+
+    ## 2X ######################################################################
+    def _enqueue(self, body):
+        self._add_job(body)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _enqueue_many(self, body):
+        for item in body:
+            self._add_job(item)
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": len(body)
+        }
+
+    def _queue_pop(self, body):
+        body = body or {}
+        items = self._pop(1, body.get("queues"), body.get("modes"))
+        if (len(items) > 0):
+            return {
+                "rsp": RESPONSES["ok"],
+                "body": items[0]
+            }
+        else:
+            return {"rsp": RESPONSES["queue_empty"]}
+
+    def _queue_pop_many(self, body):
+        items = self._pop(body["n"], body.get("queues"), body.get("modes"))
+        if (len(items) > 0):
+            return {
+                "rsp": RESPONSES["ok"],
+                "body": items
+            }
+        else:
+            return {"rsp": RESPONSES["queue_empty"]}
+
+    def _queue_size(self, body):
+        name = (body or {}).get("queue")
+        if (name is None):
+            size = len(self.queue) + self._matrix_size()
+        elif (name in self.queue):
+            size = len(self.queue[name]) + self._matrix_size(name)
+        else:
+            size = 0
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": size
+        }
+
+    def _queue_flush(self, body):
+        name = (body or {}).get("queue")
+        self._log("clear", name)
+        self._flush_queue(name)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _flush_queue(self, name):
+        """ Remove every job from a queue, or from every queue if name is None,
+        along with the duplicates waiting on them
+
+        Must be called while holding the server lock.
+        """
+
+        if (name is None):
+            self.queue.clear()
+            self.matrices.clear()
+            self._pending.clear()
+            self._job_keys.clear()
+            self._waiters.clear()
+            self._leases.clear()
+            self._requeued.clear()
+        elif (name in self.queue):
+            for (args, kwargs) in self.queue[name]:
+                job_id = kwargs["job_id"]
+                self._job_keys.pop(job_id, None)
+                if (self.dedup_precision is not None):
+                    self._pending.pop(self._job_key(args, kwargs))
+                self._waiters.pop(job_id, None)
+                self._requeued.discard(job_id)
+            self.queue[name].clear()
+            for (matrix_id, matrix) in list(self.matrices.items()):
+                if (self._matrix_queue(matrix) == name):
+                    del self.matrices[matrix_id]
+
+    def _dedup_stats(self, body):
+        stats = dict(self.dedup_stats)
+        stats["pending"] = len(self._pending)
+        stats["cached"] = len(self._results)
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": stats
+        }
+
+    def _lease_stats(self, body):
+        stats = dict(self.lease_stats)
+        stats["leases"] = len(self._leases)
+        stats["requeued"] = len(self._requeued)
+        stats["dead_letters"] = len(self._dead_jobs)
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": stats
+        }
+
+    def _dead_letters(self, body):
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": list(itertools.islice(
+                self._dead_jobs.values(), body["n"]
+            ))
+        }
+
+    def _requeue_dead_letters(self, body):
+        items = list(self._dead_jobs.values())
+        self._dead_jobs.clear()
+        for (args, kwargs) in items:
+            kwargs = dict(kwargs)
+            del kwargs["deliveries"]
+            self.queue.append((args, kwargs))
+            self._log("enqueue", (args, kwargs))
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": len(items)
+        }
+
+    ## 3X ######################################################################
+    def _open_file(self, body):
+        # records are written as they were received, so the file is always
+        # opened in binary mode
+        self.writer.open(
+            body["filename"], body["mode"], body.get("format", "jsonl")
+        )
+        return {"rsp": RESPONSES["ok"]}
+
+    def _close_file(self, body):
+        self.writer.close()
+        return {"rsp": RESPONSES["ok"]}
+
+    def _write_to_disk(self, body):
+        self._write_line(body)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _write_result(self, body):
+        (job_id, attributes, record) = body
+        if (len(record) == 0):
+            record = None
+
+        with self._lock:
+            waiters = self._finish_job(job_id, record)
+
+        if (record is not None):
+            self._write_line(compose_record(attributes, record))
+            for waiter_attributes in waiters:
+                self._write_line(compose_record(
+                    json.dumps(waiter_attributes).encode("utf-8"), record
+                ))
+        return {"rsp": RESPONSES["ok"]}
+
+    def _sink_flush(self, body):
+        self._flushed_tokens.add(body)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _sink_flushed(self, body):
+        if (body in self._flushed_tokens):
+            self._flushed_tokens.remove(body)
+            return {
+                "rsp": RESPONSES["ok"],
+                "body": True
+            }
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": False
+        }
+
+    def _write_stats(self, body):
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": self.writer.stats()
+        }
+
+    def _save_queue(self, body):
+        with self._lock:
+            journal.write_snapshot(body["filename"], 0, self.queue, None)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _load_queue(self, body):
+        # routes are enqueued again, in batches so that other commands are not
+        # blocked for too long, and get new job IDs
+        (loaded, state) = journal.read_snapshot(body["filename"])
+        with self._lock:
+            for name in loaded.names():
+                if (name not in self.queue):
+                    self._create_queue({
+                        "name": name,
+                        "ordering": loaded[name].ordering,
+                        "priority": loaded[name].priority
+                    })
+        items = iter(loaded)
+        while True:
+            batch = list(itertools.islice(items, DEFAULT_BATCH_SIZE))
+            if (len(batch) == 0):
+                break
+            with self._lock:
+                for item in batch:
+                    self._add_job(item)
+                self._commit_journal()
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": len(loaded)
+        }
+
+    ## 4X ######################################################################
+    def _get_var(self, body):
+        if body["key"] in self.vars:
+            return {
+                "rsp": RESPONSES["ok"],
+                "body": self.vars[body["key"]]
+            }
+        else:
+            return {
+                "rsp": RESPONSES["ok"],
+                "body": None
+            }
+
+    def _set_var(self, body):
+        self.vars[body["key"]] = body["value"]
+        return {"rsp": RESPONSES["ok"]}
+
+    def _save_vars(self, body):
+        with self._lock:
+            vars_ = dict(self.vars)
+        with open(body["filename"], "w") as f:
+            json.dump(vars_, f, indent = 4)
+        return {"rsp": RESPONSES["ok"]}
+
+    def _load_vars(self, body):
+        with open(body["filename"], "r") as f:
+            vars_ = json.load(f)
+        with self._lock:
+            self.vars = vars_
+        return {"rsp": RESPONSES["ok"]}
+
+    ## 5X ######################################################################
+    def _create_queue(self, body):
+        try:
+            self.queue.create(
+                body["name"], body["ordering"], body["priority"]
+            )
+        except ValueError:
+            return {"rsp": RESPONSES["notok"]}
+        self._log("create", body["name"], body["ordering"], body["priority"])
+        return {"rsp": RESPONSES["ok"]}
+
+    def _drop_queue(self, body):
+        if (body["name"] in self.queue):
+            self._log("drop", body["name"])
+            self._flush_queue(body["name"])
+            self.queue.drop(body["name"])
+        return {"rsp": RESPONSES["ok"]}
+
+    def _enqueue_matrix(self, body):
+        try:
+            matrix = queues.MatrixJob(
+                body["origins"], body["destinations"], body.get("kwargs"),
+                body.get("origin_attributes"),
+                body.get("destination_attributes")
+            )
+        except ValueError:
+            return {"rsp": RESPONSES["notok"]}
+        if (matrix.size() == 0):
+            return {"rsp": RESPONSES["notok"]}
+        matrix_id = self._next_matrix_id
+        self._log("matrix", matrix_id, matrix.to_dict())
+        self._add_matrix(matrix_id, matrix)
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": {
+                "matrix_id": matrix_id,
+                "routes": matrix.size()
+            }
+        }
+
+    def _queue_info(self, body):
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": [
+                {
+                    "name": name,
+                    "ordering": self.queue[name].ordering,
+                    "priority": self.queue[name].priority,
+                    "size": len(self.queue[name]) + self._matrix_size(name),
+                    "matrix_routes": self._matrix_size(name),
+                    "modes": self.queue[name].modes()
+                }
+                for name in self.queue.names()
+            ]
+        }
+
+    ## 6X ######################################################################
+    def _stats(self, body):
+        stats = self.stats.summary()
+        stats["queue_size"] = len(self.queue) + self._matrix_size()
+        stats["leases"] = len(self._leases)
+        stats["dead_letters"] = len(self._dead_jobs)
+        stats["lines_written"] = self.writer.lines_written
+        stats["time"] = time.time()
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": stats
+        }
+
+    def _report_stats(self, body):
+        self.stats.report(body["worker"], body["metrics"])
+        return {"rsp": RESPONSES["ok"]}
+
+    def _register_node(self, body):
+        node = dict(body["info"])
+        node["last_seen"] = time.time()
+        self.nodes[body["name"]] = node
+        return {"rsp": RESPONSES["ok"]}
+
+    def _nodes(self, body):
+        return {
+            "rsp": RESPONSES["ok"],
+            "body": self.nodes
+        }
 
 class Client(object):
 
@@ -216,31 +1468,35 @@ class Client(object):
         self._poller.register(self._socket, zmq.POLLIN)
 
         self.port = port
+        self._last_cmd = None
 
     def send_cmd(self, message):
-        """ Wrapper for zmq.Context.socket.send
+        """ Wrapper for zmq.Context.socket.send_multipart
 
         Args:
             message: The message to send
         """
 
         assert "cmd" in message, "Poorly formatted command"
-        self._socket.send(pickle.dumps(message))
+        self._last_cmd = message["cmd"]
+        self._socket.send_multipart(encode_cmd(message))
 
     def recv_rsp(self):
-        """ Wrapper for zmq.Context.socket.recv
+        """ Wrapper for zmq.Context.socket.recv_multipart
 
         Returns:
             The received message
         """
 
         if (self._poller.poll(DEFAULT_TIMEOUT_MS)):
-            message = pickle.loads(self._socket.recv())
-            assert "rsp" in message, "Poorly formatted response"
-            return message
+            return decode_rsp(self._last_cmd, self._socket.recv_multipart())
         else:
             raise TimeoutError
 
+    def close(self):
+        self._socket.close()
+        self._context.term()
+
     ## 1X ######################################################################
     def exit(self):
         self.send_cmd({"cmd": COMMANDS["exit"]})
@@ -259,22 +1515,179 @@ class Client(object):
 
     ## 2X ######################################################################
     def enqueue(self, *args, **kwargs):
+        """ Enqueue a route, given the arguments of tnra.router.Router.route
+        other than job_id (see route_item) """
+
         self.send_cmd({
             "cmd": COMMANDS["enqueue"],
-            "body": (args, kwargs)
+            "body": route_item(args, kwargs)
+        })
+        return parse_body(self.recv_rsp())
+
+    def enqueue_many(self, routes, attributes = None,
+                     batch_size = DEFAULT_BATCH_SIZE, verbose = False,
+                     **kwargs):
+        """ Enqueue many routes, sending them to the server in batches
+
+        Args:
+            routes: An iterable of (origin_x, origin_y, dest_x, dest_y)
+                sequences, or a NumPy array with one such row per route; the
+                sequences can be followed by the other positional arguments of
+                tnra.router.Router.route (see route_item)
+            attributes: An optional iterable of route attributes, with one item
+                per route
+            batch_size: The number of routes to send per round trip
+            verbose: Whether or not to print the running enqueue rate
+            kwargs: Keyword arguments shared by every route (i.e. mode)
+
+        Returns:
+            The number of routes that were enqueued
+
+        Raises:
+            EnqueueError: The server rejected a batch; the routes before it
+                were enqueued, and those in and after it were not
+        """
+
+        if (hasattr(routes, "tolist")):
+            routes = routes.tolist()
+        if (attributes is None):
+            attributes = itertools.repeat(None)
+
+        rows = zip(routes, attributes)
+        n_enqueued = 0
+        start_time = time.time()
+
+        while True:
+            batch = []
+            for (coords, route_attributes) in itertools.islice(rows,
+                                                               batch_size):
+                route_kwargs = dict(kwargs)
+                if (route_attributes is not None):
+                    route_kwargs["attributes"] = route_attributes
+                batch.append(route_item(coords, route_kwargs))
+            if (len(batch) == 0):
+                break
+
+            self.send_cmd({
+                "cmd": COMMANDS["enqueue_many"],
+                "body": batch
+            })
+            if (parse_body(self.recv_rsp()) is None):
+                if (verbose):
+                    print("")
+                raise EnqueueError(n_enqueued)
+            n_enqueued += len(batch)
+
+            if (verbose):
+                sys.stdout.write("\r%d routes enqueued (%.0f routes/s)" % (
+                    n_enqueued, n_enqueued / (time.time() - start_time)
+                ))
+                sys.stdout.flush()
+
+        if (verbose):
+            print("")
+
+        return n_enqueued
+
+    def queue_pop(self, queues = None, modes = None):
+        """ Pop an item from the queues
+
+        Args:
+            queues: The names of the queues to pop from, or None for every
+                queue
+            modes: The modes of the items to pop, or None for every mode
+
+        Returns:
+            An (args, kwargs) tuple, or None if the queues are empty
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["queue_pop"],
+            "body": {
+                "queues": queues,
+                "modes": modes
+            }
         })
         return parse_body(self.recv_rsp())
 
-    def queue_pop(self):
-        self.send_cmd({"cmd": COMMANDS["queue_pop"]})
+    def queue_pop_many(self, n, queues = None, modes = None):
+        """ Pop up to n items from the queues in a single round trip
+
+        Args:
+            n: The maximum number of items to pop
+            queues: The names of the queues to pop from, or None for every
+                queue
+            modes: The modes of the items to pop, or None for every mode
+
+        Returns:
+            A list of (args, kwargs) tuples, or None if the queues are empty
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["queue_pop_many"],
+            "body": {
+                "n": n,
+                "queues": queues,
+                "modes": modes
+            }
+        })
         return parse_body(self.recv_rsp())
 
-    def queue_size(self):
-        self.send_cmd({"cmd": COMMANDS["queue_size"]})
+    def dedup_stats(self):
+        """ Return the deduplication hit and miss counters of the server """
+
+        self.send_cmd({"cmd": COMMANDS["dedup_stats"]})
         return parse_body(self.recv_rsp())
 
-    def queue_flush(self):
-        self.send_cmd({"cmd": COMMANDS["queue_flush"]})
+    def lease_stats(self):
+        """ Return the lease counters of the server """
+
+        self.send_cmd({"cmd": COMMANDS["lease_stats"]})
+        return parse_body(self.recv_rsp())
+
+    def dead_letters(self, n = 100):
+        """ Return up to n of the oldest jobs in the dead-letter queue,
+        without removing them
+
+        Returns:
+            A list of (args, kwargs) tuples, where kwargs include the number
+            of times that the job was handed out as "deliveries"
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["dead_letters"],
+            "body": {
+                "n": n
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def requeue_dead_letters(self):
+        """ Move every job in the dead-letter queue back onto the queue
+
+        Returns:
+            The number of jobs that were requeued
+        """
+
+        self.send_cmd({"cmd": COMMANDS["requeue_dead_letters"]})
+        return parse_body(self.recv_rsp())
+
+    def queue_size(self, queue = None):
+        self.send_cmd({
+            "cmd": COMMANDS["queue_size"],
+            "body": {
+                "queue": queue
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def queue_flush(self, queue = None):
+        self.send_cmd({
+            "cmd": COMMANDS["queue_flush"],
+            "body": {
+                "queue": queue
+            }
+        })
         return parse_body(self.recv_rsp())
 
     ## 3X ######################################################################
@@ -282,12 +1695,22 @@ class Client(object):
         self.send_cmd({"cmd": COMMANDS["close_file"]})
         return parse_body(self.recv_rsp())
 
-    def open_file(self, filename, mode = "w"):
+    def open_file(self, filename, mode = "w", format = "jsonl"):
+        """ Open the output file on the server
+
+        Args:
+            filename: The path of the file on the server
+            mode: "w" to overwrite the file or "a" to append to it
+            format: "jsonl" for one JSON record per line, or "blocks" for a
+                compressed tnra.blockfile block file
+        """
+
         self.send_cmd({
             "cmd": COMMANDS["open_file"],
             "body": {
                 "filename": filename,
-                "mode": mode
+                "mode": mode,
+                "format": format
             }
         })
         return parse_body(self.recv_rsp())
@@ -299,7 +1722,39 @@ class Client(object):
         })
         return parse_body(self.recv_rsp())
 
-    def save_queue(self, filename = "queue.json"):
+    def write_result(self, record, attributes = None, job_id = None):
+        """ Send the result of a job to the server to be written to disk
+
+        Args:
+            record: A JSON serializable dict holding the result of the route,
+                without its attributes, or None if no route was found
+            attributes: The attributes of the route
+            job_id: The job ID that the route was popped with, if any
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["write_result"],
+            "body": result_body(record, attributes, job_id)
+        })
+        return parse_body(self.recv_rsp())
+
+    def sink_flushed(self, token):
+        """ Return whether or not the server has received a ResultSink flush
+        marker with the given token """
+
+        self.send_cmd({
+            "cmd": COMMANDS["sink_flushed"],
+            "body": token
+        })
+        return parse_body(self.recv_rsp())
+
+    def write_stats(self):
+        """ Return the write throughput statistics of the server """
+
+        self.send_cmd({"cmd": COMMANDS["write_stats"]})
+        return parse_body(self.recv_rsp())
+
+    def save_queue(self, filename = "queue.snapshot"):
         self.send_cmd({
             "cmd": COMMANDS["save_queue"],
             "body": {
@@ -365,8 +1820,301 @@ class Client(object):
         })
         return parse_body(self.recv_rsp())
 
+    ## 5X ######################################################################
+    def create_queue(self, name, ordering = queues.DEFAULT_ORDERING,
+                     priority = 0):
+        """ Create a named queue, or change the priority of an existing one
+
+        Routes are enqueued to a named queue by passing its name as the
+        "queue" keyword argument of enqueue or enqueue_many. Queues that do not
+        exist when a route is enqueued to them are created with the default
+        ordering.
+
+        Args:
+            name: The name of the queue
+            ordering: "lifo", "fifo", or "priority" to pop routes with the
+                highest "priority" keyword argument first
+            priority: Routes are popped from queues with higher priorities
+                first
+
+        Returns:
+            True, or None if the queue already exists with another ordering
+            and is not empty
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["create_queue"],
+            "body": {
+                "name": name,
+                "ordering": ordering,
+                "priority": priority
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def drop_queue(self, name):
+        """ Remove a named queue and every route in it """
+
+        self.send_cmd({
+            "cmd": COMMANDS["drop_queue"],
+            "body": {
+                "name": name
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def enqueue_matrix(self, origins, destinations, origin_attributes = None,
+                       destination_attributes = None, **kwargs):
+        """ Enqueue every route between a set of origins and a set of
+        destinations as a single matrix job, which the server expands into
+        routes as they are popped
+
+        A route's attributes are the attributes of its origin updated with
+        those of its destination; origins and destinations without attributes
+        are identified by their index, as {"origin": i} and
+        {"destination": j}.
+
+        Args:
+            origins, destinations: Iterables of (x, y) coordinates, or NumPy
+                arrays with one such row per point
+            origin_attributes, destination_attributes: Optional lists of dicts
+                of attributes, with one item per origin or destination
+            kwargs: Keyword arguments shared by every route (i.e. mode, or
+                queue)
+
+        Returns:
+            A dict with the "matrix_id" of the job and its number of
+            "routes", or None if the matrix is empty or its attributes do not
+            match its origins and destinations
+        """
+
+        if (hasattr(origins, "tolist")):
+            origins = origins.tolist()
+        if (hasattr(destinations, "tolist")):
+            destinations = destinations.tolist()
+
+        self.send_cmd({
+            "cmd": COMMANDS["enqueue_matrix"],
+            "body": {
+                "origins": [tuple(coords) for coords in origins],
+                "destinations": [tuple(coords) for coords in destinations],
+                "origin_attributes": origin_attributes,
+                "destination_attributes": destination_attributes,
+                "kwargs": kwargs
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def queue_info(self):
+        """ Return the name, ordering, priority, size and modes of every queue,
+        where the size includes "matrix_routes", the routes of matrix jobs
+        that have not been expanded yet
+        """
+
+        self.send_cmd({"cmd": COMMANDS["queue_info"]})
+        return parse_body(self.recv_rsp())
+
+    ## 6X ######################################################################
+    def stats(self):
+        """ Return the route metrics reported by workers, with the state of
+        the queue
+
+        Returns:
+            A dict holding "modes" and "total", the counters, latency
+            percentiles and routes per second of every mode and of every mode
+            combined (see tnra.metrics.StatsAggregator.summary); "workers",
+            the number of workers that reported recently; "queue_size",
+            "leases", "dead_letters" and "lines_written"; and "time", the
+            server time of the stats
+        """
+
+        self.send_cmd({"cmd": COMMANDS["stats"]})
+        return parse_body(self.recv_rsp())
+
+    def register_node(self, name, info):
+        """ Register a worker node with the server, or update what it
+        registered with
+
+        Args:
+            name: A name that identifies the node, i.e. its host name
+            info: A JSON serializable dict describing the node, i.e. its
+                number of router processes and routing engines
+        """
+
+        self.send_cmd({
+            "cmd": COMMANDS["register_node"],
+            "body": {
+                "name": name,
+                "info": info
+            }
+        })
+        return parse_body(self.recv_rsp())
+
+    def nodes(self):
+        """ Return a dict of node name -> the info that the node last
+        registered with, along with "last_seen", the server time that it did
+        """
+
+        self.send_cmd({"cmd": COMMANDS["nodes"]})
+        return parse_body(self.recv_rsp())
+
+class ResultSink(object):
+
+    """ Client that pushes results to the server over a PUSH socket, without
+    waiting for them to be written to disk """
+
+    def __init__(self, host = "localhost", port = DEFAULT_RESULT_PORT,
+                 linger_ms = DEFAULT_SINK_LINGER_MS):
+        """ Initializes ResultSink object
+
+        Args:
+            host, port: The location of the result socket of the TNRA server
+            linger_ms: How long to keep trying to deliver unsent results
+                after the sink is closed
+        """
+
+        self._context = zmq.Context()
+
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.LINGER, linger_ms)
+        self._socket.connect("tcp://%s:%d" % (host, port))
+
+        self.port = port
+        self.sent = 0
+
+    def write_result(self, record, attributes = None, job_id = None):
+        """ Send the result of a job to the server to be written to disk
+
+        See Client.write_result for a description of the arguments.
+        """
+
+        self._socket.send_multipart(encode_cmd({
+            "cmd": COMMANDS["write_result"],
+            "body": result_body(record, attributes, job_id)
+        }))
+        self.sent += 1
+
+    def report_stats(self, report, worker = None):
+        """ Send route metrics to the server
+
+        Args:
+            report: The output of tnra.metrics.Metrics.take
+            worker: A name that identifies the worker, by default its host
+                name and process ID
+        """
+
+        if (worker is None):
+            worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self._socket.send_multipart(encode_cmd({
+            "cmd": COMMANDS["report_stats"],
+            "body": {
+                "worker": worker,
+                "metrics": report
+            }
+        }))
+
+    def flush(self, client, timeout = DEFAULT_SINK_FLUSH_TIMEOUT_S):
+        """ Wait until the server has handled every result sent so far
+
+        A marker is pushed behind the results that have been sent, and the
+        server is polled until it reports having received the marker.
+
+        Args:
+            client: A Client connected to the same server
+            timeout: The number of seconds to wait
+
+        Raises:
+            TimeoutError: The server did not receive the marker in time
+        """
+
+        token = uuid.uuid4().hex
+        self._socket.send_multipart(encode_cmd({
+            "cmd": COMMANDS["sink_flush"],
+            "body": token
+        }))
+
+        deadline = time.time() + timeout
+        while (not client.sink_flushed(token)):
+            if (time.time() > deadline):
+                raise TimeoutError
+            time.sleep(0.01)
+
+    def close(self):
+        self._socket.close()
+        self._context.term()
+
 def start_server():
-    server = Server()
+    parser = argparse.ArgumentParser(description = "Start the TNRA server")
+    parser.add_argument("-p", "--port", type = int, default = DEFAULT_PORT,
+                        help = "The port to listen on")
+    parser.add_argument("-r", "--result-port", type = int,
+                        default = DEFAULT_RESULT_PORT,
+                        help = "The port to receive results on")
+    parser.add_argument("-e", "--engine", choices = ENGINES,
+                        default = DEFAULT_ENGINE,
+                        help = "The server engine to use")
+    parser.add_argument("--dedup-precision", type = int,
+                        default = DEFAULT_DEDUP_PRECISION,
+                        help = "Decimal places to round coordinates to when "
+                               "deduplicating routes")
+    parser.add_argument("--no-dedup", action = "store_true",
+                        help = "Do not deduplicate routes")
+    parser.add_argument("--result-cache-size", type = int,
+                        default = DEFAULT_RESULT_CACHE_SIZE,
+                        help = "Number of finished results to keep for reuse")
+    parser.add_argument("--flush-bytes", type = int,
+                        default = writer.DEFAULT_FLUSH_BYTES,
+                        help = "Number of buffered bytes that triggers a write")
+    parser.add_argument("--flush-interval", type = float,
+                        default = writer.DEFAULT_FLUSH_INTERVAL,
+                        help = "Maximum number of seconds to buffer results")
+    parser.add_argument("--fsync-interval", type = float,
+                        default = writer.DEFAULT_FSYNC_INTERVAL,
+                        help = "Minimum number of seconds between fsyncs; by "
+                               "default, the output file is never fsynced")
+    parser.add_argument("--lease-timeout", type = float,
+                        default = DEFAULT_LEASE_TIMEOUT,
+                        help = "Seconds that workers have to finish a popped "
+                               "job before it is put back on the queue")
+    parser.add_argument("--no-leases", action = "store_true",
+                        help = "Do not lease popped jobs")
+    parser.add_argument("--max-deliveries", type = int,
+                        default = DEFAULT_MAX_DELIVERIES,
+                        help = "Number of times a job is handed out before it "
+                               "is moved to the dead-letter queue")
+    parser.add_argument("-j", "--journal-dir",
+                        help = "Directory to journal the queue to, so that it "
+                               "survives the server restarting")
+    parser.add_argument("--snapshot-bytes", type = int,
+                        default = journal.DEFAULT_SNAPSHOT_BYTES,
+                        help = "Journal size after which the queue is "
+                               "snapshotted")
+    parser.add_argument("--journal-fsync-interval", type = float,
+                        default = journal.DEFAULT_FSYNC_INTERVAL,
+                        help = "Minimum number of seconds between fsyncs of "
+                               "the journal; by default, it is never fsynced")
+    args = parser.parse_args()
+
+    if (args.no_dedup):
+        args.dedup_precision = None
+    if (args.no_leases):
+        args.lease_timeout = None
+
+    server = Server(
+        args.port, args.engine, args.dedup_precision, args.result_cache_size,
+        args.result_port,
+        {
+            "flush_bytes": args.flush_bytes,
+            "flush_interval": args.flush_interval,
+            "fsync_interval": args.fsync_interval
+        },
+        args.journal_dir,
+        {
+            "snapshot_bytes": args.snapshot_bytes,
+            "fsync_interval": args.journal_fsync_interval
+        },
+        args.lease_timeout, args.max_deliveries
+    )
     print("Starting TNRA server...")
     server.start()
     server.join()
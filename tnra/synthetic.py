@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# synthetic routing backend for benchmarks and tests
+#
+# SyntheticDistances has the interface of the route_distances calculators that
+# tnra.Router uses, but calculates nothing: it waits for a configurable latency,
+# fails a configurable share of routes, and returns a duration and distance
+# derived from the great-circle distance between the origin and destination
+# along with a padded response of a configurable size. It can be passed as the
+# router of tnra.start_routers to measure the overhead of TNRA itself without
+# OpenTripPlanner or a real graph.
+
+import math
+import random
+import time
+
+DEFAULT_LATENCY = 0.05        # seconds that a route takes
+DEFAULT_LATENCY_SD = 0.0      # standard deviation of the latency, in seconds
+DEFAULT_FAILURE_RATE = 0.0    # share of routes that are not found
+DEFAULT_RESPONSE_SIZE = 20000 # approximate size of a response, in bytes
+
+EARTH_RADIUS_M = 6371000
+
+SPEEDS = { # meters per second
+    "walk": 1.4,
+    "bike": 4.5,
+    "transit": 6.0,
+    "drive": 11.0
+}
+DEFAULT_SPEED = 5.0
+
+def haversine(origin_x, origin_y, dest_x, dest_y):
+    """ Return the great-circle distance between two points, in meters
+
+    Args:
+        origin_x, origin_y, dest_x, dest_y: Longitudes and latitudes, in
+            degrees
+    """
+
+    (lon1, lat1, lon2, lat2) = map(
+        math.radians, (origin_x, origin_y, dest_x, dest_y)
+    )
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+class SyntheticDistances(object):
+
+    """ Fake route_distances calculator with a configurable latency, failure
+    rate and response size
+
+    Durations and distances only depend on the route, so that results can be
+    compared between runs; latencies and failures are random.
+    """
+
+    def __init__(self, latency = DEFAULT_LATENCY,
+                 latency_sd = DEFAULT_LATENCY_SD,
+                 failure_rate = DEFAULT_FAILURE_RATE,
+                 response_size = DEFAULT_RESPONSE_SIZE, seed = None,
+                 entrypoint = None):
+        """ Initializes SyntheticDistances object
+
+        Args:
+            latency: The mean number of seconds that a route takes
+            latency_sd: The standard deviation of the number of seconds that a
+                route takes; latencies are drawn from a normal distribution
+                and cut off at 0
+            failure_rate: The share of routes for which no route is found
+            response_size: The approximate size of the response of a route
+                once encoded as JSON, in bytes
+            seed: The seed of the random number generator, or None to seed it
+                from the system
+            entrypoint: The entrypoint of a routing engine, which is kept but
+                otherwise ignored, so that a pool of fake engines can be
+                balanced between (see tnra.balancer)
+        """
+
+        self.latency = latency
+        self.latency_sd = latency_sd
+        self.failure_rate = failure_rate
+        self.response_size = response_size
+        self.entrypoint = entrypoint
+
+        self._random = random.Random(seed)
+        self._padding = "x" * response_size
+
+    def distance(self, origin_x, origin_y, dest_x, dest_y, mode = "walk",
+                 departure_time = None):
+        """ Pretend to calculate a route
+
+        Args:
+            origin_x, origin_y, dest_x, dest_y: Routing arguments
+            mode: The mode of transportation, which sets the speed of travel
+            departure_time: The datetime.datetime of departure, which is
+                ignored
+
+        Returns:
+            A dict with "duration" in seconds, "distance" in meters and
+            "response" keys, or None if no route was found
+        """
+
+        if (self.latency_sd > 0):
+            latency = self._random.gauss(self.latency, self.latency_sd)
+        else:
+            latency = self.latency
+        if (latency > 0):
+            time.sleep(latency)
+
+        if ((self.failure_rate > 0)
+                and (self._random.random() < self.failure_rate)):
+            return None
+
+        distance = haversine(origin_x, origin_y, dest_x, dest_y)
+        duration = distance / SPEEDS.get(mode, DEFAULT_SPEED)
+        return {
+            "duration": duration,
+            "distance": distance,
+            "response": {
+                "plan": {
+                    "from": {"lon": origin_x, "lat": origin_y},
+                    "to": {"lon": dest_x, "lat": dest_y},
+                    "itineraries": [{
+                        "duration": duration,
+                        "walkDistance": distance
+                    }]
+                },
+                "padding": self._padding
+            }
+        }
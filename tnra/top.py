@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# live view of the throughput, latency and progress of a TNRA run
+
+import argparse
+import collections
+import datetime
+import time
+
+from . import server
+
+DEFAULT_INTERVAL = 2.0 # seconds between refreshes
+DEFAULT_WINDOW = 60.0  # seconds of history that the drain rate is taken over
+
+CLEAR_SCREEN = "\x1b[2J\x1b[H"
+
+class QueueTrend(object):
+
+    """ Estimates how fast the remaining routes are being finished from the
+    recent number of routes that are queued or leased; leased routes are
+    counted so that routes buffered by workers are not counted as done """
+
+    def __init__(self, window = DEFAULT_WINDOW):
+        self.window = window
+        self._sizes = collections.deque() # (time, remaining routes)
+
+    def add(self, now, size):
+        self._sizes.append((now, size))
+        while ((len(self._sizes) > 2)
+                and (self._sizes[1][0] <= now - self.window)):
+            self._sizes.popleft()
+
+    def rate(self):
+        """ Return the number of routes finished per second, or None if there
+        are not enough sizes yet """
+
+        if (len(self._sizes) < 2):
+            return None
+        ((first_time, first_size), (last_time, last_size)) = (
+            self._sizes[0], self._sizes[-1]
+        )
+        if (last_time <= first_time):
+            return None
+        return (first_size - last_size) / (last_time - first_time)
+
+    def eta(self):
+        """ Return the number of seconds until every route is finished, or
+        None if the remaining routes are not going down """
+
+        rate = self.rate()
+        if ((rate is None) or (rate <= 0)):
+            return None
+        return self._sizes[-1][1] / rate
+
+def format_seconds(seconds):
+    if (seconds is None):
+        return "-"
+    return str(datetime.timedelta(seconds = int(seconds)))
+
+def format_ms(seconds):
+    if (seconds is None):
+        return "-"
+    return "%.1f" % (seconds * 1000)
+
+def render(stats, trend, host, port):
+    """ Return the text of one refresh of the view
+
+    Args:
+        stats: The output of tnra.Client.stats
+        trend: The QueueTrend of the queue
+        host, port: The location of the TNRA server
+
+    Returns:
+        The text to print, as str
+    """
+
+    lines = []
+    lines.append("tnra_top - %s:%d - %s" % (
+        host, port, time.strftime("%H:%M:%S", time.localtime(stats["time"]))
+    ))
+    lines.append(
+        "queue: %d   leases: %d   dead letters: %d   workers: %d   "
+        "written: %d" % (
+            stats["queue_size"], stats["leases"], stats["dead_letters"],
+            stats["workers"], stats["lines_written"]
+        )
+    )
+    rate = trend.rate()
+    lines.append("drain: %s routes/s   ETA: %s" % (
+        "-" if (rate is None) else "%.1f" % rate, format_seconds(trend.eta())
+    ))
+    lines.append("")
+
+    header = "%-12s %10s %9s %7s %8s %8s %8s %8s %8s %8s" % (
+        "mode", "routes", "routes/s", "fail %", "cache %",
+        "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"
+    )
+    lines.append(header)
+    rows = sorted(stats["modes"].items())
+    if (len(rows) > 1):
+        rows.append(("total", stats["total"]))
+    for (mode, counts) in rows:
+        latency = counts["latency"]
+        routes = counts["routes"]
+        lines.append("%-12s %10d %9.1f %7.2f %8.2f %8s %8s %8s %8s %8s" % (
+            mode[:12], routes, counts["routes_per_second"],
+            100 * counts["failure_rate"],
+            100 * counts["cache_hits"] / routes if routes else 0.0,
+            format_ms(latency["mean"]), format_ms(latency["p50"]),
+            format_ms(latency["p90"]), format_ms(latency["p99"]),
+            format_ms(latency["max"])
+        ))
+    return "\n".join(lines)
+
+def start_top():
+    parser = argparse.ArgumentParser(
+        description = "Show the live throughput, latency and ETA of a TNRA run"
+    )
+    parser.add_argument("-H", "--host", default = "localhost",
+                        help = "The host of the TNRA server")
+    parser.add_argument("-p", "--port", type = int,
+                        default = server.DEFAULT_PORT,
+                        help = "The port of the TNRA server")
+    parser.add_argument("-i", "--interval", type = float,
+                        default = DEFAULT_INTERVAL,
+                        help = "Seconds between refreshes")
+    parser.add_argument("-w", "--window", type = float,
+                        default = DEFAULT_WINDOW,
+                        help = "Seconds of history to estimate the ETA from")
+    parser.add_argument("--once", action = "store_true",
+                        help = "Print the stats once and exit, without "
+                               "clearing the screen")
+    args = parser.parse_args()
+
+    client = server.Client(args.host, args.port)
+    trend = QueueTrend(args.window)
+    try:
+        while True:
+            try:
+                stats = client.stats()
+            except server.TimeoutError:
+                # a REQ socket cannot send again until it gets a reply
+                client = server.Client(args.host, args.port)
+                print("%sNo response from %s:%d" % (
+                    "" if args.once else CLEAR_SCREEN, args.host, args.port
+                ))
+            else:
+                trend.add(stats["time"], stats["queue_size"] + stats["leases"])
+                print("%s%s" % (
+                    "" if args.once else CLEAR_SCREEN,
+                    render(stats, trend, args.host, args.port)
+                ))
+            if (args.once):
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
@@ -1,111 +1,229 @@
 #!/usr/bin/env python3
-# responsible for calculations
-# BROKEN - assumes old Redis server
-
-import atexit
+# starts the routing engines and routers of a worker node
+#
+# A worker node connects directly to the TNRA server of the main node, starts
+# one or more OpenTripPlanner instances with otpmanager and waits until each of
+# them answers HTTP requests, registers itself with the server, and routes
+# until the server queue is empty. Routes are balanced between the
+# OpenTripPlanner instances by tnra.balancer.
+
+import argparse
+import multiprocessing
 import os
-import subprocess
+import socket
 import time
 
 import otpmanager
+import route_distances
 
-from . import router, server
-
-CONFIG = configparser.ConfigParser()
-CONFIG.read("config.ini")
-
-OTP_PATH = CONFIG["otp"]["path"]
+from . import balancer, router, server
 
-PORT = CONFIG["databases"]["queue_port"]
+DEFAULT_CONNECT_TIMEOUT = 60.0 # seconds to wait for the TNRA server
+DEFAULT_OTP_TIMEOUT = 600.0    # seconds to wait for OpenTripPlanner to start
+PROBE_INTERVAL = 2.0           # seconds between readiness probes
 
-def connect_to_main_node(hostame):
-    """ Attempts to connect to the server on the main node
+def wait_for_server(host = "localhost", port = server.DEFAULT_PORT,
+                    timeout = DEFAULT_CONNECT_TIMEOUT):
+    """ Wait until the TNRA server answers a ping
 
     Args:
-        hostname: The hostname of the main node
+        host, port: The location of the TNRA server
+        timeout: The number of seconds to wait
 
     Returns:
-        True if a connection could be made; False if not
-    """
-    print("setting up SSH TCP tunnel for port %d" % PORT)
-
-    args = [
-        "ssh",
-        "-fNL",
-        "%d:localhost:%d" % (PORT, PORT),
-        hostname
-    ]
-    print("Calling %s" % " ".join(args))
-    ssh_thread = subprocess.call(args)
+        A Client connected to the server
 
-    try:
-        atexit.register(ssh_thread.kill)
-    except AttributeError:
-        print("Could not open SSH tunnel; continuing anyway")
-        print("If this is running on the same server as the main server, "
-              "this message can be safely ignored.")
-
-    time.sleep(2)
+    Raises:
+        server.TimeoutError: The server did not answer in time
+    """
 
-    for i in range(connect_to_main_node_ATTEMPTS):
+    deadline = time.time() + timeout
+    while True:
+        client = server.Client(host, port)
         try:
-            server.Client().queue_size()
-            return True
-        except redis.exceptions.ConnectionError as err:
-            if (i != connect_to_main_node_ATTEMPTS):
-                print("Could not connect to Redis; trying again in 2 seconds")
-        time.sleep(2)
+            client.ping()
+            return client
+        except server.TimeoutError:
+            # a REQ socket cannot send again until it gets a reply
+            client.close()
+            if (time.time() > deadline):
+                raise
+            print("No response from %s:%d; trying again" % (host, port))
+
+def wait_for_otp(entrypoints, timeout = DEFAULT_OTP_TIMEOUT):
+    """ Wait until every OpenTripPlanner instance is ready
 
-    try:
-        ssh_thread.kill()
-    except AttributeError:
-        pass
-    return False
+    Args:
+        entrypoints: The host:port of every instance
+        timeout: The number of seconds to wait
 
-if (__name__ == "__main__"):
-    import optparse
-    parser = optparse.OptionParser()
-    parser.add_option("-c", "--city", dest = "city",
-                      help = "City whose graph should be loaded",
-                      metavar = "CITY")
-    parser.add_option("-H", "--hostname", dest = "hostname",
-                      help = "The hostname of the main server containing the "
-                             "running Redis instance. You can also specify "
-                             "the user by supplying user@hostname instead of "
-                             "just the hostname, as in the ssh command")
-    (options, args) = parser.parse_args()
-
-    router_kwargs = vars(options)
-
-    if (None in router_kwargs.values()):
-        print("All options are mandatory\n")
-        parser.print_help()
-    else:
-        hostname = router_kwargs.pop("hostname")
-        city = router_kwargs.pop("city")
-
-        if (connect_to_main_node(hostname)):
-            print("Starting node")
-
-            # Here, we use (0, 0, 0, 0) as the bounding box because we assume
-            # that the graph is already pre-generated, so the bounding box
-            # does not matter
-            manager = otpmanager.OTPManager(
-                city, 0, 0, 0, 0, otp_path = OTP_PATH
-            )
-            manager.start()
-            time.sleep(2)
+    Raises:
+        TimeoutError: Not every instance was ready in time
+    """
 
-            router_kwargs = {
-                "otp_port": manager.port
-            }
-            router.start_routers(
-                router_kwargs
+    deadline = time.time() + timeout
+    waiting = list(entrypoints)
+    while True:
+        waiting = [
+            entrypoint for entrypoint in waiting
+            if (not balancer.otp_ready(entrypoint, PROBE_INTERVAL))
+        ]
+        if (len(waiting) == 0):
+            return
+        if (time.time() > deadline):
+            raise TimeoutError(
+                "OpenTripPlanner is not ready at %s" % ", ".join(waiting)
             )
+        time.sleep(PROBE_INTERVAL)
 
-            manager.stop()
+def router_processes(concurrency = router.CONCURRENCY, cpus = None):
+    """ Return the number of router processes to start on this node, so that
+    there is about one route in flight per CPU
 
-            print("Node finished")
+    Args:
+        concurrency: The number of routes that each process calculates at once
+        cpus: The number of CPUs of the node, by default all of them
+    """
 
+    if (cpus is None):
+        cpus = multiprocessing.cpu_count()
+    return max(1, cpus // max(1, concurrency))
+
+def start_worker():
+    parser = argparse.ArgumentParser(
+        description = "Start the routing engines and routers of a worker node"
+    )
+    parser.add_argument("-H", "--host", default = "localhost",
+                        help = "The host of the TNRA server")
+    parser.add_argument("-p", "--port", type = int,
+                        default = server.DEFAULT_PORT,
+                        help = "The port of the TNRA server")
+    parser.add_argument("-r", "--result-port", type = int,
+                        default = server.DEFAULT_RESULT_PORT,
+                        help = "The port that the TNRA server receives "
+                               "results on")
+    parser.add_argument("-c", "--city",
+                        help = "The graph for OpenTripPlanner to load")
+    parser.add_argument("--otp-path",
+                        help = "The path to the OpenTripPlanner jar")
+    parser.add_argument("-n", "--otp-instances", type = int, default = 1,
+                        help = "Number of OpenTripPlanner instances to start")
+    parser.add_argument("-e", "--entrypoint", action = "append",
+                        help = "The host:port of an OpenTripPlanner instance "
+                               "that is already running, instead of starting "
+                               "one; may be given more than once")
+    parser.add_argument("--otp-timeout", type = float,
+                        default = DEFAULT_OTP_TIMEOUT,
+                        help = "Seconds to wait for OpenTripPlanner to start")
+    parser.add_argument("-P", "--processes", type = int,
+                        help = "Number of router processes; by default, one "
+                               "route is kept in flight per CPU")
+    parser.add_argument("--adaptive", action = "store_true",
+                        help = "Vary the number of active router processes, "
+                               "up to --processes, with the latency and "
+                               "failure rate of OpenTripPlanner")
+    parser.add_argument("--concurrency", type = int,
+                        default = router.CONCURRENCY,
+                        help = "Routes calculated at once by every process")
+    parser.add_argument("-m", "--modes", nargs = "+",
+                        help = "The modes to route; by default, every mode")
+    parser.add_argument("-q", "--queues", nargs = "+",
+                        help = "The queues to take routes from; by default, "
+                               "every queue")
+    parser.add_argument("--route-cache",
+                        help = "The path of a route cache to share between "
+                               "the routers of the node")
+    parser.add_argument("--graph-id", default = "",
+                        help = "The graph ID of cached routes; defaults to "
+                               "the city")
+    parser.add_argument("--name", default = socket.gethostname(),
+                        help = "The name to register the node with")
+    args = parser.parse_args()
+
+    if ((not args.entrypoint) and ((args.city is None)
+                                   or (args.otp_path is None))):
+        parser.error("either --entrypoint or --city and --otp-path are needed")
+
+    client = wait_for_server(args.host, args.port)
+    print("Connected to %s:%d" % (args.host, args.port))
+
+    managers = []
+    info = None
+    try:
+        if (args.entrypoint):
+            entrypoints = args.entrypoint
+        else:
+            # the graph is already built, so the bounding box does not matter
+            for i in range(args.otp_instances):
+                manager = otpmanager.OTPManager(
+                    args.city, 0, 0, 0, 0, otp_path = args.otp_path
+                )
+                manager.start()
+                managers.append(manager)
+            entrypoints = [
+                "localhost:%d" % manager.port for manager in managers
+            ]
+        print("Waiting for OpenTripPlanner at %s" % ", ".join(entrypoints))
+        wait_for_otp(entrypoints, args.otp_timeout)
+
+        processes = args.processes or router_processes(args.concurrency)
+        info = {
+            "pid": os.getpid(),
+            "cpus": multiprocessing.cpu_count(),
+            "processes": processes,
+            "concurrency": args.concurrency,
+            "entrypoints": entrypoints,
+            "adaptive": args.adaptive,
+            "modes": args.modes,
+            "queues": args.queues,
+            "status": "routing",
+            "started": time.time()
+        }
+        client.register_node(args.name, info)
+        print("Registered as %s; starting %d routers" % (args.name, processes))
+
+        router_kwargs = {
+            "router": route_distances.OTPDistances,
+            "kwargs": {},
+            "route_logging": False,
+            "server_host": args.host,
+            "server_port": args.port,
+            "server_result_port": args.result_port,
+            "queues": args.queues,
+            "modes": args.modes,
+            "concurrency": args.concurrency
+        }
+        if (args.route_cache is not None):
+            router_kwargs["route_cache"] = {
+                "path": args.route_cache,
+                "graph_id": args.graph_id or args.city or ""
+            }
+        if (len(entrypoints) == 1):
+            router_kwargs["kwargs"]["entrypoint"] = entrypoints[0]
+            endpoints = None
         else:
-            print("Failed to connect to Redis")
+            endpoints = entrypoints
+        router.start_routers(
+            router_kwargs, processes, adaptive = {} if args.adaptive else None,
+            endpoints = endpoints
+        )
+        info["status"] = "finished"
+        print("Node finished")
+    finally:
+        for manager in managers:
+            manager.stop_otp()
+        # a node that stopped with an error is not left routing on the server
+        if (info is not None):
+            if (info["status"] != "finished"):
+                info["status"] = "failed"
+            info["finished"] = time.time()
+            try:
+                client.register_node(args.name, info)
+            except server.TimeoutError:
+                print("Could not register %s as %s" % (
+                    args.name, info["status"]
+                ))
+        client.close()
+
+if (__name__ == "__main__"):
+    start_worker()
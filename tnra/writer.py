@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# background writer that batches result lines into group commits
+
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from . import blockfile
+
+FORMATS = ("jsonl", "blocks")
+
+DEFAULT_FLUSH_BYTES = 4 * 1024 * 1024 # flush once this many bytes are buffered
+DEFAULT_FLUSH_INTERVAL = 1.0          # or once the oldest line is this old
+DEFAULT_FSYNC_INTERVAL = None         # seconds between fsyncs; None to never
+
+STOPPED_CHECK_INTERVAL = 1.0 # seconds between checks that the writer is alive
+
+class ResultWriter(threading.Thread):
+
+    """ Thread that owns the output file and writes lines to it in batches
+
+    Lines are buffered in memory and written with a single write call once
+    flush_bytes have been buffered or flush_interval seconds have passed
+    since the first buffered line, whichever comes first. If fsync_interval
+    is set, the file is also fsynced after a flush if at least that many
+    seconds have passed since the last fsync; an fsync_interval of 0 fsyncs
+    after every flush. Lines written while no file is open are held in memory
+    until one is opened.
+
+    If writing to the output file fails, i.e. because the disk is full, the
+    writer stops: the error is kept as its error attribute, and is raised by
+    the call that is waiting on the writer and by every later call to open,
+    close or stop. Opening and closing files can fail without stopping the
+    writer.
+
+    Files can be written in one of two formats: "jsonl", which is one record
+    per line in a plain text file, or "blocks", which is a
+    tnra.blockfile block file. In the "blocks" format, records only reach the
+    file once their block is full or the file is closed.
+
+    Attributes:
+        lines_written, bytes_written: The number of lines and bytes written
+        flushes, fsyncs: The number of flushes and fsyncs done
+        error: The exception that stopped the writer, or None
+    """
+
+    def __init__(self, flush_bytes = DEFAULT_FLUSH_BYTES,
+                 flush_interval = DEFAULT_FLUSH_INTERVAL,
+                 fsync_interval = DEFAULT_FSYNC_INTERVAL):
+        """ Initializes ResultWriter object
+
+        Args:
+            flush_bytes: The number of buffered bytes that triggers a flush
+            flush_interval: The maximum number of seconds to buffer a line
+            fsync_interval: The minimum number of seconds between fsyncs, or
+                None to leave syncing to the operating system
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.error = None
+
+        self._ops = queue.Queue()
+        self._file = None
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._deadline = None
+        self._last_fsync = time.time()
+        self._start_time = time.time()
+
+    def write(self, line):
+        """ Queue a line to be written, without waiting for it to be written
+
+        Args:
+            line: The line to write, as bytes, without a trailing newline
+        """
+
+        self._ops.put(line)
+
+    def open(self, filename, mode = "w", format = "jsonl"):
+        """ Open a new output file, closing the current one, and wait for it
+        to be opened
+
+        Args:
+            filename: The path of the file
+            mode: The mode to open the file with; the file is always opened
+                in binary mode
+            format: The format of the file; one of FORMATS
+        """
+
+        if (format not in FORMATS):
+            raise ValueError("Unknown format %s" % format)
+        if ("b" not in mode):
+            mode += "b"
+        self._call("open", filename, mode, format)
+
+    def close(self):
+        """ Write every queued line and close the output file, waiting for it
+        to be closed """
+
+        self._call("close")
+
+    def stop(self):
+        """ Write every queued line, close the output file, and stop """
+
+        if (self.is_alive()):
+            self._call("stop")
+        self.join()
+
+    def stats(self):
+        """ Return write throughput statistics
+
+        Returns:
+            A dict of counters and rates since the writer was started
+        """
+
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        return {
+            "lines_written": self.lines_written,
+            "bytes_written": self.bytes_written,
+            "flushes": self.flushes,
+            "fsyncs": self.fsyncs,
+            "lines_per_second": self.lines_written / elapsed,
+            "bytes_per_second": self.bytes_written / elapsed,
+            "queued": self._ops.qsize(),
+            "error": None if (self.error is None) else str(self.error)
+        }
+
+    def _call(self, *op):
+        """ Queue a control operation and wait for the writer to run it,
+        re-raising any exception that it raised """
+
+        if (self.error is not None):
+            raise self.error
+        done = threading.Event()
+        outcome = []
+        self._ops.put((op, done, outcome))
+        # the writer may have stopped on an error before it got to the op
+        while (not done.wait(STOPPED_CHECK_INTERVAL)):
+            if (not self.is_alive()):
+                raise self.error or RuntimeError("The writer is not running")
+        if (outcome):
+            raise outcome[0]
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as err:
+            print("Result writer stopped:", file = sys.stderr)
+            traceback.print_exc()
+            self.error = err
+            # release every call that is waiting on the writer
+            while True:
+                try:
+                    op = self._ops.get_nowait()
+                except queue.Empty:
+                    break
+                if (not isinstance(op, bytes)):
+                    (name, done, outcome) = op
+                    outcome.append(err)
+                    done.set()
+
+    def _run(self):
+        while True:
+            if (self._deadline is None):
+                timeout = None
+            else:
+                timeout = max(self._deadline - time.time(), 0)
+
+            try:
+                op = self._ops.get(timeout = timeout)
+            except queue.Empty:
+                self._flush()
+                continue
+
+            if (isinstance(op, bytes)):
+                self._buffer.append(op)
+                self._buffer_bytes += len(op) + 1
+                if (self._deadline is None):
+                    self._deadline = time.time() + self.flush_interval
+                if (self._buffer_bytes >= self.flush_bytes):
+                    self._flush()
+                continue
+
+            ((name, *args), done, outcome) = op
+            try:
+                if (name == "open"):
+                    (filename, mode, format) = args
+                    self._flush()
+                    self._close_file()
+                    if (format == "blocks"):
+                        self._file = blockfile.BlockWriter(filename, mode)
+                    else:
+                        self._file = open(filename, mode)
+                    self._flush()
+                elif (name in ("close", "stop")):
+                    self._flush()
+                    self._close_file()
+            except Exception as err:
+                outcome.append(err)
+            done.set()
+            if (name == "stop"):
+                break
+
+    def _flush(self):
+        """ Write every buffered line to the output file in one write call """
+
+        self._deadline = None
+        if ((self._file is None) or (self._buffer_bytes == 0)):
+            return
+
+        if (isinstance(self._file, blockfile.BlockWriter)):
+            self._file.write_lines(self._buffer)
+        else:
+            self._file.write(b"\n".join(self._buffer) + b"\n")
+        self._file.flush()
+        self.lines_written += len(self._buffer)
+        self.bytes_written += self._buffer_bytes
+        self.flushes += 1
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        if ((self.fsync_interval is not None)
+                and (time.time() - self._last_fsync >= self.fsync_interval)):
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.time()
+            self.fsyncs += 1
+
+    def _close_file(self):
+        if (self._file is not None):
+            if (self.fsync_interval is not None):
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+            self._file.close()
+            self._file = None